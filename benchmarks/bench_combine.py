@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Benchmarks for the combination of the master calibration files.
+"""
+
+from soar_simager.data_reduction import combine
+
+from .common import BINNINGS, TemporaryFolder, write_reduced_file
+
+__author__ = 'Bruno Quint'
+
+N_FRAMES = 5
+
+
+class Combine(TemporaryFolder):
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    repeat = 3
+    timeout = 600
+
+    def setup(self, binning):
+
+        self.make_folder()
+
+        self.zero_files = []
+        self.flat_files = []
+
+        for i in range(N_FRAMES):
+
+            filename = self.join('zero{:d}.fits'.format(i))
+            write_reduced_file(filename, binning, 'ZERO', level=10., seed=i)
+            self.zero_files.append(filename)
+
+            filename = self.join('flat{:d}.fits'.format(i))
+            write_reduced_file(filename, binning, 'SFLAT', seed=i)
+            self.flat_files.append(filename)
+
+    def time_zero_combine(self, binning):
+        combine.ZeroCombine(
+            self.zero_files, output_file=self.join('0Zero.fits')).run()
+
+    def time_flat_combine(self, binning):
+        combine.FlatCombine(
+            self.flat_files, output_file=self.join('1NSFLAT.fits')).run()
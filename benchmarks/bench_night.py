@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Benchmarks for building the table that describes a night.
+"""
+
+import glob
+
+from soar_simager.data_reduction import sami
+
+from .common import BINNINGS, TemporaryFolder, write_raw_file
+
+__author__ = 'Bruno Quint'
+
+N_FILES = 10
+
+OBSTYPES = ['ZERO', 'SFLAT', 'OBJECT']
+
+
+class BuildTable(TemporaryFolder):
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    def setup(self, binning):
+
+        self.make_folder()
+
+        for i in range(N_FILES):
+            write_raw_file(self.join('sami_{:04d}.fits'.format(i)), binning,
+                           obstype=OBSTYPES[i % len(OBSTYPES)], seed=i)
+
+        self.list_of_files = glob.glob(self.join('*.fits'))
+
+    def time_build_table(self, binning):
+        sami.build_table(self.list_of_files)
+
+    def time_build_table_without_data_check(self, binning):
+        sami.build_table(self.list_of_files, check_data=False)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Benchmarks for the steps applied by the reducers to each frame.
+"""
+
+from soar_simager.data_reduction import cosmic_rays, parallel, reduce
+from soar_simager.data_reduction.cache import calibration_cache
+from soar_simager.data_reduction.writer import FrameWriter
+
+from .common import BINNINGS, TemporaryFolder, make_cosmic_ray_frame, \
+    make_cosmic_ray_sequence, make_raw_hdul, write_raw_file, \
+    write_reduced_file
+
+__author__ = 'Bruno Quint'
+
+
+class Merge(TemporaryFolder):
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    def setup(self, binning):
+        self.make_folder()
+        self.filename = self.join('raw.fits')
+        write_raw_file(self.filename, binning)
+        self.reducer = reduce.Reducer()
+
+    def time_merge(self, binning):
+        self.reducer.merge(self.filename)
+
+
+class Calibration(TemporaryFolder):
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    def setup(self, binning):
+
+        self.make_folder()
+
+        self.zero_file = self.join('zero.fits')
+        self.dark_file = self.join('dark.fits')
+        self.flat_file = self.join('flat.fits')
+
+        write_reduced_file(self.zero_file, binning, 'ZERO', level=10.)
+        write_reduced_file(self.dark_file, binning, 'DARK', level=1.)
+        write_reduced_file(self.flat_file, binning, 'DFLAT', level=1.)
+
+        self.data, self.header, _ = reduce.Reducer().merge(
+            make_raw_hdul(binning))
+
+        # The masters are read once per night, so they are kept out of the
+        # timings.
+        calibration_cache.clear()
+        calibration_cache.get_zero(self.zero_file, dtype=self.data.dtype)
+        calibration_cache.get_dark(self.dark_file, dtype=self.data.dtype)
+        calibration_cache.get_flat(self.flat_file, dtype=self.data.dtype)
+
+    def teardown(self, binning):
+        calibration_cache.clear()
+        TemporaryFolder.teardown(self)
+
+    def time_correct_zero(self, binning):
+        reduce.Reducer.correct_zero(
+            self.data, self.header, 'm_', self.zero_file)
+
+    def time_correct_dark(self, binning):
+        reduce.Reducer.correct_dark(
+            self.data, self.header, 'm_', self.dark_file)
+
+    def time_correct_flat(self, binning):
+        reduce.Reducer.correct_flat(
+            self.data, self.header, 'm_', self.flat_file)
+
+    def time_calibrate(self, binning):
+        # Corrects self.data in place: the values change between the runs,
+        # but not the time.
+        reduce.Reducer.calibrate(
+            self.data, self.header, 'm_', zero_file=self.zero_file,
+            dark_file=self.dark_file, flat_file=self.flat_file, time=True)
+
+
+class CosmicRays:
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    repeat = 1
+    timeout = 600
+
+    def setup(self, binning):
+        self.data, self.header, _ = reduce.Reducer().merge(
+            make_raw_hdul(binning))
+
+    def time_remove_cosmic_rays(self, binning):
+        reduce.Reducer.remove_cosmic_rays(
+            self.data, self.header, 'm_', True)
+
+    def time_remove_cosmic_rays_tiled(self, binning):
+        reduce.Reducer.remove_cosmic_rays(
+            self.data, self.header, 'm_', True,
+            tile_size=cosmic_rays.TILE_SIZE // binning, threads=2)
+
+    def time_remove_cosmic_rays_fast(self, binning):
+        reduce.Reducer.remove_cosmic_rays(
+            self.data, self.header, 'm_', 'fast')
+
+
+class StackCosmicRays:
+    """Cosmic rays rejected by comparing three dithered frames."""
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    repeat = 1
+    timeout = 600
+
+    def setup(self, binning):
+        self.frames, self.offsets, _ = make_cosmic_ray_sequence(binning)
+
+    def time_reject_in_stack(self, binning):
+        cosmic_rays.stack([f.copy() for f in self.frames],
+                          offsets=self.offsets)
+
+
+class CosmicRayDetection:
+    """Fraction of the cosmic ray hits found by each detector."""
+
+    params = [4]
+    param_names = ['binning']
+
+    def setup(self, binning):
+        self.data, self.hits = make_cosmic_ray_frame(binning)
+
+    def track_lacosmic_detection_rate(self, binning):
+        _, mask = cosmic_rays.lacosmic(self.data)
+        return float(mask[self.hits].mean())
+
+    def track_fast_detection_rate(self, binning):
+        _, mask = cosmic_rays.fast(self.data)
+        return float(mask[self.hits].mean())
+
+    def track_stack_detection_rate(self, binning):
+        frames, offsets, hits = make_cosmic_ray_sequence(binning)
+        cleaned = [f.copy() for f in frames]
+        cosmic_rays.stack(cleaned, offsets=offsets)
+        return float((cleaned[0] != frames[0])[hits[0]].mean())
+
+
+class CleanHotColumnsAndLines:
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    def setup(self, binning):
+        self.reducer = reduce.SamiReducer()
+        self.data, self.header, _ = self.reducer.merge(make_raw_hdul(binning))
+
+        # Load the bad pixel map before timing, as the pipeline does with
+        # the first frame of a night.
+        self.reducer.get_bad_pixel_map(self.header)
+
+    def time_clean_hot_columns_and_lines(self, binning):
+        self.reducer.clean_hot_columns_and_lines(
+            self.data.copy(), self.header, 'm_', True)
+
+
+class CreateWcs:
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    def setup(self, binning):
+        self.data, self.header, _ = reduce.Reducer().merge(
+            make_raw_hdul(binning))
+
+    def time_create_wcs(self, binning):
+        reduce.Reducer.create_wcs(self.data, self.header.copy())
+
+
+class SamiReduce(TemporaryFolder):
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    repeat = 1
+    timeout = 600
+
+    def setup(self, binning):
+
+        self.make_folder()
+        self.filename = self.join('raw.fits')
+        write_raw_file(self.filename, binning)
+
+        self.reducer = reduce.SamiReducer(cosmic_rays=False)
+
+    def time_reduce_without_cosmic_rays(self, binning):
+        self.reducer.reduce(self.filename)
+
+
+class ReduceFiles(TemporaryFolder):
+
+    params = BINNINGS
+    param_names = ['binning']
+
+    repeat = 1
+    timeout = 600
+
+    n_frames = 4
+
+    def setup(self, binning):
+
+        self.make_folder()
+        self.tasks = []
+
+        for i in range(self.n_frames):
+            filename = self.join('raw{:d}.fits'.format(i))
+            write_raw_file(filename, binning)
+            self.tasks.append((reduce.SamiReducer(cosmic_rays=False),
+                               filename, self.join('m_raw{:d}.fits'.format(i)),
+                               'OBJECT'))
+
+    def time_reduce_files(self, binning):
+        parallel.reduce_files(self.tasks)
+
+    def time_reduce_files_writing_in_background(self, binning):
+        with FrameWriter(threads=1) as writer:
+            parallel.reduce_files(self.tasks, writer=writer)
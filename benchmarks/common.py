@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Helpers shared by the benchmarks. The raw frames come from
+    soar_simager.tools.synthetic, so every run reads the same data.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from soar_simager.io import pyfits
+from soar_simager.tools import synthetic
+
+__author__ = 'Bruno Quint'
+
+BINNINGS = [1, 2, 4]
+
+
+def make_raw_hdul(binning, obstype='OBJECT', seed=0):
+    """Return a SAMI raw HDUList with four amplifiers."""
+    return synthetic.make_frame('SAM', obstype=obstype, binning=binning,
+                                seed=seed)
+
+
+def write_raw_file(filename, binning, obstype='OBJECT', seed=0):
+    """Write a SAMI raw file."""
+    make_raw_hdul(binning, obstype=obstype, seed=seed).writeto(
+        filename, overwrite=True)
+
+
+def write_reduced_file(filename, binning, obstype='ZERO', level=1000.,
+                       seed=0):
+    """Write a merged float32 frame, as written by the pipeline."""
+    rng = np.random.default_rng(seed)
+    n = 4096 // binning
+
+    header = pyfits.Header()
+    header['OBSTYPE'] = obstype
+    header['INSTRUME'] = 'SAM'
+    header['FILTERS'] = 'c0002'
+    header['CCDSUM'] = '{0:d} {0:d}'.format(binning)
+    header['EXPTIME'] = 60.
+
+    data = rng.normal(level, level / 100., size=(n, n)).astype(np.float32)
+    pyfits.writeto(filename, data, header, overwrite=True)
+
+
+def make_cosmic_ray_frame(binning, n_hits=None, seed=0):
+    """
+    Return a merged frame with sky, stars and noise, in ADU, and the mask of
+    the pixels hit by cosmic rays that are 5 sigma above the noise.
+    """
+    rng = np.random.default_rng(seed)
+    n = 4096 // binning
+
+    if n_hits is None:
+        n_hits = n * n // 2500
+
+    model = np.full((n, n), 800., dtype=np.float32)
+    synthetic._add_stars(model, rng, n_stars=n * n // 7000)
+
+    noise = np.sqrt(model / 2.6 + (10. / 2.6) ** 2)
+    image = model + noise * rng.standard_normal(model.shape, dtype=np.float32)
+
+    sky = image.copy()
+    synthetic._add_cosmic_rays(image, rng, n_hits)
+
+    hits = (image != sky) & (image - model > 5. * noise)
+
+    return image, hits
+
+
+def make_cosmic_ray_sequence(binning, n_frames=3, seed=0):
+    """
+    Same as make_cosmic_ray_frame for n_frames exposures of the same field,
+    dithered following synthetic.DITHERS. Also returns the (dy, dx) offsets
+    of each frame, as used by cosmic_rays.stack.
+    """
+    rng = np.random.default_rng(seed)
+    n = 4096 // binning
+    n_hits = n * n // 2500
+
+    frames, offsets, hits = [], [], []
+
+    for dx, dy in synthetic.DITHERS[:n_frames]:
+
+        model = np.full((n, n), 800., dtype=np.float32)
+        synthetic._add_stars(
+            model, np.random.default_rng(synthetic.FIELD_SEED),
+            n_stars=n * n // 7000, offset=(-dx / binning, -dy / binning))
+
+        noise = np.sqrt(model / 2.6 + (10. / 2.6) ** 2)
+        image = model + noise * rng.standard_normal(model.shape,
+                                                    dtype=np.float32)
+
+        sky = image.copy()
+        synthetic._add_cosmic_rays(image, rng, n_hits)
+
+        frames.append(image)
+        offsets.append((-dy // binning, -dx // binning))
+        hits.append((image != sky) & (image - model > 5. * noise))
+
+    return frames, np.array(offsets), hits
+
+
+class TemporaryFolder:
+    """Mixin that creates a temporary folder in setup."""
+
+    def make_folder(self):
+        self.path = tempfile.mkdtemp(prefix='sami_bench_')
+
+    def teardown(self, *args):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def join(self, name):
+        return os.path.join(self.path, name)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Benchmark Runner
+
+    The benchmarks follow the layout used by airspeed velocity (asv), so they
+    can be run with `asv run` using the asv.conf.json in the root of the
+    repository. This module is a small runner that only needs the standard
+    library. It runs the `time_*` methods of the classes found in the
+    `bench_*` modules, keeps the best of a few repeats, and stores or compares
+    the results against a baseline file.
+
+    Run it from the root of the repository:
+
+        $ python -m benchmarks.run --save
+        $ python -m benchmarks.run --compare
+"""
+
+import argparse
+import importlib
+import inspect
+import itertools
+import json
+import os
+import pkgutil
+import platform
+import sys
+import time
+
+import numpy as np
+
+__author__ = 'Bruno Quint'
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Default number of times each benchmark is repeated.
+REPEAT = 5
+
+# Default slowdown, relative to the baseline, that is reported as a
+# regression.
+TOLERANCE = 1.2
+
+
+def find_benchmarks(pattern=None):
+    """
+    Find the benchmark classes of the bench_* modules.
+
+    Args:
+
+        pattern (str, optional) : only keep the benchmarks whose name
+        contains this string.
+
+    Returns:
+
+        benchmarks (list) : (name, class, method name) tuples.
+    """
+    package = importlib.import_module(__package__ or 'benchmarks')
+    benchmarks = []
+
+    for module_info in sorted(pkgutil.iter_modules(package.__path__),
+                              key=lambda m: m.name):
+
+        if not module_info.name.startswith('bench_'):
+            continue
+
+        module = importlib.import_module(
+            '{}.{}'.format(package.__name__, module_info.name))
+
+        for class_name, cls in inspect.getmembers(module, inspect.isclass):
+
+            if cls.__module__ != module.__name__:
+                continue
+
+            for method in sorted(dir(cls)):
+
+                if not method.startswith('time_'):
+                    continue
+
+                name = '{}.{}.{}'.format(module_info.name, class_name, method)
+
+                if pattern is None or pattern in name:
+                    benchmarks.append((name, cls, method))
+
+    return benchmarks
+
+
+def get_params(cls):
+    """Return the combinations of parameters of a benchmark class."""
+    params = getattr(cls, 'params', None)
+
+    if params is None:
+        return [()]
+
+    if not params or not isinstance(params[0], (list, tuple)):
+        params = [params]
+
+    return list(itertools.product(*params))
+
+
+def run_benchmark(cls, method, params, repeat=REPEAT):
+    """
+    Time one benchmark method for one combination of parameters.
+
+    Returns:
+
+        seconds (float) : the best time of all the repeats, or None if the
+        setup raised NotImplementedError.
+    """
+    repeat = min(repeat, getattr(cls, 'repeat', repeat))
+    bench = cls()
+
+    try:
+        if hasattr(bench, 'setup'):
+            bench.setup(*params)
+    except NotImplementedError:
+        return None
+
+    try:
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            getattr(bench, method)(*params)
+            timings.append(time.perf_counter() - start)
+    finally:
+        if hasattr(bench, 'teardown'):
+            bench.teardown(*params)
+
+    return min(timings)
+
+
+def machine_info():
+    """Describe the machine used to run the benchmarks."""
+    return {
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'system': platform.system(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+    }
+
+
+def run(pattern=None, repeat=REPEAT, log=sys.stdout):
+    """
+    Run the benchmarks.
+
+    Returns:
+
+        results (dict) : best time in seconds of each benchmark, keyed by
+        `<module>.<class>.<method>(<params>)`. Skipped benchmarks are None.
+    """
+    results = {}
+
+    for name, cls, method in find_benchmarks(pattern):
+        for params in get_params(cls):
+
+            key = '{}({})'.format(name, ', '.join(str(p) for p in params))
+            results[key] = run_benchmark(cls, method, params, repeat=repeat)
+
+            if results[key] is None:
+                log.write('{:70s} skipped\n'.format(key))
+            else:
+                log.write('{:70s} {:10.4f} s\n'.format(key, results[key]))
+
+            log.flush()
+
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE, log=sys.stdout):
+    """
+    Compare the results with the baseline.
+
+    Returns:
+
+        regressions (list) : the benchmarks that became slower than the
+        baseline by more than the tolerance.
+    """
+    regressions = []
+
+    for key, seconds in sorted(results.items()):
+
+        reference = baseline.get(key)
+
+        if seconds is None or reference is None:
+            continue
+
+        ratio = seconds / reference
+        flag = ''
+
+        if ratio > tolerance:
+            flag = 'SLOWER'
+            regressions.append(key)
+        elif ratio < 1. / tolerance:
+            flag = 'faster'
+
+        log.write('{:70s} {:10.4f} s {:10.4f} s {:6.2f} {:s}\n'.format(
+            key, reference, seconds, ratio, flag))
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Run the benchmarks of the SAMI data reduction.")
+
+    parser.add_argument('-b', '--baseline', type=str, default=BASELINE,
+                        help="Baseline file (default: benchmarks/"
+                             "baseline.json).")
+
+    parser.add_argument('-c', '--compare', action='store_true',
+                        help="Compare the results with the baseline and "
+                             "return a non-zero status on regressions.")
+
+    parser.add_argument('-f', '--filter', type=str, default=None,
+                        help="Only run the benchmarks whose names contain "
+                             "this string.")
+
+    parser.add_argument('-r', '--repeat', type=int, default=REPEAT,
+                        help="Number of repeats (default: {:d}).".format(
+                            REPEAT))
+
+    parser.add_argument('-s', '--save', action='store_true',
+                        help="Save the results as the new baseline.")
+
+    parser.add_argument('-t', '--tolerance', type=float, default=TOLERANCE,
+                        help="Slowdown reported as a regression "
+                             "(default: {:.1f}).".format(TOLERANCE))
+
+    args = parser.parse_args()
+
+    results = run(pattern=args.filter, repeat=args.repeat)
+
+    if args.save:
+
+        baseline = {'machine': machine_info(), 'results': {}}
+
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline['results'] = json.load(f)['results']
+
+        baseline['results'].update(results)
+
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        print('\nBaseline measured on: {}\n'.format(baseline['machine']))
+
+        regressions = compare(results, baseline['results'],
+                              tolerance=args.tolerance)
+
+        if regressions:
+            print('\n{:d} benchmark(s) slower than the baseline.'.format(
+                len(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -72,7 +72,8 @@ setup(
 
     # You can just specify the packages manually here if your project is
     # simple. Or you can use find_packages().
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+    packages=find_packages(
+        exclude=['benchmarks', 'contrib', 'docs', 'tests']),
 
     # Alternatively, if you want to distribute just a my_module.py, uncomment
     # this:
@@ -97,6 +98,7 @@ setup(
     # installed, specify them here.
     package_data={
         'sami_filters': ['soar_sami/data/filters.json'],
+        'soar_simager': ['data/bad_pixels/*.json', 'data/recipes.json'],
     },
 
     # To provide executable scripts, use entry points in preference to the
@@ -108,6 +110,7 @@ setup(
     #    ],
     #},
     scripts=[
+        'bin/make_night',
         'bin/reduce_sami',
         'bin/reduce_soi',
 ],
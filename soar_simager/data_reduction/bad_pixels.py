@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Bad Pixel Maps
+
+    The known bad columns and lines of each instrument are stored in
+    versioned JSON files inside `soar_simager/data/bad_pixels`, one file per
+    instrument and binning (e.g. `sami_4x4.json`). Each file contains the
+    shape of the merged frame, the bad columns as [x, y0, yf] and the bad
+    lines as [x0, xf, y], using the same slices as Reducer.clean_column and
+    Reducer.clean_line.
+
+    When a map is loaded, the position of every bad pixel and of the pixels
+    used to replace it are computed once. Bad columns are replaced by the
+    median of the pixels at their left and right and bad lines by the median
+    of the pixels above and below them. Neighbours that are outside the frame
+    or that are bad themselves are not used. A frame is then repaired with a
+    single gather and median over all its bad pixels. The maps are cached in
+    memory, so all the frames of a night share the same arrays.
+
+    A map can also be derived from the master ZERO, DARK and FLAT files of a
+    night (see derive_bad_pixel_map). Columns, parts of columns and single
+    pixels that deviate from their neighbours in the same line are flagged.
+    Only the pixels found in more than one master are kept, so the cosmic
+    rays left in a master or the vignetted edges of a FLAT are not taken as
+    bad pixels. The result is written next to the masters with the same
+    format, so the detection runs once per night and binning.
+"""
+
+import functools
+import json
+import os
+
+import numpy as _np
+
+from scipy import ndimage
+
+from soar_simager.io import pyfits as _pyfits
+
+__author__ = 'Bruno Quint'
+
+__all__ = ['BadPixelMap', 'derive_bad_pixel_map', 'find_bad_pixels',
+           'get_bad_pixel_map', 'get_filename', 'read_bad_pixel_map']
+
+MAP_VERSION = 1
+
+PREFIXES = {'SAM': 'sami', 'SOI': 'soi'}
+
+# Number of pixels used at each side of a bad pixel.
+N_NEIGHBOURS = 5
+
+# Detection threshold, in robust standard deviations, number of blocks of
+# lines whose column profiles are compared by find_bad_pixels and width of
+# the running median used as reference. The width must be larger than twice
+# the widest group of adjacent bad columns.
+SIGMA = 5.
+N_BLOCKS = 16
+WIDTH = 33
+
+# Number of masters in which a bad column or pixel must be found.
+MIN_MASTERS = 2
+
+# Number of columns at the left and right edges of a master FLAT where no
+# bad pixels are searched. They are vignetted and, for SAMI, hold the two
+# central columns moved by SamiReducer, which the FLAT correction handles.
+FLAT_EDGE = WIDTH // 2
+
+
+def get_filename(instrument, binning):
+    """
+    Return the bad pixel map file of an instrument and binning.
+
+    Args:
+
+        instrument (str) : value of the INSTRUME keyword (e.g. 'SAM').
+
+        binning (int) : binning of the frames.
+
+    Returns:
+
+        filename (str) : path to the JSON file. It might not exist.
+    """
+    prefix = PREFIXES.get(instrument.strip().upper(), instrument.lower())
+
+    return os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), 'data', 'bad_pixels',
+        '{:s}_{:d}x{:d}.json'.format(prefix, binning, binning))
+
+
+class BadPixelMap:
+    """
+    Known bad columns and lines of a merged frame and the neighbours used to
+    repair them.
+
+    Parameters
+    ----------
+        shape : tuple
+            Shape (rows, columns) of the merged frame.
+
+        columns : list
+            Bad columns as [x, y0, yf]. The rows y0:yf of column x are bad.
+
+        lines : list
+            Bad lines as [x0, xf, y]. The columns x0:xf of line y are bad.
+
+        name : str
+            Name used in the header HISTORY (e.g. the map filename).
+
+        version : int
+            Version of the map.
+
+        n : int
+            Number of neighbours used at each side of a bad pixel.
+
+    Attributes
+    ----------
+        mask : numpy.ndarray
+            Boolean array with the shape of the frame. True on bad pixels.
+    """
+
+    def __init__(self, shape, columns=(), lines=(), name=None, version=None,
+                 n=N_NEIGHBOURS):
+
+        self.shape = tuple(int(s) for s in shape)
+        self.columns = [list(c) for c in columns]
+        self.lines = [list(line) for line in lines]
+        self.name = name
+        self.version = version
+        self.n = n
+
+        self.mask = _np.zeros(self.shape, dtype=bool)
+
+        column_pixels = self._column_pixels()
+        line_pixels = self._line_pixels()
+
+        for ys, xs in (column_pixels, line_pixels):
+            self.mask[ys, xs] = True
+
+        # A pixel that belongs to a bad column and to a bad line is repaired
+        # only once, using its horizontal neighbours.
+        in_column = _np.zeros(self.shape, dtype=bool)
+        in_column[column_pixels] = True
+        keep = ~in_column[line_pixels]
+        line_pixels = (line_pixels[0][keep], line_pixels[1][keep])
+
+        offsets = _np.concatenate(
+            (_np.arange(-n, 0), _np.arange(1, n + 1)))
+        zeros = _np.zeros_like(offsets)
+
+        self._columns = self._neighbours(column_pixels, zeros, offsets)
+        self._lines = self._neighbours(line_pixels, offsets, zeros)
+        self._both = self._concatenate_neighbours(self._columns, self._lines)
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Read a bad pixel map from a JSON file.
+
+        Args:
+
+            filename (str) : path to the file.
+
+        Returns:
+
+            bad_pixel_map (BadPixelMap)
+        """
+        with open(filename) as f:
+            content = json.load(f)
+
+        version = content.get('version', MAP_VERSION)
+        if version > MAP_VERSION:
+            raise ValueError(
+                'Bad pixel map {:s} has version {:d}. Only versions up to {:d}'
+                ' are supported.'.format(filename, version, MAP_VERSION))
+
+        return cls(content['shape'], columns=content.get('columns', []),
+                   lines=content.get('lines', []),
+                   name=os.path.basename(filename), version=version)
+
+    @classmethod
+    def from_mask(cls, mask, min_column=2, **kwargs):
+        """
+        Create a bad pixel map from a boolean mask. Vertical runs of bad
+        pixels become bad columns and the remaining bad pixels become bad
+        lines, so single pixels are repaired with the pixels above and
+        below them.
+
+        Args:
+
+            mask (numpy.ndarray) : 2D boolean array. True on bad pixels.
+
+            min_column (int, optional) : shortest vertical run treated as a
+            bad column (default = 2).
+
+            **kwargs : name and version of the map.
+
+        Returns:
+
+            bad_pixel_map (BadPixelMap)
+        """
+        mask = _np.asarray(mask, dtype=bool)
+
+        xs, y0s, yfs = _runs(mask.T)
+        is_column = (yfs - y0s) >= min_column
+
+        columns = [[int(x), int(y0), int(yf)] for x, y0, yf in
+                   zip(xs[is_column], y0s[is_column], yfs[is_column])]
+
+        remaining = mask.copy()
+        for x, y0, yf in columns:
+            remaining[y0:yf, x] = False
+
+        ys, x0s, xfs = _runs(remaining)
+        lines = [[int(x0), int(xf), int(y)] for y, x0, xf in
+                 zip(ys, x0s, xfs)]
+
+        return cls(mask.shape, columns=columns, lines=lines, **kwargs)
+
+    def to_file(self, filename, instrument=None, binning=None,
+                derived_from=None):
+        """
+        Write the map to a JSON file, one bad column or line per line.
+
+        Args:
+
+            filename (str) : path to the file.
+
+            instrument (str, optional) : value of the INSTRUME keyword.
+
+            binning (int, optional) : binning of the frames.
+
+            derived_from (list, optional) : master files used to find the
+            bad pixels.
+        """
+        header = [('instrument', instrument), ('binning', binning),
+                  ('version', self.version or MAP_VERSION),
+                  ('shape', list(self.shape)),
+                  ('derived_from', derived_from)]
+
+        lines = ['    {:s}: {:s},'.format(json.dumps(key), json.dumps(value))
+                 for key, value in header if value is not None]
+
+        for key, regions in [('columns', self.columns),
+                             ('lines', self.lines)]:
+            if regions:
+                lines.append('    {:s}: ['.format(json.dumps(key)))
+                lines.append(',\n'.join(
+                    '        ' + json.dumps(r) for r in regions))
+                lines.append('    ],')
+            else:
+                lines.append('    {:s}: [],'.format(json.dumps(key)))
+
+        lines[-1] = lines[-1].rstrip(',')
+
+        temp_filename = filename + '.tmp'
+
+        with open(temp_filename, 'w') as f:
+            f.write('{\n' + '\n'.join(lines) + '\n}\n')
+
+        os.replace(temp_filename, filename)
+
+    def _column_pixels(self):
+
+        ny, nx = self.shape
+        ys, xs = [], []
+
+        for x, y0, yf in self.columns:
+            if 0 <= x < nx:
+                y = _np.arange(ny)[y0:yf]
+                ys.append(y)
+                xs.append(_np.full(y.size, x))
+
+        return self._concatenate(ys, xs)
+
+    def _line_pixels(self):
+
+        ny, nx = self.shape
+        ys, xs = [], []
+
+        for x0, xf, y in self.lines:
+            if 0 <= y < ny:
+                x = _np.arange(nx)[x0:xf]
+                xs.append(x)
+                ys.append(_np.full(x.size, y))
+
+        return self._concatenate(ys, xs)
+
+    @staticmethod
+    def _concatenate(ys, xs):
+        """Return unique (ys, xs) index arrays."""
+        if not ys:
+            empty = _np.zeros(0, dtype=_np.intp)
+            return empty, empty
+
+        ys = _np.concatenate(ys).astype(_np.intp)
+        xs = _np.concatenate(xs).astype(_np.intp)
+
+        _, unique = _np.unique(ys * (xs.max() + 1) + xs, return_index=True)
+        unique.sort()
+
+        return ys[unique], xs[unique]
+
+    def _neighbours(self, pixels, dy, dx):
+        """
+        Return the flat indices of the bad pixels that have good neighbours,
+        of their neighbours, the positions of the neighbours that cannot be
+        used and the positions of the two central values of the sorted good
+        neighbours.
+        """
+        ys, xs = pixels
+
+        ny = ys[:, _np.newaxis] + dy
+        nx = xs[:, _np.newaxis] + dx
+
+        valid = (ny >= 0) & (ny < self.shape[0]) & \
+                (nx >= 0) & (nx < self.shape[1])
+
+        ny = _np.where(valid, ny, 0)
+        nx = _np.where(valid, nx, 0)
+        valid &= ~self.mask[ny, nx]
+
+        count = valid.sum(axis=1)
+        good = count > 0
+        valid, count = valid[good], count[good]
+
+        rows = _np.arange(count.size) * dy.size
+
+        targets = _np.ravel_multi_index((ys[good], xs[good]), self.shape)
+        neighbours = _np.ravel_multi_index((ny[good], nx[good]), self.shape)
+
+        return (targets, neighbours, _np.flatnonzero(~valid),
+                rows + (count - 1) // 2, rows + count // 2)
+
+    @staticmethod
+    def _concatenate_neighbours(columns, lines):
+        """Join the neighbours of the bad columns and of the bad lines."""
+        offset = columns[1].size
+
+        return (_np.concatenate((columns[0], lines[0])),
+                _np.concatenate((columns[1], lines[1])),
+                _np.concatenate((columns[2], lines[2] + offset)),
+                _np.concatenate((columns[3], lines[3] + offset)),
+                _np.concatenate((columns[4], lines[4] + offset)))
+
+    @property
+    def n_pixels(self):
+        """Number of bad pixels."""
+        return int(self.mask.sum())
+
+    def repair(self, data, columns=True, lines=True):
+        """
+        Replace the bad pixels of a frame, in place, by the median of their
+        good neighbours. Pixels without good neighbours are not changed.
+        The data type of the frame is kept.
+
+        Args:
+
+            data (numpy.ndarray) : 2D array with the merged frame.
+
+            columns (bool, optional) : repair the bad columns.
+
+            lines (bool, optional) : repair the bad lines.
+
+        Returns:
+
+            data (numpy.ndarray) : the same array, repaired.
+        """
+        if data.shape != self.shape:
+            raise ValueError(
+                'Frame with shape {} does not match the bad pixel map with '
+                'shape {}.'.format(data.shape, self.shape))
+
+        if columns and lines:
+            indices = self._both
+        elif columns:
+            indices = self._columns
+        elif lines:
+            indices = self._lines
+        else:
+            return data
+
+        targets, neighbours, invalid, lower, upper = indices
+
+        if targets.size == 0:
+            return data
+
+        # Neighbours that cannot be used become infinite, so numpy.sort puts
+        # them at the end of each row and the median of the good ones is
+        # taken from the precomputed positions.
+        values = _np.take(data.reshape(-1), neighbours)
+        values.reshape(-1)[invalid] = _np.inf
+        values.sort(axis=1)
+
+        values = values.reshape(-1)
+        median = 0.5 * (values[lower] + values[upper])
+
+        if data.flags.c_contiguous:
+            data.reshape(-1)[targets] = median
+        else:
+            data[_np.unravel_index(targets, self.shape)] = median
+
+        return data
+
+
+@functools.lru_cache(maxsize=None)
+def get_bad_pixel_map(instrument, binning):
+    """
+    Return the bad pixel map of an instrument and binning. Maps are read once
+    and kept in memory.
+
+    Args:
+
+        instrument (str) : value of the INSTRUME keyword (e.g. 'SAM').
+
+        binning (int) : binning of the frames.
+
+    Returns:
+
+        bad_pixel_map (BadPixelMap) : None if there is no map for this
+        instrument and binning.
+    """
+    filename = get_filename(instrument, binning)
+
+    if not os.path.exists(filename):
+        return None
+
+    return BadPixelMap.from_file(filename)
+
+
+def read_bad_pixel_map(filename):
+    """
+    Read a bad pixel map from a JSON file. Maps are kept in memory until the
+    file changes on disk.
+
+    Args:
+
+        filename (str) : path to the file.
+
+    Returns:
+
+        bad_pixel_map (BadPixelMap)
+    """
+    filename = os.path.abspath(filename)
+
+    return _read_bad_pixel_map(filename, os.stat(filename).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=8)
+def _read_bad_pixel_map(filename, mtime):
+    return BadPixelMap.from_file(filename)
+
+
+def _runs(mask):
+    """
+    Return the line, start and stop of the runs of True along the lines of a
+    2D boolean array.
+    """
+    padded = _np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=_np.int8)
+    padded[:, 1:-1] = mask
+
+    steps = _np.diff(padded, axis=1)
+    lines, starts = _np.nonzero(steps == 1)
+    _, stops = _np.nonzero(steps == -1)
+
+    return lines, starts, stops
+
+
+def _robust_std(data):
+    """Standard deviation estimated from the median absolute deviation."""
+    data = data[_np.isfinite(data)]
+
+    if data.size == 0:
+        return 0.
+
+    return 1.4826 * _np.median(_np.abs(data - _np.median(data)))
+
+
+def find_bad_pixels(data, sigma=SIGMA, n_blocks=N_BLOCKS, width=WIDTH):
+    """
+    Find the bad pixels of a master frame. The frame is split in blocks of
+    lines and the median of each column in each block is compared to the
+    running median of the columns around it. Columns whose median deviates
+    are flagged over the whole block. Single pixels that deviate from the
+    running median of their block are flagged too.
+
+    Args:
+
+        data (numpy.ndarray) : 2D array with a master ZERO, DARK or FLAT.
+
+        sigma (float, optional) : detection threshold in robust standard
+        deviations (default = SIGMA).
+
+        n_blocks (int, optional) : number of blocks of lines
+        (default = N_BLOCKS).
+
+        width (int, optional) : number of columns used by the running
+        median (default = WIDTH).
+
+    Returns:
+
+        mask (numpy.ndarray) : 2D boolean array. True on bad pixels.
+    """
+    data = _np.asarray(data, dtype=_np.float32)
+    ny, nx = data.shape
+
+    edges = _np.linspace(0, ny, min(n_blocks, ny) + 1).astype(int)
+    block = _np.repeat(_np.arange(edges.size - 1), _np.diff(edges))
+
+    profile = _np.stack([_np.median(data[y0:yf], axis=0)
+                         for y0, yf in zip(edges[:-1], edges[1:])])
+    # Repeating the edge columns would bias the running median near the
+    # edges whenever the last columns differ from their neighbours.
+    background = ndimage.median_filter(
+        profile, size=(1, width), mode='mirror')
+
+    residual = profile - background
+    mask = (_np.abs(residual) > sigma * _robust_std(residual))[block]
+
+    residual = data - background[block]
+    mask |= _np.abs(residual) > sigma * _robust_std(residual[::4, ::4])
+
+    return mask
+
+
+def derive_bad_pixel_map(output_file, master_files, instrument=None,
+                         binning=None, sigma=SIGMA, min_masters=MIN_MASTERS):
+    """
+    Find the bad pixels of a night in its master files and write them to a
+    bad pixel map. The bad columns and the single bad pixels must be found
+    in at least min_masters masters: the cosmic rays, noise or vignetting
+    left in one master do not persist in the others. The FLAT_EDGE columns
+    at each side of the master FLATs are not searched. The measured bad
+    columns and lines of the instrument are included.
+
+    Args:
+
+        output_file (str) : JSON file that will be written.
+
+        master_files (list) : master ZERO, DARK and FLAT files with the same
+        binning.
+
+        instrument (str, optional) : value of the INSTRUME keyword.
+
+        binning (int, optional) : binning of the masters.
+
+        sigma (float, optional) : detection threshold in robust standard
+        deviations (default = SIGMA).
+
+        min_masters (int, optional) : number of masters in which a bad
+        column or pixel must be found (default = MIN_MASTERS).
+
+    Returns:
+
+        bad_pixel_map (BadPixelMap) : the map written.
+    """
+    if len(master_files) == 0:
+        raise ValueError('At least one master file is needed to find the '
+                         'bad pixels.')
+
+    count = None
+
+    for master_file in master_files:
+
+        data, header = _pyfits.getdata(master_file, header=True)
+        found = find_bad_pixels(data, sigma=sigma)
+
+        if 'FLAT' in str(header.get('OBSTYPE', '')).upper():
+            found[:, :FLAT_EDGE] = False
+            found[:, -FLAT_EDGE:] = False
+
+        if count is None:
+            count = _np.zeros(found.shape, dtype=_np.uint16)
+
+        count += found
+
+    mask = count >= min_masters
+
+    if instrument is not None and binning is not None:
+
+        known = get_bad_pixel_map(instrument, binning)
+        if known is not None and known.shape == mask.shape:
+            mask |= known.mask
+
+    bad_pixel_map = BadPixelMap.from_mask(
+        mask, name=os.path.basename(output_file), version=MAP_VERSION)
+    bad_pixel_map.to_file(
+        output_file, instrument=instrument, binning=binning,
+        derived_from=[os.path.basename(f) for f in master_files])
+
+    return bad_pixel_map
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Frame Buffers
+
+    All the frames of a night with the same binning are merged into arrays
+    with the same shape, which are thrown away as soon as the reduced frame
+    is written. Instead, the reducers take the merged frame from a small pool
+    and the pipeline gives it back once the frame is on disk, so the next
+    frame reuses the same memory. This keeps the memory used by a long night
+    flat and avoids asking the allocator for a new full frame each time.
+
+    Only the arrays handed out by the pool can be given back. Arrays that
+    are never given back are simply freed, so the callers that keep the
+    result of Reducer.reduce are not affected. Each process has its own
+    pool, so the workers of parallel.reduce_files reuse their own buffers.
+"""
+
+import collections
+import threading
+import weakref
+
+import numpy as _np
+
+__author__ = 'Bruno Quint'
+
+__all__ = ['FramePool', 'frame_pool']
+
+
+class FramePool:
+    """
+    Pool of reusable frame buffers, keyed by shape and data type.
+
+    Parameters
+    ----------
+        maxsize : int
+            Maximum number of free buffers kept for each shape and data
+            type.
+    """
+
+    def __init__(self, maxsize=2):
+
+        self.maxsize = maxsize
+
+        self._free = collections.defaultdict(list)
+        self._lent = {}
+
+        # Reentrant, since the garbage collector may call _forget while the
+        # lock is held.
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(buffers) for buffers in self._free.values())
+
+    def clear(self):
+        """Free all the buffers kept by the pool."""
+        with self._lock:
+            self._free.clear()
+
+    def get(self, shape, dtype=float):
+        """
+        Return a buffer for one frame. Its content is not initialized.
+
+        Args:
+
+            shape (tuple) : shape of the frame.
+
+            dtype (numpy.dtype, optional) : data type of the frame.
+
+        Returns:
+
+            buffer (numpy.ndarray) : a free buffer of the pool, or a new one
+            if there is none with this shape and data type.
+        """
+        key = (tuple(shape), _np.dtype(dtype).str)
+
+        with self._lock:
+            free = self._free.get(key)
+            buffer = free.pop() if free else None
+
+        if buffer is None:
+            buffer = _np.empty(shape, dtype=dtype)
+
+        with self._lock:
+            self._lent[id(buffer)] = weakref.ref(
+                buffer, lambda ref, i=id(buffer): self._forget(i, ref))
+
+        return buffer
+
+    def release(self, buffer):
+        """
+        Give a buffer back to the pool. It must not be used afterwards.
+
+        Args:
+
+            buffer (numpy.ndarray) : an array returned by get. Other arrays,
+            including views of the buffers, are ignored.
+
+        Returns:
+
+            released (bool) : True if the buffer was kept for the next
+            frames.
+        """
+        if not isinstance(buffer, _np.ndarray):
+            return False
+
+        key = (buffer.shape, buffer.dtype.str)
+
+        with self._lock:
+
+            ref = self._lent.get(id(buffer))
+            if ref is None or ref() is not buffer:
+                return False
+
+            del self._lent[id(buffer)]
+
+            free = self._free[key]
+            if len(free) >= self.maxsize:
+                return False
+
+            free.append(buffer)
+
+        return True
+
+    def _forget(self, buffer_id, ref):
+        """Drop the record of a lent buffer that was freed."""
+        with self._lock:
+            if self._lent.get(buffer_id) is ref:
+                del self._lent[buffer_id]
+
+
+# Pool shared by all the reducers living in the same process.
+frame_pool = FramePool()
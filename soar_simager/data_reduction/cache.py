@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Calibration Cache
+
+    The same master ZERO, DARK and FLAT files are applied to every frame of a
+    night. Instead of opening them for each frame, the reducers get them from
+    a small in-memory cache that keeps the data ready to be used: the master
+    DARK is stored already divided by its exposure time. The entries are keyed
+    by the absolute path and the modification time of the master file, so a
+    master that is rewritten on disk is read again. When the cache is full, the
+    least recently used entry is discarded.
+"""
+
+import collections
+import os
+import threading
+
+import numpy as _np
+
+from soar_simager.data_reduction import profiling
+from soar_simager.io import pyfits as _pyfits
+
+__author__ = 'Bruno Quint'
+
+
+def _load_dark(filename, dtype):
+    """Return the master dark normalized to one second of exposure."""
+    with _pyfits.open(filename) as hdul:
+        data = hdul[0].data / float(hdul[0].header['EXPTIME'])
+
+    return data.astype(dtype)
+
+
+def _load_data(filename, dtype):
+    """Return the data of the primary HDU."""
+    with _pyfits.open(filename) as hdul:
+        data = hdul[0].data.astype(dtype)
+
+    return data
+
+
+class CalibrationCache:
+    """
+    Least recently used cache for master calibration files.
+
+    Parameters
+    ----------
+        maxsize : int
+            Maximum number of master files kept in memory.
+
+        dtype : numpy.dtype
+            Default data type used to store the master files.
+    """
+
+    loaders = {
+        'dark': _load_dark,
+        'flat': _load_data,
+        'zero': _load_data,
+    }
+
+    def __init__(self, maxsize=8, dtype=_np.float32):
+
+        self.maxsize = maxsize
+        self.dtype = dtype
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Remove all the master files from memory."""
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, kind, filename, dtype=None):
+        """
+        Return the data of a master calibration file.
+
+        Args:
+
+            kind (str) : one of 'zero', 'dark' or 'flat'.
+
+            filename (str) : master file name.
+
+            dtype (numpy.dtype, optional) : data type of the returned array.
+            The same master may be kept with different data types.
+
+        Returns:
+
+            data (numpy.ndarray) : read-only array with the master data.
+        """
+        dtype = _np.dtype(self.dtype if dtype is None else dtype)
+        filename = os.path.abspath(filename)
+        key = (kind, filename, dtype.str, os.stat(filename).st_mtime_ns)
+
+        with self._lock:
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            # Forget older versions of the same file
+            for old_key in list(self._entries):
+                if old_key[:3] == key[:3]:
+                    del self._entries[old_key]
+
+        data = self.loaders[kind](filename, dtype)
+        data.flags.writeable = False
+        profiling.add_bytes_read(os.path.getsize(filename))
+
+        with self._lock:
+
+            self._entries[key] = data
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return data
+
+    def get_dark(self, filename, dtype=None):
+        """Return the master dark already divided by its exposure time."""
+        return self.get('dark', filename, dtype=dtype)
+
+    def get_flat(self, filename, dtype=None):
+        """Return the master flat."""
+        return self.get('flat', filename, dtype=dtype)
+
+    def get_zero(self, filename, dtype=None):
+        """Return the master zero."""
+        return self.get('zero', filename, dtype=dtype)
+
+
+# Registry shared by all the reducers living in the same process.
+calibration_cache = CalibrationCache()
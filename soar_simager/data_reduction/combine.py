@@ -3,13 +3,179 @@
 
 __author__ = 'Bruno Quint'
 
-import ccdproc
+import os
+
 import numpy as np
 
 from astropy.io import fits as pyfits
 
+from soar_simager.data_reduction import profiling
 from soar_simager.io.logging import get_logger
 
+# Default amount of memory, in bytes, used to hold the stack of images.
+MEM_LIMIT = 5e8
+
+# Number of lowest and highest values of each pixel rejected when the ZERO
+# and DARK frames are combined.
+N_LOW = 1
+N_HIGH = 1
+
+
+def combine_files(input_list, method='average', scale=None,
+                  minmax_clip=False, minmax_clip_min=None,
+                  minmax_clip_max=None, sigma_clip=False,
+                  sigma_clip_low_thresh=3, sigma_clip_high_thresh=3,
+                  n_low=0, n_high=0, mem_limit=MEM_LIMIT):
+    """
+    Combine a list of FITS files. The files are memory-mapped and combined in
+    bands of rows whose size is given by the memory budget, so each input is
+    read only once and sequentially. The rejection and combination follow
+    the same rules used by ccdproc.combine. n_low and n_high add the minmax
+    rejection of IRAF's imcombine, which ccdproc does not have.
+
+    Args:
+
+        input_list (list) : list of files to be combined.
+
+        method (str, optional) : 'average' or 'median' (default = 'average').
+
+        scale (function, optional) : function applied to each image to
+        obtain the factor that multiplies it before combining.
+
+        minmax_clip (bool, optional) : reject pixels below minmax_clip_min or
+        above minmax_clip_max (default = False).
+
+        minmax_clip_min (float, optional) : lower threshold for minmax_clip.
+
+        minmax_clip_max (float, optional) : upper threshold for minmax_clip.
+
+        sigma_clip (bool, optional) : reject pixels that deviate from the
+        mean of the stack by more than the thresholds, in units of the
+        standard deviation of the stack (default = False).
+
+        sigma_clip_low_thresh (float, optional) : lower threshold.
+
+        sigma_clip_high_thresh (float, optional) : upper threshold.
+
+        n_low (int, optional) : number of lowest values of each pixel that
+        are rejected (default = 0).
+
+        n_high (int, optional) : number of highest values of each pixel that
+        are rejected, e.g. to remove the cosmic rays (default = 0). Pixels
+        with no more than n_low + n_high valid values keep all of them.
+
+        mem_limit (float, optional) : memory budget in bytes
+        (default = MEM_LIMIT).
+
+    Returns:
+
+        combined (numpy.ndarray) : the combined data, with the same floating
+        point type of the inputs. The stack itself is always combined using
+        float64. Pixels rejected in all the images are set to NaN.
+    """
+    if method == 'average':
+        combine_function = np.nanmean
+    elif method == 'median':
+        combine_function = np.nanmedian
+    else:
+        raise ValueError('Unknown combine method: {}'.format(method))
+
+    hdu_lists = [pyfits.open(f, memmap=True) for f in input_list]
+
+    try:
+        images = [hdul[0].data for hdul in hdu_lists]
+        n_images = len(images)
+        n_rows, n_columns = images[0].shape
+
+        if scale is not None:
+            scaling = np.array([scale(image) for image in images])
+            scaling = scaling[:, np.newaxis, np.newaxis]
+
+        # The stack, its mask and the temporary arrays used to reject pixels
+        # need about four times the size of the band.
+        row_size = 4 * n_images * n_columns * np.dtype(float).itemsize
+        band_size = max(1, min(n_rows, int(mem_limit // row_size)))
+
+        combined = np.empty((n_rows, n_columns),
+                            dtype=np.result_type(images[0].dtype, np.float32))
+        stack = np.empty((n_images, band_size, n_columns), dtype=float)
+
+        for r1 in range(0, n_rows, band_size):
+
+            r2 = min(r1 + band_size, n_rows)
+            band = stack[:, :r2 - r1]
+
+            for i, image in enumerate(images):
+                band[i] = image[r1:r2]
+                profiling.add_bytes_read(band[i].nbytes)
+
+            mask = ~np.isfinite(band)
+
+            if minmax_clip:
+                if minmax_clip_min is not None:
+                    mask |= band < minmax_clip_min
+                if minmax_clip_max is not None:
+                    mask |= band > minmax_clip_max
+
+            if sigma_clip:
+                with np.errstate(invalid='ignore'):
+                    center = np.nanmean(band, axis=0)
+                    deviation = np.nanstd(band, axis=0)
+                    mask |= band < center - sigma_clip_low_thresh * deviation
+                    mask |= band > center + sigma_clip_high_thresh * deviation
+
+            if scale is not None:
+                band *= scaling
+
+            band[mask] = np.nan
+
+            if n_low > 0 or n_high > 0:
+                reject_extrema(band, n_low, n_high)
+
+            with np.errstate(invalid='ignore'):
+                combined[r1:r2] = combine_function(band, axis=0)
+
+    finally:
+        for hdul in hdu_lists:
+            hdul.close()
+
+    return combined
+
+
+def reject_extrema(stack, n_low, n_high):
+    """
+    Reject, in place, the n_low lowest and n_high highest values of each
+    pixel of a stack. Pixels with no more than n_low + n_high finite values
+    are not changed.
+
+    Args:
+
+        stack (numpy.ndarray) : 3D array of floats with the images along the
+        first axis. NaN marks the values already rejected. The order of the
+        values of each pixel is not kept.
+
+        n_low (int) : number of lowest values rejected.
+
+        n_high (int) : number of highest values rejected.
+
+    Returns:
+
+        stack (numpy.ndarray) : the same array, with the rejected values set
+        to NaN.
+    """
+    # NaN are sorted to the end, after the highest valid value.
+    stack.sort(axis=0)
+
+    count = np.isfinite(stack).sum(axis=0)
+    rank = np.arange(stack.shape[0]).reshape((-1,) + (1,) * (stack.ndim - 1))
+
+    reject = (rank < n_low) | (rank >= count - n_high)
+    reject &= count > n_low + n_high
+
+    stack[reject] = np.nan
+
+    return stack
+
 
 def scale_flat_sami(data):
     """
@@ -21,13 +187,12 @@ def scale_flat_sami(data):
         the masked data.
 
     """
-    data = np.ma.masked_invalid(data)
     h, w = data.shape
 
     r1, r2 = h // 2 - h // 10, h // 2 + h // 10
     c1, c2 = w // 2 - w // 10, w // 2 + w // 10
 
-    data = data[r1:r2, c1:c2]
+    data = np.ma.masked_invalid(data[r1:r2, c1:c2])
     scale_factor = 1. / np.ma.median(data)
 
     return scale_factor
@@ -81,7 +246,8 @@ class Combine:
 
 class DarkCombine(Combine):
 
-    def __init__(self, input_list, output_file=None, verbose=False, debug=False):
+    def __init__(self, input_list, output_file=None, verbose=False, debug=False,
+                 mem_limit=MEM_LIMIT):
         """
         Class created to help combining dark files.
 
@@ -95,10 +261,13 @@ class DarkCombine(Combine):
 
             debug (bool) : Turn on debug mode? (default = False)
 
+            mem_limit (float) : Memory budget in bytes (default = MEM_LIMIT)
+
         """
         Combine.__init__(self, verbose=verbose, debug=debug)
         self.input_list = input_list
         self.output_filename = output_file
+        self.mem_limit = mem_limit
 
     def run(self):
 
@@ -113,22 +282,24 @@ class DarkCombine(Combine):
         header = pyfits.getheader(self.input_list[0])
         bx, by = header['CCDSUM'].strip().split()
 
-        # Parameter obtained from PySOAR, written by Luciano Fraga
-        master_dark = ccdproc.combine(
-            self.input_list, method='average', mem_limit=6.4e7,
-            minmax_clip=True, unit='adu')
+        # The highest and lowest value of each pixel are rejected, which
+        # removes the cosmic rays without biasing the average.
+        master_dark = combine_files(
+            self.input_list, method='average', mem_limit=self.mem_limit,
+            n_low=N_LOW, n_high=N_HIGH)
 
         if self.output_filename is None:
             self.output_filename = "1Dark{}x{}".format(bx, by)
 
         pyfits.writeto(
-            self.output_filename, master_dark.data, header)
+            self.output_filename, master_dark, header, overwrite=True)
+        profiling.add_bytes_written(os.path.getsize(self.output_filename))
 
 
 class FlatCombine(Combine):
 
     def __init__(self, input_list, output_file=None, verbose=False,
-                 debug=False):
+                 debug=False, mem_limit=MEM_LIMIT):
         """
         Class created to help combining flats. By now, it does not do any type
         or organization. It will simply combine all the flat images that are
@@ -144,11 +315,14 @@ class FlatCombine(Combine):
 
             debug (bool) : Turn on debug mode? (default = False)
 
+            mem_limit (float) : Memory budget in bytes (default = MEM_LIMIT)
+
         """
 
         Combine.__init__(self, verbose=verbose, debug=debug)
         self.input_list = input_list
         self.output_filename = output_file
+        self.mem_limit = mem_limit
 
     def run(self):
 
@@ -162,19 +336,18 @@ class FlatCombine(Combine):
 
         header = pyfits.getheader(self.input_list[0])
 
+        scale_function = None
         if header['INSTRUME'] == 'SAM':
             scale_function = scale_flat_sami
 
         # TODO - Scale Function for SOI and SIFS
 
         # Parameter obtained from PySOAR, written by Luciano Fraga
-        ccd_data = ccdproc.combine(
-            self.input_list, method='median', mem_limit=6.4e7, sigma_clip=True,
-            unit='adu', scale=scale_function
+        data = combine_files(
+            self.input_list, method='median', mem_limit=self.mem_limit,
+            sigma_clip=True, scale=scale_function
         )
 
-        data = ccd_data.data
-
         if self.output_filename is None:
 
             filter_name = header['FILTERS'].strip()
@@ -185,12 +358,14 @@ class FlatCombine(Combine):
                 '1NSFLAT{0:d}x{0:d}_{1:s}.fits'.format(
                     binning, filter_name)
 
-        pyfits.writeto(self.output_filename, data, header)
+        pyfits.writeto(self.output_filename, data, header, overwrite=True)
+        profiling.add_bytes_written(os.path.getsize(self.output_filename))
 
 
 class ZeroCombine(Combine):
 
-    def __init__(self, input_list, output_file=None, verbose=False, debug=False):
+    def __init__(self, input_list, output_file=None, verbose=False, debug=False,
+                 mem_limit=MEM_LIMIT):
         """
         Class created to help combining zero files.
 
@@ -204,10 +379,13 @@ class ZeroCombine(Combine):
 
             debug (bool) : Turn on debug mode? (default = False)
 
+            mem_limit (float) : Memory budget in bytes (default = MEM_LIMIT)
+
         """
         Combine.__init__(self, verbose=verbose, debug=debug)
         self.input_list = input_list
         self.output_filename = output_file
+        self.mem_limit = mem_limit
 
     def run(self):
 
@@ -222,18 +400,15 @@ class ZeroCombine(Combine):
         header = pyfits.getheader(self.input_list[0])
         bx, by = header['CCDSUM'].strip().split()
 
-        # Parameter obtained from PySOAR, written by Luciano Fraga
-        try:
-            master_bias = ccdproc.combine(
-                self.input_list, method='average', mem_limit=6.4e7,
-                minmax_clip=True, unit='adu')
-        except ZeroDivisionError:
-            raise RuntimeError('CCDProc.combine raised an error. '
-                               'Try again with a different number of input '
-                               'files')
+        # The highest and lowest value of each pixel are rejected, which
+        # removes the cosmic rays without biasing the average.
+        master_bias = combine_files(
+            self.input_list, method='average', mem_limit=self.mem_limit,
+            n_low=N_LOW, n_high=N_HIGH)
 
         if self.output_filename is None:
             self.output_filename = "0Zero{}x{}".format(bx, by)
 
         pyfits.writeto(
-            self.output_filename, master_bias.data, header)
+            self.output_filename, master_bias, header, overwrite=True)
+        profiling.add_bytes_written(os.path.getsize(self.output_filename))
@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Cosmic Rays
+
+    LACosmic decides if a pixel was hit by a cosmic ray using only the pixels
+    around it, so a frame can be cleaned in tiles. Each tile is extended by
+    `overlap` pixels at each side, cleaned with ccdproc's LACosmic and only
+    its central part is copied to the result. The tiles are cleaned by a pool
+    of threads: the filters of astroscrappy, used by ccdproc, release the
+    GIL. Each tile also needs less memory than the whole frame. Those filters
+    may also use OpenMP, so set OMP_NUM_THREADS to avoid running more threads
+    than CPUs.
+
+    With the default overlap, the tiled result is the same as the full frame
+    one except for the pixels whose whole neighbourhood was flagged as
+    cosmic rays. LACosmic replaces them by the median of the frame, which is
+    measured per tile here. Such pixels are rare, so the fraction of pixels
+    whose flag or value differ stays below TILED_TOLERANCE.
+
+    The 'fast' mode replaces LACosmic by a single pass median filter test,
+    meant for quicklook. The frame is reduced to blocks of FAST_BLOCK x
+    FAST_BLOCK pixels and only the pixels that stand out from the median of
+    their block are tested, using medians of the pixels around each of
+    them. A pixel is flagged when it is `sigclip` times the noise above the
+    5 x 5 median and `objlim` times sharper than the local structure (the
+    3 x 3 median minus the 7 x 7 median), which keeps the cores of the
+    stars. Its neighbours above `sigfrac * sigclip` are flagged too, and the
+    flagged pixels are replaced by their 5 x 5 median. On synthetic SAMI
+    frames it is 15 to 35 times faster than LACosmic and finds all the hits
+    brighter than 5 sigma, but misses most of the fainter ones.
+
+    The 'stack' mode is used on sequences of at least MIN_STACK exposures of
+    the same field. A cosmic ray hits a given piece of sky in only one of
+    them, so a pixel is flagged when it is `sigclip` times the noise above
+    the median of the aligned frames, after subtracting the sky of each
+    one. The noise of the sky is measured on each frame, the photon noise of
+    the sources is added using the `gain`, and so is a `scale` fraction of
+    their signal, to allow for residual misalignment and changes of seeing
+    and transparency. The
+    frames are aligned by whole pixels using their WCS and read in strips
+    of STACK_ROWS rows of the common grid, so the memory used does not
+    depend on the number of frames. Pixels covered by less than MIN_STACK
+    frames are not tested.
+"""
+
+import warnings
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as _np
+
+from astropy import wcs as _wcs
+from ccdproc import cosmicray_lacosmic as _cosmicray_lacosmic
+from scipy import ndimage
+
+from soar_simager.data_reduction import profiling
+from soar_simager.io import pyfits as _pyfits
+
+__author__ = 'Bruno Quint'
+
+__all__ = ['FAST_BLOCK', 'FAST_OPTIONS', 'LACOSMIC_OPTIONS', 'MIN_STACK',
+           'MODES', 'OVERLAP', 'STACK_OPTIONS', 'STACK_ROWS', 'TILE_SIZE',
+           'TILED_TOLERANCE', 'fast', 'get_offsets', 'get_tiles', 'lacosmic',
+           'reject_in_stack', 'stack']
+
+# Cosmic ray detectors that the reducers can use. 'stack' works on whole
+# sequences of frames (see reject_in_stack).
+MODES = ('lacosmic', 'fast', 'stack')
+
+# Options given to ccdproc.cosmicray_lacosmic by the reducers.
+LACOSMIC_OPTIONS = {
+    'gain': 2.6,
+    'readnoise': 10.0,
+    'sigclip': 2.5,
+    'sigfrac': 0.3,
+    'objlim': 5.0,
+}
+
+# Options of the fast detector. It has no Laplacian to reject the noise, so
+# it needs a higher threshold than LACosmic.
+FAST_OPTIONS = {
+    'gain': 2.6,
+    'readnoise': 10.0,
+    'sigclip': 5.0,
+    'sigfrac': 0.3,
+    'objlim': 5.0,
+}
+
+# Size of the blocks used by the fast detector to find candidate pixels.
+FAST_BLOCK = 4
+
+# Options of the stack detector.
+STACK_OPTIONS = {
+    'gain': 2.6,
+    'sigclip': 5.0,
+    'sigfrac': 0.3,
+    'scale': 0.25,
+}
+
+# Smallest number of frames compared by the stack detector.
+MIN_STACK = 3
+
+# Number of rows of the common grid read at once by reject_in_stack.
+STACK_ROWS = 256
+
+# Size of the tiles and number of pixels added at each of their sides.
+TILE_SIZE = 1024
+OVERLAP = 32
+
+# Largest fraction of the pixels that may differ between the tiled and the
+# full frame results.
+TILED_TOLERANCE = 1e-4
+
+
+def get_tiles(shape, tile_size=TILE_SIZE, overlap=OVERLAP):
+    """
+    Split a frame in tiles.
+
+    Args:
+
+        shape (tuple) : shape of the frame.
+
+        tile_size (int, optional) : size of the tiles, without the overlap
+        (default = TILE_SIZE).
+
+        overlap (int, optional) : number of pixels added at each side of the
+        tiles (default = OVERLAP).
+
+    Returns:
+
+        tiles (list) : one (outer, inner, center) tuple per tile. `outer` are
+        the slices of the frame cleaned, including the overlap, `inner` the
+        slices of the frame that receive the result and `center` the slices
+        of the tile copied to them.
+    """
+    def _split(n):
+        for start in range(0, n, tile_size):
+            stop = min(start + tile_size, n)
+            outer_start = max(start - overlap, 0)
+            outer_stop = min(stop + overlap, n)
+            yield (slice(outer_start, outer_stop), slice(start, stop),
+                   slice(start - outer_start, stop - outer_start))
+
+    return [((oy, ox), (iy, ix), (cy, cx))
+            for oy, iy, cy in _split(shape[0])
+            for ox, ix, cx in _split(shape[1])]
+
+
+def lacosmic(data, tile_size=None, overlap=OVERLAP, threads=1, **kwargs):
+    """
+    Clean the cosmic rays of a frame with ccdproc's LACosmic, optionally in
+    tiles.
+
+    Args:
+
+        data (numpy.ndarray) : 2D array with the frame.
+
+        tile_size (int, optional) : size of the tiles. The whole frame is
+        cleaned at once when it is None (default) or larger than the frame.
+
+        overlap (int, optional) : number of pixels added at each side of the
+        tiles (default = OVERLAP).
+
+        threads (int, optional) : number of tiles cleaned at the same time
+        (default = 1).
+
+        **kwargs : options given to ccdproc.cosmicray_lacosmic. They update
+        LACOSMIC_OPTIONS.
+
+    Returns:
+
+        cleaned (numpy.ndarray) : the frame without cosmic rays, as returned
+        by ccdproc.cosmicray_lacosmic.
+
+        mask (numpy.ndarray) : True on the pixels flagged as cosmic rays.
+    """
+    options = dict(LACOSMIC_OPTIONS, **kwargs)
+
+    if tile_size is None or (tile_size >= data.shape[0] and
+                             tile_size >= data.shape[1]):
+        cleaned, mask = _cosmicray_lacosmic(data, **options)
+        return _np.asarray(cleaned), _np.asarray(mask)
+
+    tiles = get_tiles(data.shape, tile_size=tile_size, overlap=overlap)
+
+    def _clean(tile):
+        outer, inner, center = tile
+        cleaned, mask = _cosmicray_lacosmic(data[outer], **options)
+        return _np.asarray(cleaned)[center], _np.asarray(mask)[center]
+
+    if threads is None or threads < 2:
+        results = [_clean(tile) for tile in tiles]
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(profiling.share_stages(_clean),
+                                        tiles))
+
+    cleaned = _np.empty(data.shape, dtype=results[0][0].dtype)
+    mask = _np.zeros(data.shape, dtype=bool)
+
+    for (outer, inner, center), (tile_cleaned, tile_mask) in \
+            zip(tiles, results):
+        cleaned[inner] = tile_cleaned
+        mask[inner] = tile_mask
+
+    return cleaned, mask
+
+
+def _candidates(data, block, sigclip, gain, readnoise):
+    """
+    Return the positions of the pixels that are `sigclip` times the noise
+    above the median of their block of `block` x `block` pixels.
+    """
+    ny, nx = data.shape
+    by, bx = -(-ny // block), -(-nx // block)
+
+    padded = _np.pad(data, ((0, by * block - ny), (0, bx * block - nx)),
+                     mode='edge').reshape(by, block, bx, block)
+
+    median = _np.median(padded.swapaxes(1, 2).reshape(by, bx, -1), axis=2)
+    noise = _np.sqrt(_np.maximum(median, 0) / gain + (readnoise / gain) ** 2)
+
+    excess = padded - median[:, _np.newaxis, :, _np.newaxis]
+    mask = excess > sigclip * noise[:, _np.newaxis, :, _np.newaxis]
+
+    y, x = _np.nonzero(mask.reshape(by * block, bx * block)[:ny, :nx])
+
+    return y, x
+
+
+def _median(padded, y, x, size, pad):
+    """Median of the size x size pixels around the positions (y, x)."""
+    half = size // 2
+    dy, dx = _np.mgrid[-half:half + 1, -half:half + 1]
+
+    values = padded[y[:, _np.newaxis] + dy.ravel() + pad,
+                    x[:, _np.newaxis] + dx.ravel() + pad]
+
+    return _np.median(values, axis=1)
+
+
+def fast(data, block=FAST_BLOCK, **kwargs):
+    """
+    Clean the cosmic rays of a frame with a single pass median filter test.
+    It is less thorough than LACosmic, but much faster.
+
+    Args:
+
+        data (numpy.ndarray) : 2D array with the frame, in ADU.
+
+        block (int, optional) : size of the blocks whose median is used to
+        find the candidate pixels (default = FAST_BLOCK).
+
+        **kwargs : gain, readnoise, sigclip, sigfrac and objlim. They update
+        FAST_OPTIONS.
+
+    Returns:
+
+        cleaned (numpy.ndarray) : the frame without cosmic rays, in ADU.
+
+        mask (numpy.ndarray) : True on the pixels flagged as cosmic rays.
+    """
+    options = dict(FAST_OPTIONS, **kwargs)
+
+    gain = options['gain']
+    readnoise = options['readnoise']
+    sigclip = options['sigclip']
+
+    data = _np.asarray(data)
+    if not _np.issubdtype(data.dtype, _np.floating):
+        data = data.astype(_np.float32)
+
+    ny, nx = data.shape
+    cleaned = data.copy()
+    mask = _np.zeros(data.shape, dtype=bool)
+
+    y, x = _candidates(data, block, sigclip, gain, readnoise)
+
+    if y.size == 0:
+        return cleaned, mask
+
+    pad = 3
+    padded = _np.pad(data, pad, mode='reflect')
+
+    def _test(y, x, threshold):
+        value = data[y, x]
+        m5 = _median(padded, y, x, 5, pad)
+        noise = _np.sqrt(_np.maximum(m5, 0) / gain + (readnoise / gain) ** 2)
+        return (value - m5) / noise > threshold, value, m5, noise
+
+    # Cosmic rays are much sharper than the local structure, stars are not.
+    significant, value, m5, noise = _test(y, x, sigclip)
+    y, x, value, m5, noise = \
+        y[significant], x[significant], value[significant], \
+        m5[significant], noise[significant]
+
+    m3 = _median(padded, y, x, 3, pad)
+    structure = _np.maximum(m3 - _median(padded, y, x, 7, pad), noise)
+    sharp = value - m3 > options['objlim'] * structure
+
+    y, x, m5 = y[sharp], x[sharp], m5[sharp]
+    mask[y, x] = True
+    cleaned[y, x] = m5
+
+    # Neighbours of the hits that are above sigfrac * sigclip.
+    dy, dx = _np.mgrid[-1:2, -1:2]
+    ny_, nx_ = (y[:, _np.newaxis] + dy.ravel()).ravel(), \
+        (x[:, _np.newaxis] + dx.ravel()).ravel()
+    inside = (ny_ >= 0) & (ny_ < ny) & (nx_ >= 0) & (nx_ < nx)
+    neighbours = _np.unique(ny_[inside] * nx + nx_[inside])
+    neighbours = neighbours[~mask.ravel()[neighbours]]
+
+    y, x = _np.divmod(neighbours, nx)
+    grow, _, m5, _ = _test(y, x, options['sigfrac'] * sigclip)
+
+    mask[y[grow], x[grow]] = True
+    cleaned[y[grow], x[grow]] = m5[grow]
+
+    return cleaned, mask
+
+
+def get_offsets(headers):
+    """
+    Find the offsets between frames of the same field using their WCS.
+
+    Args:
+
+        headers (list) : headers of the frames, with a celestial WCS.
+
+    Returns:
+
+        offsets (numpy.ndarray) : (dy, dx) whole pixel offsets of each frame.
+        The pixel (y, x) of the first frame sees the same sky as the pixel
+        (y + dy, x + dx) of the others.
+
+    Raises:
+
+        ValueError : if a header has no celestial WCS.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', _wcs.FITSFixedWarning)
+        frames_wcs = [_wcs.WCS(h).celestial for h in headers]
+
+    for w, h in zip(frames_wcs, headers):
+        if not w.has_celestial or not w.wcs.ctype[0]:
+            raise ValueError('Frame has no WCS: {}'.format(
+                h.get('FILENAME', h.get('OBJECT', ''))))
+
+    reference = frames_wcs[0].wcs.crpix - 1
+    sky = frames_wcs[0].pixel_to_world(*reference)
+
+    offsets = [_np.array(w.world_to_pixel(sky)) - reference
+               for w in frames_wcs]
+
+    return _np.rint(offsets).astype(int)[:, ::-1]
+
+
+def _sky(frame, stride=16):
+    """Return the sky level and noise of a frame from a strided sample."""
+    sample = _np.asarray(frame[::stride, ::stride], dtype=float)
+    sample = sample[_np.isfinite(sample)]
+
+    sky = _np.median(sample)
+    noise = 1.4826 * _np.median(_np.abs(sample - sky))
+
+    return float(sky), float(noise)
+
+
+def _sorted_median(stack):
+    """Median along the first axis of a stack with NaN on missing pixels."""
+    count = _np.count_nonzero(~_np.isnan(stack), axis=0)
+    ordered = _np.sort(stack, axis=0)
+
+    low = _np.take_along_axis(
+        ordered, _np.maximum(count - 1, 0)[_np.newaxis] // 2, axis=0)[0]
+    high = _np.take_along_axis(
+        ordered, (count // 2)[_np.newaxis], axis=0)[0]
+
+    return 0.5 * (low + high), count
+
+
+def stack(frames, offsets=None, rows=STACK_ROWS, **kwargs):
+    """
+    Clean the cosmic rays of a sequence of frames of the same field by
+    comparing each one with the median of the sequence.
+
+    Args:
+
+        frames (list) : 2D arrays with the same shape, in ADU. They are
+        cleaned in place, so they can be writable memory maps.
+
+        offsets (numpy.ndarray, optional) : (dy, dx) offsets of each frame,
+        as returned by get_offsets (default = the frames are aligned).
+
+        rows (int, optional) : number of rows compared at once (default =
+        STACK_ROWS).
+
+        **kwargs : gain, sigclip, sigfrac and scale. They update
+        STACK_OPTIONS.
+
+    Returns:
+
+        n_flagged (list) : number of pixels cleaned in each frame.
+
+    Raises:
+
+        ValueError : if there are less than MIN_STACK frames or if their
+        shapes differ.
+    """
+    options = dict(STACK_OPTIONS, **kwargs)
+
+    if len(frames) < MIN_STACK:
+        raise ValueError('At least {:d} frames are needed, got {:d}.'.format(
+            MIN_STACK, len(frames)))
+
+    ny, nx = frames[0].shape
+    if any(f.shape != (ny, nx) for f in frames):
+        raise ValueError('The frames must have the same shape.')
+
+    if offsets is None:
+        offsets = _np.zeros((len(frames), 2), dtype=int)
+
+    # Position of the first pixel of each frame in the common grid.
+    origins = offsets.max(axis=0) - offsets
+    height, width = origins.max(axis=0) + (ny, nx)
+
+    skies, sky_noises = zip(*[_sky(f) for f in frames])
+    n_flagged = [0] * len(frames)
+
+    gain = options['gain']
+    sigclip = options['sigclip']
+
+    for start in range(0, height, rows):
+
+        stop = min(start + rows, height)
+        values = _np.full((len(frames), stop - start, width), _np.nan,
+                          dtype=_np.float32)
+        parts = []
+
+        for j, (frame, (oy, ox), sky) in enumerate(
+                zip(frames, origins, skies)):
+
+            y0, y1 = max(start - oy, 0), min(stop - oy, ny)
+            if y0 >= y1:
+                parts.append(None)
+                continue
+
+            part = (slice(y0 + oy - start, y1 + oy - start),
+                    slice(ox, ox + nx))
+            values[j][part] = frame[y0:y1] - sky
+            parts.append((slice(y0, y1), part))
+
+        median, count = _sorted_median(values)
+        covered = count >= MIN_STACK
+
+        signal = _np.maximum(median, 0)
+
+        # The median of a few frames is noisy too.
+        median_noise = _np.sqrt(1 + _np.pi / (2 * _np.maximum(count, 1)))
+
+        for j, (frame, sky, sky_noise) in enumerate(
+                zip(frames, skies, sky_noises)):
+
+            if parts[j] is None:
+                continue
+
+            frame_rows, part = parts[j]
+
+            noise = median_noise * _np.sqrt(
+                sky_noise ** 2 + signal / gain +
+                (options['scale'] * signal) ** 2)
+            excess = (values[j] - median) / noise
+
+            mask = covered & (excess > sigclip)
+
+            # Neighbours of the hits above sigfrac * sigclip.
+            mask = covered & (
+                mask | (ndimage.binary_dilation(mask) &
+                        (excess > options['sigfrac'] * sigclip)))
+
+            mask = mask[part]
+            if mask.any():
+                frame[frame_rows][mask] = (median[part] + sky)[mask]
+                n_flagged[j] += int(_np.count_nonzero(mask))
+
+    return n_flagged
+
+
+def reject_in_stack(filenames, offsets=None, rows=STACK_ROWS, **kwargs):
+    """
+    Clean the cosmic rays of a sequence of reduced files of the same field,
+    rewriting them in place (see stack).
+
+    Args:
+
+        filenames (list) : reduced FITS files with the data in the primary
+        HDU.
+
+        offsets (numpy.ndarray, optional) : (dy, dx) offsets of each frame
+        (default = the offsets found by get_offsets).
+
+        rows (int, optional) : number of rows compared at once (default =
+        STACK_ROWS).
+
+        **kwargs : options of stack.
+
+    Returns:
+
+        n_flagged (list) : number of pixels cleaned in each file.
+    """
+    hduls = [_pyfits.open(f, mode='update', memmap=True) for f in filenames]
+
+    try:
+        if offsets is None:
+            offsets = get_offsets([hdul[0].header for hdul in hduls])
+
+        n_flagged = stack([hdul[0].data for hdul in hduls], offsets=offsets,
+                          rows=rows, **kwargs)
+
+        for hdul in hduls:
+            hdul[0].header.add_history(
+                'Cosmic rays removed comparing {:d} aligned frames'.format(
+                    len(hduls)))
+
+    finally:
+        for hdul in hduls:
+            hdul.close()
+
+    return n_flagged
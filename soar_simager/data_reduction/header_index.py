@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Header Index
+
+    Keeps the keywords used to organize the pipeline in a SQLite database
+    stored in the folder with the reduced data. Each raw file is keyed by its
+    path, size and modification time, so a raw file is only opened again if
+    it is new or if it changed since the last run. Files rejected by the data
+    quality check are also stored, with their flag, so they are not read
+    again either.
+
+    The database has an index on the columns used to group the frames, so it
+    can also be queried for the files with a given type, binning or filter
+    without loading the whole night. The index is only a cache: if it was
+    written with other FIELDS, it is emptied and built again.
+
+    The new entries are committed each time files are read, so a pipeline
+    that keeps running, like the watch mode, does not lose them if it is
+    killed.
+"""
+
+import os
+import sqlite3
+
+from soar_simager.data_reduction import night
+
+__author__ = 'Bruno Quint'
+
+INDEX_NAME = 'headers.sqlite'
+
+FIELDS = ['obstype', 'instrume', 'object', 'filters', 'filter1', 'filter2',
+          'binning']
+
+
+class HeaderIndex:
+    """
+    Persistent index with the header keywords of the raw files.
+
+    Parameters
+    ----------
+        path : str
+            Folder that contains the reduced data and the index.
+
+        filename : str
+            Name of the database file inside path.
+    """
+
+    def __init__(self, path, filename=INDEX_NAME):
+
+        self.filename = os.path.join(path, filename)
+        self._connection = sqlite3.connect(self.filename)
+
+        columns = [row[1] for row in self._connection.execute(
+            'PRAGMA table_info(files)')]
+
+        if columns and columns[5:] != FIELDS:
+            self._connection.execute('DROP TABLE files')
+
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' filename TEXT PRIMARY KEY,'
+            ' size INTEGER NOT NULL,'
+            ' mtime INTEGER NOT NULL,'
+            ' checked INTEGER NOT NULL,'
+            ' bad_data INTEGER NOT NULL,' +
+            ','.join(' {:s} TEXT'.format(f) for f in FIELDS) +
+            ')'
+        )
+
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS files_group '
+            'ON files (instrume, obstype, binning, filters)'
+        )
+
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def close(self):
+        """Write the pending changes and close the database."""
+        self._connection.commit()
+        self._connection.close()
+
+    def commit(self):
+        """Write the pending changes."""
+        self._connection.commit()
+
+    def get(self, filename, check_data=True):
+        """
+        Return the stored information of a raw file.
+
+        Args:
+
+            filename (str) : path to the raw file.
+
+            check_data (bool, optional) : only return entries whose data was
+            checked (default = True).
+
+        Returns:
+
+            info (dict) : the same dictionary returned by
+            night.read_file_info, or None if the file is not in the index or
+            if it changed.
+        """
+        stat = os.stat(filename)
+
+        row = self._connection.execute(
+            'SELECT size, mtime, checked, bad_data, {:s} FROM files '
+            'WHERE filename = ?'.format(', '.join(FIELDS)),
+            (os.path.abspath(filename),)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        size, mtime, checked, bad_data = row[:4]
+
+        if size != stat.st_size or mtime != stat.st_mtime_ns:
+            return None
+
+        if check_data and not checked:
+            return None
+
+        info = {'filename': filename}
+        info.update(zip(FIELDS, row[4:]))
+        info['bad_data'] = bool(bad_data) and check_data
+
+        return info
+
+    def put(self, info, check_data=True):
+        """
+        Store the information of a raw file.
+
+        Args:
+
+            info (dict) : dictionary returned by night.read_file_info.
+
+            check_data (bool, optional) : whether the data of the file was
+            checked (default = True).
+        """
+        stat = os.stat(info['filename'])
+
+        values = \
+            [os.path.abspath(info['filename']), stat.st_size,
+             stat.st_mtime_ns, int(check_data), int(info['bad_data'])] + \
+            [info[f] for f in FIELDS]
+
+        self._connection.execute(
+            'INSERT OR REPLACE INTO files VALUES ({:s})'.format(
+                ', '.join('?' * len(values))), values)
+
+    def query(self, **fields):
+        """
+        Return the raw files whose keywords match the given values, ignoring
+        the files flagged as bad data.
+
+        Args:
+
+            **fields : values of the columns in FIELDS, e.g.
+            query(obstype='ZERO', binning='4 4').
+
+        Returns:
+
+            list_of_files (list) : sorted list of absolute paths.
+        """
+        for key in fields:
+            if key not in FIELDS:
+                raise KeyError('Unknown field: {}'.format(key))
+
+        where = ''.join(' AND {:s} = ?'.format(key) for key in fields)
+
+        rows = self._connection.execute(
+            'SELECT filename FROM files WHERE bad_data = 0' + where +
+            ' ORDER BY filename', list(fields.values())
+        ).fetchall()
+
+        return [r[0] for r in rows]
+
+    def read_files_info(self, list_of_files, check_data=True,
+                        stride=night.DATA_STRIDE, threads=1):
+        """
+        Same as night.read_files_info, but only the files that are not in the
+        index or that changed are opened. The database is only accessed from
+        the calling thread. The new entries are committed before returning.
+        """
+        infos = []
+        missing = []
+
+        for i, filename in enumerate(list_of_files):
+
+            try:
+                info = self.get(filename, check_data=check_data)
+            except OSError:
+                info = None
+
+            if info is None:
+                missing.append(i)
+
+            infos.append(info)
+
+        new_infos = night.read_files_info(
+            [list_of_files[i] for i in missing], check_data=check_data,
+            stride=stride, threads=threads)
+
+        for i, info in zip(missing, new_infos):
+
+            if info is not None:
+                self.put(info, check_data=check_data)
+
+            infos[i] = info
+
+        if missing:
+            self.commit()
+
+        return infos
+
+    def read_file_info(self, filename, check_data=True,
+                       stride=night.DATA_STRIDE):
+        """
+        Same as night.read_file_info, but the raw file is only opened if it
+        is not in the index or if it changed. A new entry is committed
+        before returning.
+        """
+        info = self.get(filename, check_data=check_data)
+
+        if info is None:
+            info = night.read_file_info(
+                filename, check_data=check_data, stride=stride)
+            self.put(info, check_data=check_data)
+            self.commit()
+
+        return info
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Reduction Manifest
+
+    The manifest is a JSON file kept in the folder with the reduced data. For
+    each file written by the pipeline, it records the files used to create it
+    and the options of the reducer or of the combination. When the pipeline
+    runs again, a file is only processed again if it is missing or if any of
+    its dependencies changed.
+
+    Raw files are compared by size and modification time. Master calibration
+    files are also compared by the SHA1 of their content, so a master that is
+    written again with the same data does not force the reduction of all the
+    frames that use it.
+"""
+
+import hashlib
+import json
+import os
+
+from soar_simager.io.logging import get_logger
+
+__author__ = 'Bruno Quint'
+
+logger = get_logger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_checksum(filename, block_size=2 ** 20):
+    """
+    Return the SHA1 of the content of a file.
+
+    Args:
+
+        filename (str) : the file name.
+
+        block_size (int, optional) : number of bytes read at once.
+
+    Returns:
+
+        checksum (str) : hexadecimal digest.
+    """
+    sha1 = hashlib.sha1()
+
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def file_signature(filename, checksum=False):
+    """
+    Return a dictionary that identifies the current state of a file.
+
+    Args:
+
+        filename (str) : the file name.
+
+        checksum (bool, optional) : include the SHA1 of the content.
+
+    Returns:
+
+        signature (dict) : size, modification time and, optionally, the
+        checksum of the file.
+    """
+    stat = os.stat(filename)
+
+    signature = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+    }
+
+    if checksum:
+        signature['sha1'] = file_checksum(filename)
+
+    return signature
+
+
+class Manifest:
+    """
+    Keeps track of the dependencies of each file created by the pipeline.
+
+    Parameters
+    ----------
+        path : str
+            Folder that contains the reduced data and the manifest.
+
+        filename : str
+            Name of the manifest file inside path.
+    """
+
+    def __init__(self, path, filename=MANIFEST_NAME):
+
+        self.filename = os.path.join(path, filename)
+        self.entries = {}
+
+        # Checksums of the master files already read, keyed by their
+        # signature, so each master is read once per run.
+        self._checksums = {}
+
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logger.warning(
+                    'Ignoring corrupted manifest: {}'.format(self.filename))
+
+    def forget(self, output_file):
+        """Remove the record of a file so it is processed again."""
+        self.entries.pop(os.path.abspath(output_file), None)
+
+    def is_current(self, output_file, inputs, options, masters=()):
+        """
+        Check if a file exists and was created from the same inputs, masters
+        and options.
+
+        Args:
+
+            output_file (str) : file created by the pipeline.
+
+            inputs (list) : raw or reduced files used to create it.
+
+            options (dict) : options used to create it.
+
+            masters (list, optional) : master calibration files used.
+
+        Returns:
+
+            current (bool) : False if the file has to be processed again.
+        """
+        output_file = os.path.abspath(output_file)
+        entry = self.entries.get(output_file)
+
+        if entry is None or not os.path.exists(output_file):
+            return False
+
+        if entry['options'] != options:
+            return False
+
+        if entry['output'] != file_signature(output_file):
+            return False
+
+        inputs = [os.path.abspath(f) for f in inputs]
+        masters = [os.path.abspath(f) for f in masters if f]
+
+        if sorted(entry['inputs']) != sorted(inputs):
+            return False
+
+        if sorted(entry['masters']) != sorted(masters):
+            return False
+
+        for f in inputs:
+            if not os.path.exists(f):
+                return False
+            if file_signature(f) != entry['inputs'][f]:
+                return False
+
+        for f in masters:
+            if not os.path.exists(f):
+                return False
+
+            recorded = entry['masters'][f]
+            signature = file_signature(f)
+
+            if signature['size'] == recorded['size'] and \
+                    signature['mtime'] == recorded['mtime']:
+                continue
+
+            # The master was written again. Check if its content changed.
+            if self.checksum(f) != recorded['sha1']:
+                return False
+
+            recorded.update(signature)
+
+        return True
+
+    def record(self, output_file, inputs, options, masters=()):
+        """
+        Record how a file was created. Must be called after the file was
+        written.
+
+        Args:
+
+            output_file (str) : file created by the pipeline.
+
+            inputs (list) : raw or reduced files used to create it.
+
+            options (dict) : options used to create it. Must be JSON
+            serializable.
+
+            masters (list, optional) : master calibration files used.
+        """
+        output_file = os.path.abspath(output_file)
+
+        self.entries[output_file] = {
+            'output': file_signature(output_file),
+            'options': options,
+            'inputs': {
+                os.path.abspath(f): file_signature(f) for f in inputs},
+            'masters': {
+                os.path.abspath(f):
+                    dict(file_signature(f), sha1=self.checksum(f))
+                for f in masters if f},
+        }
+
+    def checksum(self, filename):
+        """Return the SHA1 of a file, reading it only if it changed."""
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+        if key not in self._checksums:
+            self._checksums[key] = file_checksum(filename)
+
+        return self._checksums[key]
+
+    def outdated(self, tasks, log=None):
+        """
+        Return the reduction tasks whose output is missing or was created
+        from different inputs, masters or options.
+
+        Args:
+
+            tasks (list) : list of (reducer, input_file, output_file, label)
+            tuples, as used by parallel.reduce_files.
+
+            log (logging.Logger, optional) : logger used to report the files
+            skipped.
+
+        Returns:
+
+            outdated_tasks (list) : the tasks that have to run.
+        """
+        outdated_tasks = []
+
+        for task in tasks:
+
+            reducer, input_file, output_file, label = task
+
+            if self.is_current(output_file, [input_file],
+                               reducer.get_options(),
+                               masters=reducer.get_master_files()):
+                if log is not None:
+                    log.debug('Skipping up-to-date {:s} file: {:s}'.format(
+                        label, output_file))
+                continue
+
+            outdated_tasks.append(task)
+
+        return outdated_tasks
+
+    def record_tasks(self, tasks):
+        """
+        Record the reduction tasks that were just executed.
+
+        Args:
+
+            tasks (list) : list of (reducer, input_file, output_file, label)
+            tuples, as used by parallel.reduce_files.
+        """
+        for reducer, input_file, output_file, label in tasks:
+            self.record(output_file, [input_file], reducer.get_options(),
+                        masters=reducer.get_master_files())
+
+    def save(self):
+        """Write the manifest to disk."""
+        temp_filename = self.filename + '.tmp'
+
+        with open(temp_filename, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+
+        os.replace(temp_filename, self.filename)
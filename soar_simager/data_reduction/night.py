@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Night Table
+
+    Helpers used to index the raw files of an observing night before the data
+    reduction starts. Only the header blocks of the primary HDU and of the
+    first extension are parsed, using the minimal card reader in
+    soar_simager.io.cards, with astropy as a fallback. The data of the first
+    extension is accessed through a memory map and only a strided sample of
+    it is used to reject empty frames, so the pixels of most of the file are
+    never read from disk.
+
+    On network file systems, reading a header is dominated by the latency of
+    each request, so the files can be read by a pool of threads. The results
+    keep the order of the input list.
+
+    The night table is built at once from the collected records. The columns
+    used to group the frames are stored as categoricals, so comparing them
+    against a binning or a filter compares small integer codes instead of
+    strings.
+"""
+
+import numpy as _np
+import pandas as _pd
+
+from concurrent.futures import ThreadPoolExecutor
+
+from soar_simager.data_reduction import profiling
+from soar_simager.io import cards as _cards
+from soar_simager.io import pyfits as _pyfits
+from soar_simager.io.logging import get_logger
+
+__author__ = 'Bruno Quint'
+
+logger = get_logger(__name__)
+
+# Only one every DATA_STRIDE rows and columns are used to check the data.
+DATA_STRIDE = 16
+
+# Keywords read from the primary header and from the first extension.
+PRIMARY_KEYWORDS = ['OBSTYPE', 'INSTRUME', 'OBJECT', 'FILTERS', 'FILTER1',
+                    'FILTER2']
+EXTENSION_KEYWORDS = ['CCDSUM']
+
+# Data type of each column of the night table.
+TABLE_SCHEMA = {
+    'filename': object,
+    'instrume': 'category',
+    'obstype': 'category',
+    'object': 'category',
+    'filters': 'category',
+    'filter1': 'category',
+    'filter2': 'category',
+    'binning': 'category',
+    'bad_pixel_file': object,
+    'dark_file': object,
+    'flat_file': object,
+    'zero_file': object,
+}
+
+
+def build_dataframe(records, columns):
+    """
+    Create the night table from a list of records.
+
+    Args:
+
+        records (list) : list of dictionaries, one for each file.
+
+        columns (list) : columns of the table. Each of them must be in
+        TABLE_SCHEMA.
+
+    Returns:
+
+        table (pandas.DataFrame) : the night table with the types given in
+        TABLE_SCHEMA.
+    """
+    table = _pd.DataFrame.from_records(records, columns=columns)
+
+    return set_schema(table)
+
+
+def set_schema(table):
+    """
+    Cast the columns of a night table to the types given in TABLE_SCHEMA.
+    Used again after concatenating tables, which turns categoricals with
+    different categories into plain objects.
+
+    Args:
+
+        table (pandas.DataFrame) : the night table.
+
+    Returns:
+
+        table (pandas.DataFrame) : the night table with the expected types.
+    """
+    schema = {c: TABLE_SCHEMA[c] for c in table.columns if c in TABLE_SCHEMA}
+
+    return table.astype(schema)
+
+
+def has_valid_data(data, stride=DATA_STRIDE):
+    """
+    Check if a frame contains any signal by looking at a strided sample of it.
+    Saturated or empty frames have a standard deviation equal to zero.
+
+    Args:
+
+        data (numpy.ndarray) : 2D array (or memory map) with the raw data.
+
+        stride (int, optional) : step used to sample rows and columns. A
+        stride of 1 uses the whole frame (default = DATA_STRIDE).
+
+    Returns:
+
+        valid (bool) : False if the sampled data has no variation at all.
+    """
+    if data is None:
+        return False
+
+    sample = data[::stride, ::stride]
+
+    return bool(_np.std(sample) != 0)
+
+
+def read_file_info(filename, check_data=True, stride=DATA_STRIDE):
+    """
+    Read the keywords needed to organize the pipeline from a raw file.
+
+    Args:
+
+        filename (str) : path to a raw multi-extension FITS file.
+
+        check_data (bool, optional) : check a strided sample of the first
+        extension for empty or saturated data (default = True). If False, the
+        pixels are never touched.
+
+        stride (int, optional) : step used to sample the data.
+
+    Returns:
+
+        info (dict) : the keywords used in the night table plus a 'bad_data'
+        flag.
+
+    Raises:
+
+        OSError : if the file cannot be read.
+    """
+    try:
+        (h0, _), (h1, data_offset) = _cards.read_headers(
+            filename, [PRIMARY_KEYWORDS, EXTENSION_KEYWORDS])
+
+        info = _make_info(filename, h0, h1)
+
+        if check_data:
+            data = _cards.map_data(filename, h1, data_offset)
+            info['bad_data'] = not has_valid_data(data, stride=stride)
+
+        return info
+
+    except _cards.CardParseError as error:
+        logger.debug('Reading {:s} with astropy: {}'.format(filename, error))
+
+    with _pyfits.open(filename, memmap=True,
+                      do_not_scale_image_data=True) as hdul:
+
+        info = _make_info(filename, hdul[0].header, hdul[1].header)
+
+        if check_data:
+            info['bad_data'] = not has_valid_data(hdul[1].data, stride=stride)
+
+    return info
+
+
+def _make_info(filename, h0, h1):
+    """Return the night table record from the two headers."""
+    info = {
+        'filename': filename,
+        'obstype': h0['OBSTYPE'],
+        'instrume': h0['INSTRUME'].strip().upper(),
+        'object': str(h0.get('OBJECT', '')).strip(),
+        'filters': h0['FILTERS'],
+        'filter1': h0['FILTER1'],
+        'filter2': h0['FILTER2'],
+        'binning': h1['CCDSUM'].strip(),
+        'bad_data': False,
+    }
+
+    return info
+
+
+def read_files_info(list_of_files, check_data=True, stride=DATA_STRIDE,
+                    threads=1):
+    """
+    Read the keywords needed to organize the pipeline from many raw files,
+    optionally using a pool of threads.
+
+    Args:
+
+        list_of_files (list) : paths to raw multi-extension FITS files.
+
+        check_data (bool, optional) : check a strided sample of the first
+        extension for empty or saturated data (default = True).
+
+        stride (int, optional) : step used to sample the data.
+
+        threads (int, optional) : number of files read at the same time
+        (default = 1).
+
+    Returns:
+
+        infos (list) : the dictionaries returned by read_file_info, in the
+        same order as list_of_files. Files that cannot be read are None.
+    """
+    def _read(filename):
+        try:
+            return read_file_info(
+                filename, check_data=check_data, stride=stride)
+        except OSError:
+            return None
+
+    if threads is None or threads < 2 or len(list_of_files) < 2:
+        return [_read(f) for f in list_of_files]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        infos = list(executor.map(profiling.share_stages(_read),
+                                  list_of_files))
+
+    return infos
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Parallel Reduction
+
+    Once the master calibration files exist, every raw frame can be reduced
+    independently. The functions here dispatch the per-frame reductions to a
+    pool of processes. The output filenames are decided by the caller before
+    dispatching, so the results do not depend on the number of workers or on
+    the order in which the frames are finished.
+"""
+
+import functools
+import multiprocessing
+import os
+import numpy as _np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from soar_simager.data_reduction import profiling
+from soar_simager.data_reduction.buffers import frame_pool
+from soar_simager.io import pyfits as _pyfits
+from soar_simager.io.logging import get_logger
+
+__author__ = 'Bruno Quint'
+
+
+def get_worker_logger(logger_name, level):
+    """
+    Return a logger whose name carries the name of the current process, so
+    messages coming from different workers can be told apart.
+
+    Args:
+
+        logger_name (str) : name of the pipeline logger (e.g. 'samidr').
+
+        level (int or str) : logging level used by the pipeline logger.
+
+    Returns:
+
+        _log (logging.Logger) : the logger used inside the worker.
+    """
+    process_name = multiprocessing.current_process().name
+
+    _log = get_logger('{:s}.{:s}'.format(logger_name, process_name))
+    _log.propagate = False
+    _log.setLevel(level)
+
+    return _log
+
+
+def reduce_file(reducer, input_file, output_file, label='', log=None,
+                profiler=None, writer=None):
+    """
+    Reduce a single raw file and write the result to disk.
+
+    Args:
+
+        reducer (soar_simager.data_reduction.reduce.Reducer) : reducer already
+        configured with the master files and options for this frame.
+
+        input_file (str) : raw file to be reduced.
+
+        output_file (str) : where the reduced frame will be written.
+
+        label (str, optional) : frame type used in the log messages.
+
+        log (logging.Logger, optional) : logger used to report the progress.
+
+        profiler (soar_simager.data_reduction.profiling.Profiler, optional) :
+        records the steps of the reduction and the writing of the frame.
+
+        writer (soar_simager.data_reduction.writer.FrameWriter, optional) :
+        writes the frame in the background. The file is only complete once
+        the writer is flushed (default = write it before returning).
+
+    Returns:
+
+        output_file (str) : the file written.
+    """
+    if log is not None:
+        log.info('Processing {:s} file: {:s}'.format(label, input_file))
+
+    if profiler is None:
+        profiler = getattr(reducer, 'profiler', profiling.NULL_PROFILER)
+    else:
+        reducer.profiler = profiler
+
+    data, header, prefix = reducer.reduce(input_file)
+
+    # The next frame with the same shape reuses the buffer once written.
+    release = functools.partial(frame_pool.release, data)
+
+    if writer is not None:
+        writer.submit(output_file, data, header, source=input_file,
+                      profiler=profiler, callback=release)
+        return output_file
+
+    with profiler.stage('write', input_file):
+        _pyfits.writeto(output_file, _np.asarray(data), header=header,
+                        overwrite=True)
+        profiling.add_bytes_written(os.path.getsize(output_file))
+
+    release()
+
+    return output_file
+
+
+def _reduce_file_in_worker(reducer, input_file, output_file, label,
+                           logger_name, level, trace_memory=None):
+
+    log = get_worker_logger(logger_name, level)
+
+    # The records are sent back to the profiler of the main process.
+    profiler = None
+    if trace_memory is not None:
+        profiler = profiling.Profiler(trace_memory=trace_memory)
+
+    output_file = reduce_file(reducer, input_file, output_file, label=label,
+                              log=log, profiler=profiler)
+
+    if profiler is not None:
+        profiler.stop()
+        return output_file, profiler.records
+
+    return output_file, []
+
+
+def reduce_files(tasks, jobs=1, log=None, profiler=None, writer=None):
+    """
+    Reduce a list of independent frames, either serially or using a pool of
+    processes.
+
+    Args:
+
+        tasks (list) : list of (reducer, input_file, output_file, label)
+        tuples. Each task must carry its own reducer instance.
+
+        jobs (int, optional) : number of processes used. Values smaller than
+        two reduce the frames in the current process (default = 1).
+
+        log (logging.Logger, optional) : pipeline logger. Workers use a child
+        logger with the same level.
+
+        profiler (soar_simager.data_reduction.profiling.Profiler, optional) :
+        records the steps of each frame. The records of the workers are
+        added to it in the main process, so its hooks do not need to be
+        picklable.
+
+        writer (soar_simager.data_reduction.writer.FrameWriter, optional) :
+        writes each frame in the background while the next one is reduced.
+        It is flushed before returning, so all the files are complete. Only
+        used when the frames are reduced in the current process, since the
+        workers already write at the same time.
+
+    Returns:
+
+        output_files (list) : the files written, in the same order as tasks.
+    """
+    if jobs is None or jobs < 2 or len(tasks) < 2:
+
+        output_files = [
+            reduce_file(r, i, o, label=l, log=log, profiler=profiler,
+                        writer=writer)
+            for r, i, o, l in tasks
+        ]
+
+        if writer is not None:
+            writer.flush()
+
+        return output_files
+
+    logger_name = log.name if log is not None else __name__
+    level = log.getEffectiveLevel() if log is not None else 'INFO'
+    trace_memory = profiler.trace_memory if profiler is not None else None
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+
+        futures = [
+            executor.submit(
+                _reduce_file_in_worker, r, i, o, l, logger_name, level,
+                trace_memory)
+            for r, i, o, l in tasks
+        ]
+
+        output_files = []
+
+        for future in futures:
+
+            output_file, records = future.result()
+            output_files.append(output_file)
+
+            if profiler is not None:
+                profiler.extend(records)
+
+    return output_files
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Profiling
+
+    Records where the time goes while a night is reduced. Each step of the
+    reducers (merge, zero, dark, cosmic rays, glow, flat, time, clean, WCS),
+    the writing of each frame and each master combine runs inside a stage of
+    a Profiler. A stage records its wall time, CPU time, the bytes of FITS
+    data read and written, and, optionally, the peak memory allocated by
+    numpy arrays. Every record is passed to the hooks registered in the
+    Profiler, and the records can be summarised per stage at the end.
+
+    Most of the raw and master files are memory-mapped, so the operating
+    system counters do not see their reads. The code that reads or writes
+    data reports the number of bytes with add_bytes_read and
+    add_bytes_written, which are cheap no-ops when nothing is being
+    profiled. These counters belong to the thread that runs the stage.
+
+    The CPU time of a stage is the one of its own thread, so the frames
+    written in the background at the same time are not included. Helper
+    threads working for a stage, like the tiles cleaned by LACosmic, run
+    their functions through share_stages to add their CPU time and bytes
+    to it. tracemalloc can only follow the whole process, so the peak
+    memory is only recorded for the stages of the main thread, and the
+    FrameWriter writes in the main thread while memory is traced. The wall
+    time of each stage is its own, but the sum of the wall times can be
+    longer than the reduction.
+"""
+
+import collections
+import contextlib
+import functools
+import threading
+import time
+import tracemalloc
+
+__author__ = 'Bruno Quint'
+
+__all__ = ['NULL_PROFILER', 'Profiler', 'StageRecord', 'add_bytes_read',
+           'add_bytes_written', 'share_stages']
+
+StageRecord = collections.namedtuple(
+    'StageRecord', ['stage', 'filename', 'wall_time', 'cpu_time',
+                    'bytes_read', 'bytes_written', 'peak_memory'])
+
+# Stages running in each thread. Bytes read and written are added to them.
+_active = threading.local()
+
+# Protects the counters of the stages shared with helper threads.
+_counters_lock = threading.Lock()
+
+
+def _active_stages():
+    if not hasattr(_active, 'stages'):
+        _active.stages = []
+    return _active.stages
+
+
+def _add(key, value):
+    """Add a value to a counter of the stages of the current thread."""
+    stages = _active_stages()
+
+    if stages:
+        with _counters_lock:
+            for stage in stages:
+                stage[key] += value
+
+
+def add_bytes_read(nbytes):
+    """Add bytes read to the stages running in the current thread."""
+    _add('bytes_read', int(nbytes))
+
+
+def add_bytes_written(nbytes):
+    """Add bytes written to the stages running in the current thread."""
+    _add('bytes_written', int(nbytes))
+
+
+def share_stages(function):
+    """
+    Wrap a function that will run in helper threads, e.g. the ones of a
+    ThreadPoolExecutor, so that its CPU time and the bytes it reads and
+    writes are added to the stages running now in the current thread.
+
+    Args:
+
+        function (callable) : function called by the helper threads.
+
+    Returns:
+
+        wrapper (callable) : function to give to the helper threads. It is
+        the function itself when no stage is running.
+    """
+    stages = list(_active_stages())
+    owner = threading.get_ident()
+
+    if not stages:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+
+        # The stages already count the CPU time of their own thread.
+        if threading.get_ident() == owner:
+            return function(*args, **kwargs)
+
+        _active_stages().extend(stages)
+        cpu_start = time.thread_time()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _add('cpu_time', time.thread_time() - cpu_start)
+            del _active_stages()[-len(stages):]
+
+    return wrapper
+
+
+def _format_bytes(nbytes):
+    """Return a human readable number of bytes."""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(nbytes) < 1024. or unit == 'GB':
+            break
+        nbytes /= 1024.
+
+    return '{:.1f} {:s}'.format(nbytes, unit)
+
+
+class Profiler:
+    """
+    Collect the time, I/O and memory used by each stage of the reduction.
+
+    Parameters
+    ----------
+        trace_memory : bool
+            Use tracemalloc to record the peak memory allocated in each stage.
+            It slows down the code that allocates many small Python objects.
+            Stages must not be nested when memory is traced. Only the stages
+            of the main thread record their peak memory, which includes the
+            helper threads running at the same time.
+
+        hooks : list
+            Functions called with each StageRecord as soon as the stage ends.
+    """
+
+    def __init__(self, trace_memory=False, hooks=None):
+
+        self.trace_memory = trace_memory
+        self.hooks = list(hooks or [])
+        self.records = []
+
+        self._lock = threading.Lock()
+        self._tracing = False
+
+    def add_hook(self, hook):
+        """Register a function that is called with each StageRecord."""
+        self.hooks.append(hook)
+
+    def add(self, record):
+        """
+        Store a record and pass it to the hooks. Also used to collect the
+        records of the stages that ran in other processes.
+        """
+        with self._lock:
+            self.records.append(record)
+
+        for hook in self.hooks:
+            hook(record)
+
+    def extend(self, records):
+        """Store a list of records. See Profiler.add."""
+        for record in records:
+            self.add(record)
+
+    @contextlib.contextmanager
+    def stage(self, name, filename=None):
+        """
+        Context manager that records one stage.
+
+        Args:
+
+            name (str) : name of the stage (e.g. 'merge' or 'zero').
+
+            filename (str, optional) : frame or master file being processed.
+        """
+        counters = {'bytes_read': 0, 'bytes_written': 0, 'cpu_time': 0.}
+        stages = _active_stages()
+        stages.append(counters)
+
+        # Resetting the peak in another thread would corrupt the stage
+        # running in the main thread.
+        trace_memory = self.trace_memory and \
+            threading.current_thread() is threading.main_thread()
+
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            memory_start = tracemalloc.get_traced_memory()[0]
+            # Python < 3.9 cannot reset the peak, so it is only an upper
+            # bound there.
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+
+        try:
+            yield
+        finally:
+
+            wall_time = time.perf_counter() - wall_start
+
+            peak_memory = None
+            if trace_memory:
+                peak_memory = max(
+                    0, tracemalloc.get_traced_memory()[1] - memory_start)
+
+            stages.remove(counters)
+
+            with _counters_lock:
+                cpu_time = time.thread_time() - cpu_start + \
+                    counters['cpu_time']
+
+            self.add(StageRecord(
+                name, filename, wall_time, cpu_time, counters['bytes_read'],
+                counters['bytes_written'], peak_memory))
+
+    def stop(self):
+        """Stop tracing memory if it was started by this profiler."""
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def summary(self):
+        """
+        Aggregate the records by stage.
+
+        Returns:
+
+            summary (list) : one dictionary per stage, sorted by the total
+            wall time, with the number of calls, total wall and CPU times,
+            total bytes read and written, and the largest peak memory.
+        """
+        stages = collections.OrderedDict()
+
+        with self._lock:
+            records = list(self.records)
+
+        for r in records:
+
+            s = stages.setdefault(r.stage, {
+                'stage': r.stage, 'calls': 0, 'wall_time': 0.,
+                'cpu_time': 0., 'bytes_read': 0, 'bytes_written': 0,
+                'peak_memory': None})
+
+            s['calls'] += 1
+            s['wall_time'] += r.wall_time
+            s['cpu_time'] += r.cpu_time
+            s['bytes_read'] += r.bytes_read
+            s['bytes_written'] += r.bytes_written
+
+            if r.peak_memory is not None:
+                s['peak_memory'] = max(s['peak_memory'] or 0, r.peak_memory)
+
+        return sorted(stages.values(), key=lambda s: s['wall_time'],
+                      reverse=True)
+
+    def format_summary(self):
+        """Return the summary as a list of lines of a text table."""
+        summary = self.summary()
+        total = sum(s['wall_time'] for s in summary) or 1.
+
+        lines = ['{:16s} {:>6s} {:>10s} {:>6s} {:>10s} {:>10s} {:>10s} '
+                 '{:>10s}'.format('Stage', 'Calls', 'Wall (s)', '%',
+                                  'CPU (s)', 'Read', 'Written', 'Peak')]
+
+        for s in summary:
+
+            peak = '-' if s['peak_memory'] is None else \
+                _format_bytes(s['peak_memory'])
+
+            lines.append(
+                '{:16s} {:6d} {:10.2f} {:6.1f} {:10.2f} {:>10s} {:>10s} '
+                '{:>10s}'.format(
+                    s['stage'], s['calls'], s['wall_time'],
+                    100. * s['wall_time'] / total, s['cpu_time'],
+                    _format_bytes(s['bytes_read']),
+                    _format_bytes(s['bytes_written']), peak))
+
+        return lines
+
+    def log_summary(self, log):
+        """
+        Log the summary, slowest stage first, and stop tracing memory.
+
+        Args:
+
+            log (logging.Logger) : pipeline logger.
+        """
+        log.info('Time spent in each step:')
+
+        for line in self.format_summary():
+            log.info(line)
+
+        self.stop()
+
+
+class _NullProfiler:
+    """Profiler that records nothing. Used when profiling is off."""
+
+    trace_memory = None
+
+    def add(self, record):
+        pass
+
+    def extend(self, records):
+        pass
+
+    def log_summary(self, log):
+        pass
+
+    @contextlib.contextmanager
+    def stage(self, name, filename=None):
+        yield
+
+
+NULL_PROFILER = _NullProfiler()
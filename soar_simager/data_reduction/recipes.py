@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Reduction Recipes
+
+    A recipe says which optional steps of a Reducer run for one instrument
+    and frame type (e.g. cosmic ray removal on SAMI OBJECT frames only).
+    The default recipes are stored in `soar_simager/data/recipes.json`.
+    A user file with the same layout can change some of them: the steps
+    that it does not mention keep their default value.
+
+        {
+          "version": 1,
+          "SAM": {"OBJECT": {"cosmic_rays": false}}
+        }
+
+    The steps are attributes of the Reducer, so they are also recorded in
+    the manifest and changing a recipe reduces the affected frames again.
+    Besides true and false, `cosmic_rays` can name the detector used
+    (see cosmic_rays.MODES).
+"""
+
+import copy
+import functools
+import json
+import os
+
+from soar_simager.data_reduction import cosmic_rays as _cosmic_rays
+
+__author__ = 'Bruno Quint'
+
+__all__ = ['RECIPES_VERSION', 'STEPS', 'apply_recipe', 'get_recipe',
+           'load_recipes']
+
+RECIPES_VERSION = 1
+
+RECIPES_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'data', 'recipes.json')
+
+# Reducer attributes that a recipe can switch on and off.
+STEPS = ('clean', 'cosmic_rays', 'time')
+
+# Keys of a recipes file that are not instruments.
+_METADATA = ('version', 'comment')
+
+
+def _read(filename):
+    """
+    Read and check a recipes file.
+
+    Raises:
+
+        ValueError : if the file was written by a newer version or if a
+        recipe has unknown steps or values that are not booleans (or a
+        cosmic ray mode).
+    """
+    with open(filename) as f:
+        content = json.load(f)
+
+    if content.get('version', RECIPES_VERSION) > RECIPES_VERSION:
+        raise ValueError(
+            'Recipes file {:s} has version {} but only versions up to {:d} '
+            'are supported.'.format(filename, content['version'],
+                                    RECIPES_VERSION))
+
+    recipes = {}
+
+    for instrument, obstypes in content.items():
+
+        if instrument in _METADATA:
+            continue
+
+        for obstype, recipe in obstypes.items():
+
+            unknown = set(recipe) - set(STEPS)
+            if unknown:
+                raise ValueError(
+                    'Unknown steps in the {:s} {:s} recipe of {:s}: {:s}. '
+                    'Use one of: {:s}.'.format(
+                        instrument, obstype, filename,
+                        ', '.join(sorted(unknown)), ', '.join(STEPS)))
+
+            for step, value in recipe.items():
+                if step == 'cosmic_rays' and value in _cosmic_rays.MODES:
+                    continue
+                if not isinstance(value, bool):
+                    raise ValueError(
+                        'Step {:s} of the {:s} {:s} recipe of {:s} must be '
+                        'true or false.'.format(step, instrument, obstype,
+                                                filename))
+
+            recipes.setdefault(instrument.upper(), {})[obstype.upper()] = \
+                dict(recipe)
+
+    return recipes
+
+
+@functools.lru_cache()
+def _default_recipes():
+    return _read(RECIPES_FILE)
+
+
+def load_recipes(filename=None, cosmic_ray_mode=None):
+    """
+    Load the default recipes, updated by the ones in a user file.
+
+    Args:
+
+        filename (str, optional) : JSON file with the recipes that change
+        the default ones (default = use the default recipes only).
+
+        cosmic_ray_mode (str, optional) : detector used by the recipes that
+        clean the cosmic rays, one of cosmic_rays.MODES (default = the one
+        in the recipes). 'stack' only applies to OBJECT frames, the other
+        frames keep their detector.
+
+    Returns:
+
+        recipes (dict) : one dictionary of steps per instrument and OBSTYPE.
+    """
+    recipes = copy.deepcopy(_default_recipes())
+
+    if filename:
+        for instrument, obstypes in _read(filename).items():
+            for obstype, recipe in obstypes.items():
+                recipes.setdefault(instrument, {}).setdefault(
+                    obstype, {}).update(recipe)
+
+    if cosmic_ray_mode:
+
+        if cosmic_ray_mode not in _cosmic_rays.MODES:
+            raise ValueError(
+                'Unknown cosmic ray mode: {}. Use one of: {:s}.'.format(
+                    cosmic_ray_mode, ', '.join(_cosmic_rays.MODES)))
+
+        for obstypes in recipes.values():
+            for obstype, recipe in obstypes.items():
+                if cosmic_ray_mode == 'stack' and obstype != 'OBJECT':
+                    continue
+                if recipe.get('cosmic_rays'):
+                    recipe['cosmic_rays'] = cosmic_ray_mode
+
+    return recipes
+
+
+def get_recipe(instrument, obstype, recipes=None):
+    """
+    Return the steps used to reduce one kind of frame.
+
+    Args:
+
+        instrument (str) : 'SAM', 'SOI' or 'SIFS'.
+
+        obstype (str) : 'ZERO', 'DARK', 'FLAT' or 'OBJECT'. SFLAT and DFLAT
+        use the FLAT recipe unless they have their own.
+
+        recipes (dict, optional) : recipes returned by load_recipes
+        (default = the default recipes).
+
+    Returns:
+
+        recipe (dict) : True or False for each of the STEPS, or the
+        detector for cosmic_rays. Steps that the recipe does not mention are
+        False.
+
+    Raises:
+
+        ValueError : if there is no recipe for this instrument and OBSTYPE.
+    """
+    if recipes is None:
+        recipes = _default_recipes()
+
+    instrument = instrument.strip().upper()
+    obstype = obstype.strip().upper()
+
+    obstypes = recipes.get(instrument, {})
+
+    if obstype not in obstypes and obstype in ('SFLAT', 'DFLAT'):
+        obstype = 'FLAT'
+
+    if obstype not in obstypes:
+        raise ValueError('There is no recipe for {:s} {:s} frames.'.format(
+            instrument, obstype))
+
+    recipe = dict.fromkeys(STEPS, False)
+    recipe.update(obstypes[obstype])
+
+    return recipe
+
+
+def apply_recipe(reducer, recipe):
+    """
+    Switch the steps of a Reducer on or off following a recipe.
+
+    Args:
+
+        reducer (soar_simager.data_reduction.reduce.Reducer) : the reducer
+        that is changed in place.
+
+        recipe (dict) : steps returned by get_recipe.
+
+    Returns:
+
+        reducer (soar_simager.data_reduction.reduce.Reducer) : the same
+        reducer.
+    """
+    for step in STEPS:
+        setattr(reducer, step, recipe.get(step, False))
+
+    return reducer
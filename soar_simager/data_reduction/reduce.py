@@ -22,7 +22,6 @@
 
     Todo
     ----
-    - Use multithread or multiprocessing to run this script faster.
     - Use astropy.ccdproc to reduce the data.
 
     Bruno Quint (bquint at ctio.noao.edu)
@@ -34,19 +33,26 @@
 
 import numpy as _np
 
-from ccdproc import cosmicray_lacosmic as _cosmicray_lacosmic
 from scipy import stats
 
 from astropy import wcs
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 
+from soar_simager.data_reduction import bad_pixels, profiling
+from soar_simager.data_reduction import cosmic_rays as _cosmic_rays
+from soar_simager.data_reduction.buffers import frame_pool
+from soar_simager.data_reduction.cache import calibration_cache
 from soar_simager.io import pyfits as _pyfits
 from soar_simager.io.logging import get_logger
 from soar_simager.tools import slices
 
 logger = get_logger(__name__)
 
+# Number of rows corrected at once by Reducer.calibrate. The block and the
+# same rows of the master files stay in the CPU cache.
+CALIBRATION_ROWS = 16
+
 
 # Piece of code from cosmics.py
 # We define the laplacian kernel to be used
@@ -73,13 +79,31 @@ class Reducer:
         zero_file : str
             The filename of the master zero that will be used in subtraction.
 
+        bad_pixel_file : str
+            Bad pixel map derived from the masters of the night (see
+            bad_pixels.derive_bad_pixel_map). When it is not set, the known
+            bad pixel map of the instrument is used.
+
         clean : bool
             Clean bad collumns by taking the _median value of the pixels around
             them.
 
-        cosmic_rays : bool
+        cosmic_rays : bool or str
             Clean cosmic rays using LACosmic package. See noted bellow for
-            reference.
+            reference. Use 'fast' for the quicker median filter detector of
+            soar_simager.data_reduction.cosmic_rays. 'stack' leaves the
+            frames untouched: they are cleaned later, comparing the frames
+            of the same field (see cosmic_rays.reject_in_stack).
+
+        cosmic_ray_threads : int
+            Number of tiles cleaned at the same time by LACosmic. Using more
+            than one thread splits the frames in tiles of
+            cosmic_rays.TILE_SIZE pixels if cosmic_ray_tile_size is not set.
+
+        cosmic_ray_tile_size : int
+            Clean the cosmic rays in tiles of this size. See
+            soar_simager.data_reduction.cosmic_rays for the differences to
+            the full frame cleaning.
 
         dark_file : str
             Master Dark's filename to be used for dark subtraction.
@@ -87,6 +111,12 @@ class Reducer:
         debug : bool
             Turn on debug mode with lots of printing.
 
+        dtype : str or numpy.dtype
+            Data type used for the merged frame and all the following steps.
+            Using 'float32' halves the memory used and the size of the
+            output files. The difference to the 'float64' results is of the
+            order of the float32 precision (relative 1e-6).
+
         flat_file : str
             Master Flat filename to be used for normalization.
 
@@ -109,6 +139,15 @@ class Reducer:
         read_noise : list
             A list containing the read noise on each simager amplifier.
 
+        instrument : str
+            Instrument whose bad pixel maps are used to clean the data (see
+            soar_simager.data_reduction.bad_pixels). No cleaning is done when
+            it is None.
+
+        profiler : soar_simager.data_reduction.profiling.Profiler
+            Records the time, I/O and memory used by each step of reduce.
+            Profiling is off by default.
+
     See also
     --------
         LACosmic - http://www.astro.yale.edu/dokkum/lacosmic/
@@ -116,11 +155,14 @@ class Reducer:
 
     gain = [2.6, 2.6, 2.6, 2.6]
     read_noise = [10., 10., 10., 10.]
+    instrument = None
+    profiler = profiling.NULL_PROFILER
 
     def __init__(self, clean=False, cosmic_rays=False, dark_file=None,
                  debug=False, flat_file=None, glow_file=None, merge=False,
                  overscan=False, norm_flat=False, time=False, verbose=False,
-                 zero_file=None):
+                 zero_file=None, dtype='float64', bad_pixel_file=None,
+                 cosmic_ray_threads=1, cosmic_ray_tile_size=None):
 
         logger.setLevel("ERROR")
 
@@ -130,9 +172,13 @@ class Reducer:
         if debug:
             logger.setLevel("DEBUG")
 
+        self.bad_pixel_file = bad_pixel_file
         self.clean = clean
         self.cosmic_rays = cosmic_rays
+        self.cosmic_ray_threads = cosmic_ray_threads
+        self.cosmic_ray_tile_size = cosmic_ray_tile_size
         self.dark_file = dark_file
+        self.dtype = _np.dtype(dtype)
         self.flat_file = flat_file
         self.glow_file = glow_file
         self._merge = merge
@@ -145,53 +191,68 @@ class Reducer:
 
     def reduce(self, hdu_list, prefix=""):
 
+        # Raw files given by name are memory-mapped and only the windows
+        # needed by merge are read.
+        if isinstance(hdu_list, str):
+            with open_raw(hdu_list) as hdul:
+                return self.reduce(hdul, prefix=prefix)
+
         # If the number of extensions is just 1, then the file is already
         # processed.
         if len(hdu_list) == 1:
             return hdu_list, ''
 
+        filename = hdu_list.filename()
+
         # Merge file
-        data, header, prefix = self.merge(hdu_list)
+        with self.profiler.stage('merge', filename):
+            data, header, prefix = self.merge(hdu_list)
 
-        # Correct ZERO
-        data, header, prefix = self.correct_zero(
-            data, header, prefix, self.zero_file
-        )
+        # Correct ZERO and DARK, and also FLAT and EXPOSURE TIME when no
+        # step in between changes the frame
+        fused = self.get_calibration_fused()
 
-        # Correct DARK
-        data, header, prefix = self.correct_dark(
-            data, header, prefix, self.dark_file
-        )
+        with self.profiler.stage('calibrate', filename):
+            data, header, prefix = self.calibrate(
+                data, header, prefix, zero_file=self.zero_file,
+                dark_file=self.dark_file,
+                flat_file=self.flat_file if fused else None,
+                time=self.time if fused else False
+            )
 
         # Remove cosmic rays and hot pixels
-        data, header, prefix = self.remove_cosmic_rays(
-            data, header, prefix, self.cosmic_rays
-        )
+        with self.profiler.stage('cosmic_rays', filename):
+            data, header, prefix = self.remove_cosmic_rays(
+                data, header, prefix, self.cosmic_rays,
+                tile_size=self.get_cosmic_ray_tile_size(),
+                threads=self.cosmic_ray_threads
+            )
 
         # Remove lateral glows
-        data, header, prefix = self.correct_lateral_glow(
-            data, header, prefix, self.glow_file
-        )
-
-        # Correct FLAT
-        data, header, prefix = self.correct_flat(
-            data, header, prefix, self.flat_file
-        )
-
-        # Normalize by the EXPOSURE TIME
-        data, header, prefix = self.divide_by_exposuretime(
-            data, header, prefix, self.time
-        )
+        with self.profiler.stage('glow', filename):
+            data, header, prefix = self.correct_lateral_glow(
+                data, header, prefix, self.glow_file
+            )
+
+        # Correct FLAT and normalize by the EXPOSURE TIME
+        if not fused:
+            with self.profiler.stage('calibrate', filename):
+                data, header, prefix = self.calibrate(
+                    data, header, prefix, flat_file=self.flat_file,
+                    time=self.time
+                )
 
         # Clean known bad columns and lines
-        data, header, prefix = self.clean_hot_columns_and_lines(
-            data, header, prefix, self.clean
-        )
+        with self.profiler.stage('clean', filename):
+            data, header, prefix = self.clean_hot_columns_and_lines(
+                data, header, prefix, self.clean
+            )
 
         # Add WCS
-        data, header = self.create_wcs(
-            data, header
-        )
+        with self.profiler.stage('wcs', filename):
+            data, header = self.create_wcs(
+                data, header
+            )
 
         return data, header, prefix
 
@@ -291,6 +352,8 @@ class Reducer:
     def clean_column(_data, x0, y0, yf, n=5):
         """
         Substitutes a single column by the _median of the neighbours columns.
+        Reducer.clean_bad_pixels cleans all the known columns and lines at
+        once.
 
         Args:
 
@@ -332,21 +395,25 @@ class Reducer:
     def clean_columns(self, data, header):
         """
         Clean the known bad columns that exists in most of SAMI's, SOI's or
-        SIFS's data. This method is meant to be overwritten via inheritance.
+        SIFS's data using the bad pixel map of the instrument.
 
         Args:
 
             data (numpy.ndarray) : A 2D numpy array that contains the data.
 
-            header (astropy.io.fits.Header) : A header that will be updated.
+            header (astropy.io.fits.Header) : A header that contains the
+            binning information on the 'CCDSUM' key. It will be updated.
+
+        Returns:
+
+            data (numpy.ndarray) : Processed 2D numpy array.
 
         See also:
 
-            Reducer.clean_column
-            Reducer.clean_line
+            Reducer.clean_bad_pixels
             Reducer.clean_lines
         """
-        return data, header
+        return self.clean_bad_pixels(data, header, lines=False)
 
     @staticmethod
     def clean_line(_data, x0, xf, y, n=5):
@@ -388,25 +455,109 @@ class Reducer:
     def clean_lines(self, data, header):
         """
         Clean the known bad lines that exists in most of SAMI's, SOI's or
-        SIFS's data. This method is meant to be overwritten via inheritance.
+        SIFS's data using the bad pixel map of the instrument.
 
         Args:
 
             data (numpy.ndarray) : A 2D numpy array that contains the data.
 
-            header (astropy.io.fits.Header) : A header that will be updated.
+            header (astropy.io.fits.Header) : A header that contains the
+            binning information on the 'CCDSUM' key. It will be updated.
+
+        Returns:
+
+            data (numpy.ndarray) : Processed 2D numpy array.
 
         See also:
 
-            Reducer.clean_column
-            Reducer.clean_line
-            Reducer.clean_lines
+            Reducer.clean_bad_pixels
+            Reducer.clean_columns
         """
-        return data, header
+        return self.clean_bad_pixels(data, header, columns=False)
+
+    def get_bad_pixel_map(self, header):
+        """
+        Return the bad pixel map for the binning of a frame: the map in
+        bad_pixel_file, if it is set, or the known map of the instrument.
+
+        Args:
+
+            header (astropy.io.fits.Header) : A header that contains the
+            binning information on the 'CCDSUM' key.
+
+        Returns:
+
+            bad_pixel_map (soar_simager.data_reduction.bad_pixels.BadPixelMap)
+            : None if there is no map for this instrument and binning.
+        """
+        if self.bad_pixel_file:
+            return bad_pixels.read_bad_pixel_map(self.bad_pixel_file)
+
+        if self.instrument is None:
+            return None
+
+        binning = int(header['CCDSUM'].strip().split()[0])
+        bad_pixel_map = bad_pixels.get_bad_pixel_map(self.instrument, binning)
+
+        if bad_pixel_map is None:
+            logger.warning(
+                'No bad pixel map for {:s} with binning {:d} x {:d}'.format(
+                    self.instrument, binning, binning))
+
+        return bad_pixel_map
+
+    def clean_bad_pixels(self, data, header, columns=True, lines=True):
+        """
+        Replace the known bad columns and lines by the median of their
+        neighbours in a single pass and add HISTORY to header.
+
+        Args:
+
+            data (numpy.ndarray) : A 2D numpy array that contains the data.
+
+            header (astropy.io.fits.Header) : A header that contains the
+            binning information on the 'CCDSUM' key. It will be updated.
+
+            columns (bool, optional) : Clean the bad columns.
+
+            lines (bool, optional) : Clean the bad lines.
+
+        Returns:
+
+            data (numpy.ndarray) : Processed 2D numpy array.
+
+        See also:
+
+            soar_simager.data_reduction.bad_pixels.BadPixelMap.repair
+        """
+        bad_pixel_map = self.get_bad_pixel_map(header)
+
+        if bad_pixel_map is None:
+            return data
+
+        if data.shape != bad_pixel_map.shape:
+            logger.warning(
+                'Skipping the bad pixel map {:s}: it expects frames with shape'
+                ' {} but found {}'.format(
+                    bad_pixel_map.name, bad_pixel_map.shape, data.shape))
+            return data
+
+        data = bad_pixel_map.repair(data, columns=columns, lines=lines)
+
+        if columns and lines:
+            cleaned = 'columns and lines'
+        else:
+            cleaned = 'columns' if columns else 'lines'
+
+        header.add_history('Cleaned bad {:s} using {:s} v{:d}.'.format(
+            cleaned, bad_pixel_map.name, bad_pixel_map.version))
+
+        return data
 
     def clean_hot_columns_and_lines(self, data, header, prefix, clean):
         """
-        Clean known hot columns and lines from SAMI's images.
+        Clean known hot columns and lines from SAMI's, SOI's or SIFS's
+        images.
 
         Args:
 
@@ -420,20 +571,108 @@ class Reducer:
 
         See also:
 
-            Reducer.clean_column
-            Reducer.clean_columns
-            Reducer.clean_line
-            Reducer.clean_lines
+            Reducer.clean_bad_pixels
         """
         if clean is True:
 
-            data = self.clean_columns(data, header)
-            data = self.clean_lines(data, header)
-            header.add_history('Cleaned bad columns and lines.')
+            data = self.clean_bad_pixels(data, header)
             prefix = 'c' + prefix
 
         return data, header, prefix
 
+    @staticmethod
+    def calibrate(data, header, prefix, zero_file=None, dark_file=None,
+                  flat_file=None, time=False, rows=None):
+        """
+        Subtract the ZERO and the DARK, divide by the FLAT and by the
+        exposure time in a single pass over the frame. The frame is corrected
+        in place, in blocks of rows that stay in the CPU cache together with
+        the same rows of the master files. The results, the header and the
+        prefix are the same as applying correct_zero, correct_dark,
+        correct_flat and divide_by_exposuretime one after the other.
+
+        Args:
+
+            data (numpy.ndarray) : A 2D float array that contains the data.
+            It is changed in place.
+
+            header (astropy.io.fits.Header) : A header that will be updated.
+
+            prefix (str) : File prefix that is added after each reduce.
+
+            zero_file (str, optional) : Master Bias filename.
+
+            dark_file (str, optional) : Master Dark filename.
+
+            flat_file (str, optional) : Master Flat filename.
+
+            time (bool, optional) : Divide the image by the exposure time?
+
+            rows (int, optional) : Number of rows corrected at once (default
+            = CALIBRATION_ROWS).
+        """
+        if not isinstance(prefix, str):
+            raise (TypeError, 'Expected string but found %s instead.' %
+                   prefix.__class__)
+
+        if rows is None:
+            rows = CALIBRATION_ROWS
+
+        if not (data.flags.writeable and
+                _np.issubdtype(data.dtype, _np.floating)):
+            data = _np.array(data, dtype=_np.result_type(data, _np.float32))
+
+        zero = dark = flat = None
+        exptime = None
+
+        if zero_file is not None:
+            zero = calibration_cache.get_zero(zero_file, dtype=data.dtype)
+            header['BIASFILE'] = zero_file
+            prefix = 'z' + prefix
+
+        if dark_file is not None:
+            dark = calibration_cache.get_dark(dark_file, dtype=data.dtype)
+            dark_time = header['EXPTIME']
+            header['DARKFILE'] = dark_file
+            prefix = 'd' + prefix
+
+        if flat_file is not None:
+            flat = calibration_cache.get_flat(flat_file, dtype=data.dtype)
+            header['FLATFILE'] = flat_file
+            prefix = 'f' + prefix
+
+        if time is True:
+            header['UNITS'] = 'adu / s'
+            if 'EXPTIME' in header:
+                exptime = float(header['EXPTIME'])
+            prefix = 't' + prefix
+
+        if zero is None and dark is None and flat is None and exptime is None:
+            return data, header, prefix
+
+        scratch = _np.empty((min(rows, data.shape[0]),) + data.shape[1:],
+                            dtype=data.dtype) if dark is not None else None
+
+        for start in range(0, data.shape[0], rows):
+
+            block = data[start:start + rows]
+
+            if zero is not None:
+                block -= zero[start:start + rows]
+
+            if dark is not None:
+                temp = scratch[:block.shape[0]]
+                _np.multiply(dark[start:start + rows], dark_time, out=temp)
+                block -= temp
+
+            if flat is not None:
+                block /= flat[start:start + rows]
+
+            if exptime is not None:
+                block /= exptime
+
+        return data, header, prefix
+
     @staticmethod
     def correct_dark(data, header, prefix, dark_file=None):
         """
@@ -449,7 +688,9 @@ class Reducer:
                 File prefix that is added after each reduce.
 
             dark_file: str | None
-                Master Dark filename. If None is given, nothing is done.
+                Master Dark filename. If None is given, nothing is done. The
+                master dark, already divided by its exposure time, is kept in
+                memory and reused by the next frames.
         """
 
         if not isinstance(prefix, str):
@@ -458,10 +699,9 @@ class Reducer:
 
         if dark_file is not None:
 
-            dark = _pyfits.open(dark_file)[0]
-            dark.data = dark.data / float(dark.header['EXPTIME'])
+            dark = calibration_cache.get_dark(dark_file, dtype=data.dtype)
 
-            data = data - dark.data * header['EXPTIME']
+            data = data - dark * header['EXPTIME']
             header['DARKFILE'] = dark_file
             prefix = 'd' + prefix
 
@@ -488,9 +728,9 @@ class Reducer:
                    prefix.__class__)
 
         if flat_file is not None:
-            flat = _pyfits.open(flat_file)[0]
+            flat = calibration_cache.get_flat(flat_file, dtype=data.dtype)
 
-            data /= flat.data
+            data /= flat
             header['FLATFILE'] = flat_file
             prefix = 'f' + prefix
 
@@ -531,9 +771,8 @@ class Reducer:
             midpt2 = regions[1][min_std_region]
             diff = midpt2 - midpt1
 
-            dark = _pyfits.getdata(glow_file)
-            dark = self.clean_columns(dark)
-            dark = self.clean_lines(dark)
+            dark, dark_header = _pyfits.getdata(glow_file, header=True)
+            dark = self.clean_bad_pixels(dark, dark_header)
 
             dark_regions = [
                 [_np.median(dark[539:589, 6:56]),  # Top Left
@@ -575,12 +814,10 @@ class Reducer:
             nothing is done.
 
         """
-        from os.path import abspath
-
         if zero_file is not None:
 
-            zero = _pyfits.open(abspath(zero_file))[0]
-            data = data - zero.data
+            zero = calibration_cache.get_zero(zero_file, dtype=data.dtype)
+            data = data - zero
             header['BIASFILE'] = zero_file
             prefix = 'z' + prefix
 
@@ -701,16 +938,123 @@ class Reducer:
 
         return prefix
 
+    def get_calibration_fused(self):
+        """
+        Tell if the FLAT and the exposure time are applied in the same pass
+        over the frame as the ZERO and the DARK (see calibrate).
+
+        Returns
+        -------
+            fused : bool
+                False if the cosmic rays or the lateral glow are removed
+                from each frame, since they come in between.
+        """
+        return self.glow_file is None and \
+            self.get_cosmic_ray_mode() in (None, 'stack')
+
+    def get_cosmic_ray_mode(self):
+        """
+        Return the detector used to clean the cosmic rays.
+
+        Returns
+        -------
+            mode : str
+                'lacosmic', 'fast', 'stack' or None if the cosmic rays are
+                not cleaned.
+        """
+        if not self.cosmic_rays:
+            return None
+
+        if self.cosmic_rays is True:
+            return 'lacosmic'
+
+        return self.cosmic_rays
+
+    def get_cosmic_ray_tile_size(self):
+        """
+        Return the size of the tiles used to clean the cosmic rays.
+
+        Returns
+        -------
+            tile_size : int
+                None if the whole frame is cleaned at once.
+        """
+        if self.cosmic_ray_tile_size:
+            return self.cosmic_ray_tile_size
+
+        if self.cosmic_ray_threads and self.cosmic_ray_threads > 1:
+            return _cosmic_rays.TILE_SIZE
+
+        return None
+
+    def get_master_files(self):
+        """
+        Return the master calibration files used by this reducer.
+
+        Returns
+        -------
+            master_files : list
+                The ZERO, DARK, FLAT and GLOW files and the bad pixel map
+                that are set.
+        """
+        master_files = [self.zero_file, self.dark_file, self.flat_file,
+                        self.glow_file, self.bad_pixel_file]
+
+        return [f for f in master_files if f]
+
+    def get_options(self):
+        """
+        Return the options that change the result of the reduction. They are
+        stored in the manifest of the reduced data.
+
+        Returns
+        -------
+            options : dict
+                A JSON serializable dictionary with the reducer options.
+        """
+        # LACosmic is stored as True, as before the fast mode existed.
+        cosmic_rays = self.get_cosmic_ray_mode()
+        if cosmic_rays not in ('fast', 'stack'):
+            cosmic_rays = cosmic_rays is not None
+
+        options = {
+            'reducer': self.__class__.__name__,
+            'clean': bool(self.clean),
+            'cosmic_rays': cosmic_rays,
+            'dark_file': self.dark_file,
+            'dtype': self.dtype.name,
+            'flat_file': self.flat_file,
+            'glow_file': self.glow_file,
+            'norm_flat': bool(self.norm_flat),
+            'time': bool(self.time),
+            'zero_file': self.zero_file,
+        }
+
+        # Only stored when set, so the frames cleaned at once are not
+        # reduced again.
+        tile_size = self.get_cosmic_ray_tile_size()
+        if self.get_cosmic_ray_mode() == 'lacosmic' and tile_size:
+            options['cosmic_ray_tile_size'] = tile_size
+
+        return options
+
     def merge(self,  hdul):
         """
         Open a FITS image and try to join its extensions in a single array.
+        Only the TRIMSEC and BIASSEC windows of each extension are read and
+        the result is written straight into the merged frame.
 
         Args:
 
-            hdul (astropy.io.fits.HDUList) : an HDUList that contains one
-            PrimaryHDU and four ImageHDU
+            hdul (str or astropy.io.fits.HDUList) : an HDUList that contains
+            one PrimaryHDU and four ImageHDU, or the name of a file that
+            contains it.
 
         """
+        if isinstance(hdul, str):
+            with open_raw(hdul) as _hdul:
+                return self.merge(_hdul)
+
         w, h = slices.iraf2python(hdul[1].header['DETSIZE'])
 
         if len(hdul) is 1:
@@ -723,39 +1067,52 @@ class Reducer:
                              dtype=int)
         bw, bh = w[1] // bin_size[0], h[1] // bin_size[1]
 
-        # Create empty full frame
-        new_data = _np.empty((bh, bw), dtype=float)
+        # Take an empty full frame from the pool. It is given back once the
+        # reduced frame is written (see parallel.reduce_file).
+        new_data = frame_pool.get((bh, bw), dtype=self.dtype)
 
-        # Process each extension
+        # Collect the data and the overscan of each extension
+        trims = []
+        regions = []
+        biases = []
+        scalings = []
         for i in range(1, 5):
             tx, ty = slices.iraf2python(hdul[i].header['TRIMSEC'])
             bx, by = slices.iraf2python(hdul[i].header['BIASSEC'])
 
             data = hdul[i].data
-            trim = data[ty[0]:ty[1], tx[0]:tx[1]]
+            bscale, bzero = get_scaling(hdul[i])
+
+            trims.append(data[ty[0]:ty[1], tx[0]:tx[1]])
+            scalings.append((bscale, bzero))
             bias = data[by[0]:by[1], bx[0]:bx[1]]
+            profiling.add_bytes_read(trims[-1].nbytes + bias.nbytes)
 
             # Collapse the bias columns to a single column.
-            bias = _np.median(bias, axis=1)
+            biases.append(_np.median(bias, axis=1) * bscale + bzero)
 
-            # Fit and remove OVERSCAN
-            x = _np.arange(bias.size) + 1
-            bias_fit_pars = _np.polyfit(x, bias, 2)  # Last par = inf
-            bias_fit = _np.polyval(bias_fit_pars, x)
-            bias_fit = bias_fit.reshape((bias_fit.size, 1))
-            bias_fit = _np.repeat(bias_fit, trim.shape[1], axis=1)
-
-            trim = trim - bias_fit
             dx, dy = slices.iraf2python(hdul[i].header['DETSEC'])
             dx, dy = dx // bin_size[0], dy // bin_size[1]
-            new_data[dy[0]:dy[1], dx[0]:dx[1]] = trim
+            regions.append((slice(dy[0], dy[1]), slice(dx[0], dx[1])))
+
+        # Fit the OVERSCAN of all the amplifiers at once
+        bias_fits = fit_overscan(biases, 2)
+
+        # Remove the OVERSCAN writing straight into the full frame
+        for trim, (bscale, bzero), bias_fit, region in zip(
+                trims, scalings, bias_fits, regions):
+
+            new_trim = new_data[region]
+            _np.multiply(trim, bscale, out=new_trim)
+            new_trim -= (bias_fit - bzero)[:, _np.newaxis]
 
         header = self.get_header(hdul)
 
         return new_data, header, "m_"
 
     @staticmethod
-    def remove_cosmic_rays(data, header, prefix, cosmic_rays):
+    def remove_cosmic_rays(data, header, prefix, cosmic_rays, tile_size=None,
+                           threads=1):
         """
         Use LACosmic to remove cosmic rays.
 
@@ -768,22 +1125,47 @@ class Reducer:
             prefix : str
                 Filename prefix to flag images that were clean.
 
-            cosmic_rays : bool
+            cosmic_rays : bool or str
                 Flag to indicate if cosmic rays removal should be performed.
+                'fast' uses cosmic_rays.fast instead of LACosmic. 'stack'
+                does nothing: it is applied to whole sequences by
+                cosmic_rays.reject_in_stack.
+
+            tile_size (int, optional) : Clean the frame in tiles of this size
+            (see soar_simager.data_reduction.cosmic_rays.lacosmic). By
+            default, the whole frame is cleaned at once.
+
+            threads (int, optional) : Number of tiles cleaned at the same
+            time (default = 1).
         """
-        if cosmic_rays:
+        if cosmic_rays and cosmic_rays not in (True,) + _cosmic_rays.MODES:
+            raise ValueError(
+                'Unknown cosmic ray mode: {}. Use one of: {:s}.'.format(
+                    cosmic_rays, ', '.join(_cosmic_rays.MODES)))
+
+        if cosmic_rays == 'stack':
+            pass
+
+        elif cosmic_rays == 'fast':
+
+            d, _ = _cosmic_rays.fast(data)
+            data[...] = d
+
+            header.add_history(
+                'Cosmic rays and hot pixels removed using a median filter')
+
+        elif cosmic_rays:
 
-            d = data
-            d, _ = _cosmicray_lacosmic(
-                d, gain=2.6, readnoise=10.0, sigclip=2.5, sigfrac=0.3,
-                objlim=5.0)
-            d /= 2.6
+            # The result is copied back, so the frame keeps its buffer.
+            d, _ = _cosmic_rays.lacosmic(data, tile_size=tile_size,
+                                         threads=threads)
+            data[...] = d
+            data /= 2.6
 
             h = header
             h.add_history(
                 'Cosmic rays and hot pixels removed using LACosmic')
 
-            data = d
             header = h
 
         return data, header, prefix
@@ -798,169 +1180,81 @@ class SamiReducer(Reducer):
 
     gain = [2.1, 2.0537, 2.1, 2.0823]
     read_noise = [10., 10., 10., 10.]
-    
+    instrument = 'SAM'
+
     def reduce(self, hdu_list, prefix=""):
 
+        # Raw files given by name are memory-mapped and only the windows
+        # needed by merge are read.
+        if isinstance(hdu_list, str):
+            with open_raw(hdu_list) as hdul:
+                return self.reduce(hdul, prefix=prefix)
+
         # If the number of extensions is just 1, then the file is already
         # processed.
         if len(hdu_list) == 1:
             return hdu_list, ''
 
+        filename = hdu_list.filename()
+
         # Merge file
-        data, header, prefix = self.merge(hdu_list)
+        with self.profiler.stage('merge', filename):
+            data, header, prefix = self.merge(hdu_list)
 
         # Removing bad column and line
-        data, header, prefix = self.remove_central_bad_columns(
-            data, header, prefix,
-        )
-
-        # Correct ZERO
-        data, header, prefix = self.correct_zero(
-            data, header, prefix, self.zero_file
-        )
-
-        # Correct DARK
-        data, header, prefix = self.correct_dark(
-            data, header, prefix, self.dark_file
-        )
+        with self.profiler.stage('central_columns', filename):
+            data, header, prefix = self.remove_central_bad_columns(
+                data, header, prefix,
+            )
+
+        # Correct ZERO and DARK, and also FLAT and EXPOSURE TIME when no
+        # step in between changes the frame
+        fused = self.get_calibration_fused()
+
+        with self.profiler.stage('calibrate', filename):
+            data, header, prefix = self.calibrate(
+                data, header, prefix, zero_file=self.zero_file,
+                dark_file=self.dark_file,
+                flat_file=self.flat_file if fused else None,
+                time=self.time if fused else False
+            )
 
         # Remove cosmic rays and hot pixels
-        data, header, prefix = self.remove_cosmic_rays(
-            data, header, prefix, self.cosmic_rays
-        )
+        with self.profiler.stage('cosmic_rays', filename):
+            data, header, prefix = self.remove_cosmic_rays(
+                data, header, prefix, self.cosmic_rays,
+                tile_size=self.get_cosmic_ray_tile_size(),
+                threads=self.cosmic_ray_threads
+            )
 
         # Remove lateral glows
-        data, header, prefix = self.correct_lateral_glow(
-            data, header, prefix, self.glow_file
-        )
-
-        # Correct FLAT
-        data, header, prefix = self.correct_flat(
-            data, header, prefix, self.flat_file
-        )
-
-        # Normalize by the EXPOSURE TIME
-        data, header, prefix = self.divide_by_exposuretime(
-            data, header, prefix, self.time
-        )
+        with self.profiler.stage('glow', filename):
+            data, header, prefix = self.correct_lateral_glow(
+                data, header, prefix, self.glow_file
+            )
+
+        # Correct FLAT and normalize by the EXPOSURE TIME
+        if not fused:
+            with self.profiler.stage('calibrate', filename):
+                data, header, prefix = self.calibrate(
+                    data, header, prefix, flat_file=self.flat_file,
+                    time=self.time
+                )
 
         # Clean known bad columns and lines
-        data, header, prefix = self.clean_hot_columns_and_lines(
-            data, header, prefix, self.clean
-        )
+        with self.profiler.stage('clean', filename):
+            data, header, prefix = self.clean_hot_columns_and_lines(
+                data, header, prefix, self.clean
+            )
 
         # Add WCS
-        data, header = self.create_wcs(
-            data, header
-        )
+        with self.profiler.stage('wcs', filename):
+            data, header = self.create_wcs(
+                data, header
+            )
 
         return data, header, prefix
 
-    def clean_columns(self, data, header):
-        """
-        Clean the known bad columns that exists in most of SAMI's, SOI's or
-        SIFS's data. This method is meant to be overwritten via inheritance.
-
-        Args:
-
-            data (numpy.ndarray) : A 2D numpy array that contains the data.
-
-            header (astropy.io.fits.Header) : A header that will be updated.
-
-        See also:
-
-            Reducer.clean_column
-            Reducer.clean_line
-            Reducer.clean_lines
-        """
-        binning = header['CCDSUM'].split(' ')[0]
-        binning = int(binning.strip())
-
-        if binning == 4:
-            bad_columns = [
-                [167, 0, 513],
-                [213, 513, 1023],
-                [304, 0, 513],
-                [309, 1, 512],
-                [386, 0, 513],
-                [476, 0, 513],
-                [602, 0, 513],
-                [671, 0, 513],
-                [673, 475, 513],
-                [678, 0, 513],
-                [741, 0, 513],
-                [810, 0, 513],
-                [919, 0, 513],
-                [212, 513, 1023],
-                [680, 513, 1023],
-                [725, 513, 1023],
-                [848, 513, 1023],
-                [948, 0, 512],
-                [949, 0, 512]
-                ]
-        else:
-            []
-
-        for column in bad_columns:
-            x0 = column[0]
-            y0 = column[1]
-            yf = column[2]
-            data = self.clean_column(data, x0, y0, yf)
-
-        return data
-
-    def clean_lines(self, data, header):
-        """
-        Clean the known bad lines that exists in most of SAMI's, SOI's or
-        SIFS's data. This method is meant to be overwritten via inheritance.
-
-        Args:
-
-            data (numpy.ndarray) : A 2D numpy array that contains the data.
-
-            header (astropy.io.fits.Header) : A header that will be updated.
-
-        See also:
-
-            Reducer.clean_column
-            Reducer.clean_line
-            Reducer.clean_lines
-        """
-        binning = header['CCDSUM'].split(' ')[0]
-        binning = int(binning.strip())
-
-        if binning == 4:
-            bad_lines = [
-                [166, 206, 282],
-                [212, 258, 689],
-                [214, 239, 688],
-                [304, 345, 291],
-                [386, 422, 454],
-                [398, 422, 38],
-                [477, 516, 490],
-                [387, 429, 455],
-                [574, 603, 494],
-                [574, 603, 493],
-                [640, 672, 388],
-                [604, 671, 388],
-                [698, 746, 198],
-                [706, 634, 634],
-                [772, 812, 354],
-                [900, 938, 426],
-                [904, 920, 396]
-            ]
-
-        else:
-            bad_lines = []
-
-        for line in bad_lines:
-            x0 = line[0]
-            xf = line[1]
-            y = line[2]
-            data = self.clean_line(data, x0, xf, y)
-
-        return data
-
     @staticmethod
     def remove_central_bad_columns(data, header, prefix):
         """
@@ -1005,9 +1299,12 @@ class SoiReducer(Reducer):
             Clean bad collumns by taking the _median value of the pixels around
             them.
 
-        cosmic_rays : bool
+        cosmic_rays : bool or str
             Clean cosmic rays using LACosmic package. See noted bellow for
-            reference.
+            reference. Use 'fast' for the quicker median filter detector of
+            soar_simager.data_reduction.cosmic_rays. 'stack' leaves the
+            frames untouched: they are cleaned later, comparing the frames
+            of the same field (see cosmic_rays.reject_in_stack).
 
         dark_file : str
             Master Dark's filename to be used for dark subtraction.
@@ -1033,6 +1330,8 @@ class SoiReducer(Reducer):
         LACosmic - http://www.astro.yale.edu/dokkum/lacosmic/
     """
 
+    instrument = 'SOI'
+
     @staticmethod
     def add_gap(data, header, interpolation_factor=10):
         """
@@ -1066,113 +1365,85 @@ class SoiReducer(Reducer):
 
         return data, header
 
-    def clean_columns(self, _data, _header):
-        """
-        Clean the known bad columns that exists in most of SAMI's data.
 
-        Parameters
-        ----------
-            _data : numpy.ndarray
-                A 2D numpy array that contains the data.
+def get_scaling(hdu):
+    """
+    Return the BSCALE and BZERO that still have to be applied to the data of
+    an extension. They are only needed when the file was opened with
+    `do_not_scale_image_data=True` (see open_raw) and the data still holds the
+    raw signed integers.
 
-            _header : astropy.io.fits.Header
-                a header that contains the binning information on the 'CCDSUM'
-                key.
+    Args:
 
-        See also
-        --------
-            SoiMerger.clean_column
-            SoiMerger.clean_line
-            SoiMerger.clean_lines
-        """
-        if not isinstance(_data, _np.ndarray):
-            raise (TypeError, 'Please, use a np.array as input')
-        if _data.ndim is not 2:
-            raise (TypeError, 'Data contains %d dimensions while it was '
-                              'expected 2 dimensions.')
+        hdu (astropy.io.fits.ImageHDU) : the extension.
+
+    Returns:
 
-        b = int(_header['CCDSUM'].strip().split(' ')[0])
+        bscale (float), bzero (float)
+    """
+    if hdu.data.dtype.kind == 'i':
+        return (float(hdu.header.get('BSCALE', 1.)),
+                float(hdu.header.get('BZERO', 0.)))
 
-        if b == 1:
-            bad_columns = []
-        elif b == 2:
-            bad_columns = [
-                [855, 0, 2047],
-            ]
-        elif b == 4:
-            bad_columns = [
-                [427, 0, 1023]
-            ]
-        else:
-            logger.warning(
-                'Skipping clean_columns for binning {} x {}'.format(b, b))
-            bad_columns = []
+    return 1., 0.
 
-        for column in bad_columns:
-            x0 = column[0]
-            y0 = column[1]
-            yf = column[2]
-            _data = self.clean_column(_data, x0, y0, yf)
 
-        return _data
+def open_raw(filename):
+    """
+    Open a raw multi-extension file memory-mapped and without scaling its
+    data, so reading a window of an extension only touches the corresponding
+    part of the file. The BSCALE and BZERO of each extension must be applied
+    by the caller (see get_scaling).
 
-    def clean_lines(self, hdu_list):
-        """
-        Clean the known bad lines that exists in most of SAMI's, SOI's or
-        SIFS's data. This method is meant to be overwritten via inheritance.
+    Args:
 
-        Args:
+        filename (str) : raw file name.
 
-            hdu_list (astropy.io.fits.HDUList)
+    Returns:
 
-        See also:
+        hdul (astropy.io.fits.HDUList)
+    """
+    return _pyfits.open(filename, memmap=True, do_not_scale_image_data=True)
 
-            Reducer.clean_column
-            Reducer.clean_line
-            Reducer.clean_lines
-        """
-        if not isinstance(hdu_list, _pyfits.HDUList):
-            raise TypeError('Please, use a HDUList as input')
 
-        if len(hdu_list) != 5:
-            raise ValueError(
-                "HDUList is expected to have 1 + 4 elements. Found {}".format(
-                    len(hdu_list)))
-
-        for i in range(1, len(hdu_list)):
-
-            _data = hdu_list[i].data
-            _hdr = hdu_list[i].header
-
-            bad_lines = [
-                # [166, 206, 282],
-                # [212, 258, 689],
-                # [214, 239, 688],
-                # [304, 345, 291],
-                # [386, 422, 454],
-                # [398, 422, 38],
-                # [477, 516, 490],
-                # [387, 429, 455],
-                # [574, 603, 494],
-                # [574, 603, 493],
-                # [640, 672, 388],
-                # [604, 671, 388],
-                # [698, 746, 198],
-                # [706, 634, 634],
-                # [772, 812, 354],
-                # [900, 938, 426],
-                # [904, 920, 396]
-            ]
+def fit_overscan(biases, degree=2):
+    """
+    Fit a polynomial to the collapsed OVERSCAN of each amplifier. When all the
+    amplifiers have overscans with the same size, the polynomials are obtained
+    with a single least-squares solve. The result is the same as calling
+    numpy.polyfit and numpy.polyval for each amplifier.
+
+    Args:
+
+        biases (list) : list of 1D arrays with the collapsed overscan of each
+        amplifier.
+
+        degree (int, optional) : degree of the polynomial (default = 2).
+
+    Returns:
+
+        bias_fits (list) : list of 1D arrays with the fitted overscan of each
+        amplifier.
+    """
+    sizes = set(b.size for b in biases)
+
+    if len(sizes) > 1:
+        return [fit_overscan([b], degree)[0] for b in biases]
+
+    n = sizes.pop()
+    x = _np.arange(n) + 1.
+
+    # Scale the columns of the Vandermonde matrix like numpy.polyfit does
+    vander = _np.vander(x, degree + 1)
+    scale = _np.sqrt((vander * vander).sum(axis=0))
 
-            for line in bad_lines:
-                x0 = line[0]
-                xf = line[1]
-                y = line[2]
-                _data = self.clean_line(_data, x0, xf, y)
+    rcond = n * _np.finfo(x.dtype).eps
+    coefficients = _np.linalg.lstsq(
+        vander / scale, _np.column_stack(biases), rcond=rcond)[0]
 
-            hdu_list[i].data = _data
+    bias_fits = vander @ (coefficients / scale[:, _np.newaxis])
 
-        return hdu_list
+    return list(bias_fits.T)
 
 
 def _normalize_data(data):
@@ -1,15 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
 
+import copy
+import numpy as np
 import pandas as pd
 import glob
-import numpy
 import os
+import time
 
 from soar_simager.io import pyfits
 from soar_simager.io.logging import get_logger
 from soar_simager.tools import version
-from soar_simager.data_reduction import reduce, combine
+from soar_simager.data_reduction import bad_pixels, cosmic_rays, reduce, \
+    combine, night, parallel, profiling
+from soar_simager.data_reduction.header_index import HeaderIndex
+from soar_simager.data_reduction.manifest import Manifest
+from soar_simager.data_reduction.recipes import apply_recipe, get_recipe, \
+    load_recipes
+from soar_simager.data_reduction.watch import FileWatcher
+from soar_simager.data_reduction.writer import FrameWriter
 
 astropy_logger = get_logger('astropy')
 astropy_logger.setLevel('NOTSET')
@@ -24,8 +33,30 @@ __author__ = 'Bruno Quint'
 
 KEYWORDS = ["OBSTYPE", "FILTERS", "CCDSUM"]
 
-
-def data_reduction(path, debug=False, quiet=False):
+# Columns of the night table.
+COLUMNS = [
+    'filename',
+    'instrume',
+    'obstype',
+    'object',
+    'filters',
+    'filter1',
+    'filter2',
+    'binning',
+    'bad_pixel_file',
+    'dark_file',
+    'flat_file',
+    'zero_file',
+]
+
+# Columns of the night table that hold master files.
+MASTER_COLUMNS = ['zero_file', 'dark_file', 'flat_file']
+
+
+def data_reduction(path, debug=False, quiet=False, outfolder=None, jobs=1,
+                   dtype='float64', scan_threads=1, profiler=None,
+                   cosmic_ray_threads=1, recipe_file=None,
+                   cosmic_ray_mode=None, write_threads=1):
 
     """
     Main method for SAMI data reduction pipeline.
@@ -36,6 +67,37 @@ def data_reduction(path, debug=False, quiet=False):
          debug (bool, optional) : enable debug mode (default = False).
 
          quiet (bool, optional) : disable printing on screen (default = False).
+
+         outfolder (str, optional) : directory used to store the reduced data
+         (default = path/RED).
+
+         jobs (int, optional) : number of frames reduced in parallel
+         (default = 1).
+
+         dtype (str, optional) : data type used to reduce the frames,
+         'float32' or 'float64' (default = 'float64').
+
+         scan_threads (int, optional) : number of raw files whose headers are
+         read at the same time (default = 1).
+
+         profiler (Profiler, optional) : records the time, I/O and memory
+         used by each step. A summary is logged at the end
+         (default = no profiling).
+
+         cosmic_ray_threads (int, optional) : number of tiles of each frame
+         cleaned at the same time by LACosmic (default = 1).
+
+         recipe_file (str, optional) : JSON file with the recipes that change
+         the steps run for each frame type (default = data/recipes.json).
+
+         cosmic_ray_mode (str, optional) : 'fast' cleans the cosmic rays with
+         a median filter instead of LACosmic, for quicklook. 'stack'
+         compares the OBJECT frames of the same field (default = the
+         detector in the recipes).
+
+         write_threads (int, optional) : number of threads writing the
+         reduced frames while the next ones are reduced. With 0, each frame
+         is written before the next one (default = 1).
     """
 
     if debug:
@@ -48,82 +110,233 @@ def data_reduction(path, debug=False, quiet=False):
     log.info('SAMI Data-Reduction Pipeline')
     log.info('Version {}'.format(version.__str__))
 
-    reduced_path = create_reduced_folder(os.path.join(path, 'RED'))
+    if not outfolder:
+        outfolder = os.path.join(path, 'RED')
 
-    list_of_files = glob.glob(os.path.join(path, '*.fits'))
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
 
-    dataframe = build_table(list_of_files)
+    recipes = load_recipes(recipe_file, cosmic_ray_mode=cosmic_ray_mode)
 
-    dataframe = filter_files(dataframe)
+    reduced_path = create_reduced_folder(outfolder)
+    manifest = Manifest(reduced_path)
 
-    dataframe = process_zero_files(dataframe, reduced_path)
+    list_of_files = glob.glob(os.path.join(path, '*.fits'))
 
-    dataframe = process_dark_files(dataframe, reduced_path)
+    with HeaderIndex(reduced_path) as header_index, profiler.stage('scan'):
+        dataframe = build_table(list_of_files, header_index=header_index,
+                                scan_threads=scan_threads)
 
-    dataframe = process_flat_files(dataframe, reduced_path)
+    dataframe = filter_files(dataframe)
 
-    process_object_files(dataframe, reduced_path)
+    # Closing the writer makes sure that every reduced file is on disk.
+    with FrameWriter(threads=write_threads) as writer:
+        dataframe = process_night(
+            dataframe, reduced_path, jobs=jobs, dtype=dtype,
+            manifest=manifest, profiler=profiler,
+            cosmic_ray_threads=cosmic_ray_threads, recipes=recipes,
+            writer=writer)
 
     write_dataframe_to_html(dataframe)
 
+    profiler.log_summary(log)
+
     log.info("All done.")
 
+
+def watch(path, debug=False, quiet=False, outfolder=None, jobs=1,
+          dtype='float64', scan_threads=1, interval=5., min_zero=5,
+          min_flat=5, max_polls=None, profiler=None, cosmic_ray_threads=1,
+          recipe_file=None, cosmic_ray_mode=None, write_threads=1):
+    """
+    Reduce the data while it is being observed. The raw folder is polled for
+    new files and, every time new files arrive, the night is reduced again.
+    Only the new frames and the frames whose master files changed are
+    processed. A master ZERO or FLAT is only built once enough files
+    arrived, so the first frames of a sequence do not create a noisy master.
+
+    Args:
+         path (str) : path to the directory which receives the data.
+
+         debug (bool, optional) : enable debug mode (default = False).
+
+         quiet (bool, optional) : disable printing on screen (default = False).
+
+         outfolder (str, optional) : directory used to store the reduced data
+         (default = path/RED).
+
+         jobs (int, optional) : number of frames reduced in parallel
+         (default = 1).
+
+         dtype (str, optional) : data type used to reduce the frames,
+         'float32' or 'float64' (default = 'float64').
+
+         scan_threads (int, optional) : number of raw files whose headers are
+         read at the same time (default = 1).
+
+         interval (float, optional) : seconds between two polls
+         (default = 5).
+
+         min_zero (int, optional) : minimum number of ZERO files needed to
+         build a master ZERO (default = 5).
+
+         min_flat (int, optional) : minimum number of FLAT files needed to
+         build a master FLAT (default = 5).
+
+         max_polls (int, optional) : stop after this number of polls. By
+         default, runs until interrupted.
+
+         profiler (Profiler, optional) : records the time, I/O and memory
+         used by each step. A summary is logged when watching stops
+         (default = no profiling).
+
+         cosmic_ray_threads (int, optional) : number of tiles of each frame
+         cleaned at the same time by LACosmic (default = 1).
+
+         recipe_file (str, optional) : JSON file with the recipes that change
+         the steps run for each frame type (default = data/recipes.json).
+
+         cosmic_ray_mode (str, optional) : 'fast' cleans the cosmic rays with
+         a median filter instead of LACosmic, for quicklook. 'stack'
+         compares the OBJECT frames of the same field (default = the
+         detector in the recipes).
+
+         write_threads (int, optional) : number of threads writing the
+         reduced frames while the next ones are reduced. With 0, each frame
+         is written before the next one (default = 1).
+    """
+
+    if debug:
+        log.setLevel('DEBUG')
+    elif quiet:
+        log.setLevel('NOTSET')
+    else:
+        log.setLevel('INFO')
+
+    log.info('SAMI Data-Reduction Pipeline')
+    log.info('Version {}'.format(version.__str__))
+
+    if not outfolder:
+        outfolder = os.path.join(path, 'RED')
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    recipes = load_recipes(recipe_file, cosmic_ray_mode=cosmic_ray_mode)
+
+    reduced_path = create_reduced_folder(outfolder)
+    manifest = Manifest(reduced_path)
+    header_index = HeaderIndex(reduced_path)
+    writer = FrameWriter(threads=write_threads)
+
+    watcher = FileWatcher(path)
+    dataframe = None
+    n_polls = 0
+
+    log.info('Watching for new files in: {}'.format(path))
+
+    try:
+        while True:
+
+            new_files = watcher.poll()
+            n_polls += 1
+
+            if len(new_files) > 0:
+
+                log.info('Found {:d} new files.'.format(len(new_files)))
+
+                with profiler.stage('scan'):
+                    new_dataframe = filter_files(
+                        build_table(new_files, header_index=header_index,
+                                    scan_threads=scan_threads))
+                dataframe = night.set_schema(pd.concat(
+                    [dataframe, new_dataframe], ignore_index=True))
+
+                ready_dataframe = select_calibrations(
+                    dataframe, min_zero=min_zero, min_flat=min_flat)
+
+                ready_dataframe = process_night(
+                    ready_dataframe.copy(), reduced_path, jobs=jobs,
+                    dtype=dtype, manifest=manifest, profiler=profiler,
+                    cosmic_ray_threads=cosmic_ray_threads,
+                    recipes=recipes, writer=writer)
+                writer.sync()
+
+                write_dataframe_to_html(ready_dataframe)
+
+                log.info('Waiting for new files.')
+
+            if max_polls is not None and n_polls >= max_polls:
+                break
+
+            time.sleep(interval)
+
+    except KeyboardInterrupt:
+        log.info('Stopped watching: {}'.format(path))
+
+    finally:
+        writer.close()
+        header_index.close()
+        profiler.log_summary(log)
+
     
-def build_table(list_of_files):
+def build_table(list_of_files, check_data=True, stride=night.DATA_STRIDE,
+                header_index=None, scan_threads=1):
     """
-    Return a pandas.DataFrame used to organize the pipeline.
+    Return a pandas.DataFrame used to organize the pipeline. Only the headers
+    and a strided sample of the first extension of each file are read.
 
     Args:
         list_of_files (list) : list of files to be included in the dataframe.
 
+        check_data (bool, optional) : reject files with empty or saturated
+        data (default = True).
+
+        stride (int, optional) : step used to sample the data when checking
+        it (default = night.DATA_STRIDE).
+
+        header_index (HeaderIndex, optional) : persistent index used to avoid
+        reading the files that did not change since the last run.
+
+        scan_threads (int, optional) : number of files read at the same time.
+        Useful when the raw data is on a network file system (default = 1).
+
     Returns:
         table (pandas.Dataframe) : a dataframe with information needed for the
         pipeline.
     """
     log.info('Reading raw files')
 
-    table = pd.DataFrame(
-        columns=[
-            'filename',
-            'instrume',
-            'obstype',
-            'filters',
-            'filter1',
-            'filter2',
-            'binning',
-            'dark_file',
-            'flat_file',
-            'zero_file',
-        ]
-    )
+    if header_index is None:
+        read_files_info = night.read_files_info
+    else:
+        read_files_info = header_index.read_files_info
 
     list_of_files.sort()
-    for _file in list_of_files:
+    infos = read_files_info(list_of_files, check_data=check_data,
+                            stride=stride, threads=scan_threads)
 
-        try:
-            hdu = pyfits.open(_file)
-        except OSError:
+    records = []
+
+    for _file, info in zip(list_of_files, infos):
+
+        if info is None:
             log.warning("Could not read file: {}".format(_file))
             continue
 
-        if numpy.std(hdu[1].data.ravel()) == 0:
+        if info.pop('bad_data'):
             log.warning("Bad data found on file: {}".format(_file))
             continue
 
-        row = pd.Series(data={
-            'filename': _file,
-            'obstype': hdu[0].header['obstype'],
-            'instrume': hdu[0].header['instrume'].strip().upper(),
-            'filters': hdu[0].header['filters'],
-            'filter1': hdu[0].header['filter1'],
-            'filter2': hdu[0].header['filter2'],
-            'binning': hdu[1].header['ccdsum'].strip(),
+        info.update({
+            'bad_pixel_file': None,
             'dark_file': None,
             'flat_file': None,
             'zero_file': None,
         })
+        records.append(info)
 
-        table = table.append(row, ignore_index=True, sort=True)
+    table = night.build_dataframe(records, columns=COLUMNS)
 
     return table
 
@@ -192,7 +405,79 @@ def get_binning_used(table):
     return list_of_binning
 
 
-def process_dark_files(df, red_path):
+def process_bad_pixels(df, red_path, manifest=None, profiler=None):
+    """
+    Find the bad pixels in the master files of each binning and write them
+    to a bad pixel map next to the masters. The OBJECT files are cleaned
+    with it. The map is only derived again when the masters change.
+
+    Args:
+        df (pandas.DataFrame) : a data-frame containing the all the data being
+        processed.
+        red_path (str) : the path where the reduced data is stored.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+
+    Returns:
+        updated_table (pandas.DataFrame) : an updated data-frame where each
+        OBJECT file now is attached to the corresponding bad pixel map.
+    """
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    options = {'derive': 'BadPixelMap', 'sigma': bad_pixels.SIGMA,
+               'min_masters': bad_pixels.MIN_MASTERS,
+               'flat_edge': bad_pixels.FLAT_EDGE}
+
+    for b in df.binning.unique():
+
+        bx, by = b.split(' ')
+
+        binning_df = df.loc[df.binning.values == b]
+        master_files = sorted(
+            {f for column in MASTER_COLUMNS for f in binning_df[column]
+             if isinstance(f, str)})
+
+        if len(master_files) == 0:
+            continue
+
+        log.info('Finding bad pixels with binning: {} x {}'.format(bx, by))
+
+        bad_pixel_file = os.path.join(
+            red_path, "2BadPixels{}x{}.json".format(bx, by))
+
+        if manifest.is_current(bad_pixel_file, master_files, options):
+            log.warning('Skipping up-to-date BAD PIXEL MAP: {:s}'.format(
+                bad_pixel_file))
+        else:
+            log.info('Writing bad pixel map to: {}'.format(bad_pixel_file))
+
+            with profiler.stage('bad_pixels', bad_pixel_file):
+                bad_pixel_map = bad_pixels.derive_bad_pixel_map(
+                    bad_pixel_file, master_files, instrument='SAM',
+                    binning=int(bx))
+            manifest.record(bad_pixel_file, master_files, options)
+
+            log.info('Number of bad pixels: {:d}'.format(
+                bad_pixel_map.n_pixels))
+
+        mask1 = df['obstype'].values == 'OBJECT'
+        mask2 = df['binning'].values == b
+        df.loc[mask1 & mask2, 'bad_pixel_file'] = bad_pixel_file
+
+    manifest.save()
+
+    return df
+
+
+def process_dark_files(df, red_path, jobs=1, dtype='float64',
+                       manifest=None, profiler=None, cosmic_ray_threads=1,
+                       recipes=None, writer=None):
     """
     Args:
 
@@ -201,13 +486,37 @@ def process_dark_files(df, red_path):
 
         red_path (str) : the path where the reduced data is stored.
 
+        jobs (int, optional) : number of frames reduced in parallel.
+        dtype (str, optional) : data type used to reduce the frames.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+
+        cosmic_ray_threads (int, optional) : number of tiles cleaned at the
+        same time by LACosmic (default = 1).
+
+        recipes (dict, optional) : steps run for each frame type, as
+        returned by recipes.load_recipes (default = the default recipes).
+
+        writer (FrameWriter, optional) : writes the reduced frames in the
+        background (default = each frame is written before the next one).
+
     Returns:
 
         updated_table (pandas.DataFrame) : an updated data-frame where each
         file now is attached to the corresponding master Zero file.
 
     """
-    sami_pipeline = reduce.SamiReducer()
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    sami_pipeline = reduce.SamiReducer(
+        dtype=dtype, cosmic_ray_threads=cosmic_ray_threads)
+    apply_recipe(sami_pipeline, get_recipe('SAM', 'DARK', recipes))
 
     binning = df.binning.unique()
 
@@ -223,12 +532,11 @@ def process_dark_files(df, red_path):
         dark_table = dark_table.sort_values('filename')
 
         dark_list = []
-        for index, row in dark_table.iterrows():
+        dark_tasks = []
+        for row in dark_table.itertuples():
 
-            sami_pipeline.cosmic_rays = True
             sami_pipeline.dark_file = None
             sami_pipeline.flat_file = None
-            sami_pipeline.time = True
             sami_pipeline.zero_file = row.zero_file
 
             dark_file = row.filename
@@ -239,16 +547,13 @@ def process_dark_files(df, red_path):
 
             dark_list.append(prefix + fname)
 
-            if os.path.exists(output_dark_file):
-                log.warning('Skipping existing file: {}'.format(
-                    output_dark_file))
-                continue
-
-            log.info('Processing DARK file: {}'.format(dark_file))
+            dark_tasks.append((copy.copy(sami_pipeline), dark_file,
+                               output_dark_file, 'DARK'))
 
-            hdul = pyfits.open(dark_file)
-            data, header, prefix = sami_pipeline.reduce(hdul)
-            pyfits.writeto(output_dark_file, data.value, header=header)
+        dark_tasks = manifest.outdated(dark_tasks, log=log)
+        parallel.reduce_files(dark_tasks, jobs=jobs, log=log,
+                              profiler=profiler, writer=writer)
+        manifest.record_tasks(dark_tasks)
 
         if len(dark_list) == 0:
             continue
@@ -259,43 +564,69 @@ def process_dark_files(df, red_path):
             for dark_file in dark_list:
                 dark_list_buffer.write('{:s}\n'.format(dark_file))
 
-        log.info('Combining ZERO files.')
+        log.info('Combining DARK files.')
         master_dark = dark_list_name + '.fits'
 
-        if os.path.exists(master_dark):
+        dark_combine_files = [os.path.join(red_path, f) for f in dark_list]
+
+        if manifest.is_current(master_dark, dark_combine_files,
+                               {'combine': 'DarkCombine'}):
             log.warning(
-                'Skipping existing MASTER ZERO: {:s}'.format(master_dark))
+                'Skipping up-to-date MASTER DARK: {:s}'.format(master_dark))
 
         else:
 
-            log.info("Writing master zero to: {}".format(master_dark))
-            dark_combine_files = [os.path.join(red_path, f) for f in dark_list]
+            log.info("Writing master dark to: {}".format(master_dark))
 
             dark_combine = combine.DarkCombine(input_list=dark_combine_files,
                                                output_file=master_dark)
-            dark_combine.run()
+            with profiler.stage('dark_combine', master_dark):
+                dark_combine.run()
+            manifest.record(master_dark, dark_combine_files,
+                            {'combine': 'DarkCombine'})
             log.info('Done.')
 
         mask1 = df['obstype'].values != 'DARK'
         mask2 = df['binning'].values == b
         df.loc[mask1 & mask2, 'dark_file'] = master_dark
 
+    manifest.save()
+
     return df
 
 
-def process_flat_files(df, red_path):
+def process_flat_files(df, red_path, jobs=1, dtype='float64',
+                       manifest=None, profiler=None, recipes=None,
+                       writer=None):
     """
     Args:
         df (pandas.DataFrame) : a data-frame containing the all the data being
         processed.
         red_path (str) : the path where the reduced data is stored.
+        jobs (int, optional) : number of frames reduced in parallel.
+        dtype (str, optional) : data type used to reduce the frames.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+        recipes (dict, optional) : steps run for each frame type, as
+        returned by recipes.load_recipes (default = the default recipes).
+        writer (FrameWriter, optional) : writes the reduced frames in the
+        background (default = each frame is written before the next one).
 
     Returns:
         updated_table (pandas.DataFrame) : an updated data-frame where each
         file now is attached to the corresponding master Zero file.
     """
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
     log.info('Processing FLAT files (SFLAT + DFLAT)')
-    sami_pipeline = reduce.SamiReducer()
+    sami_pipeline = reduce.SamiReducer(dtype=dtype)
+    apply_recipe(sami_pipeline, get_recipe('SAM', 'FLAT', recipes))
 
     binning = df.binning.unique()
 
@@ -324,7 +655,8 @@ def process_flat_files(df, red_path):
                 'Filter Wheel 2: {}'.format(filter_flat_df.filter2.unique()[0]))
 
             flat_list = []
-            for index, row in filter_flat_df.iterrows():
+            flat_tasks = []
+            for row in filter_flat_df.itertuples():
 
                 sami_pipeline.zero_file = row.zero_file
                 sami_pipeline.dark_file = row.dark_file
@@ -336,16 +668,13 @@ def process_flat_files(df, red_path):
                 output_flat = os.path.join(red_path, prefix + fname)
                 flat_list.append(prefix + fname)
 
-                if os.path.exists(output_flat):
-                    log.warning(
-                        'Skipping existing FLAT file: {}'.format(output_flat))
-                    continue
+                flat_tasks.append((copy.copy(sami_pipeline), flat_file,
+                                   output_flat, 'FLAT'))
 
-                log.info('Processing FLAT file: {}'.format(flat_file))
-
-                hdul = pyfits.open(flat_file)
-                data, header, prefix = sami_pipeline.reduce(hdul)
-                pyfits.writeto(output_flat, data.value, header=header)
+            flat_tasks = manifest.outdated(flat_tasks, log=log)
+            parallel.reduce_files(flat_tasks, jobs=jobs, log=log,
+                                  profiler=profiler, writer=writer)
+            manifest.record_tasks(flat_tasks)
 
             if len(flat_list) == 0:
                 continue
@@ -359,28 +688,94 @@ def process_flat_files(df, red_path):
 
             master_flat = flat_list_name + '.fits'
 
-            if os.path.exists(master_flat):
-                log.warning(
-                    'Skipping existing MASTER FLAT: {:s}'.format(master_flat))
+            flat_combine_files = [os.path.join(red_path, f) for f in flat_list]
+
+            if manifest.is_current(master_flat, flat_combine_files,
+                                   {'combine': 'FlatCombine'}):
+                log.warning('Skipping up-to-date MASTER FLAT: {:s}'.format(
+                    master_flat))
             else:
                 log.info('Writing master FLAT to file: {}'.format(master_flat))
 
-            flat_combine_files = [os.path.join(red_path, f) for f in flat_list]
-
-            flat_combine = combine.FlatCombine(
-                 input_list=flat_combine_files, output_file=master_flat)
+                flat_combine = combine.FlatCombine(
+                     input_list=flat_combine_files, output_file=master_flat)
 
-            flat_combine.run()
+                with profiler.stage('flat_combine', master_flat):
+                    flat_combine.run()
+                manifest.record(master_flat, flat_combine_files,
+                                {'combine': 'FlatCombine'})
 
             mask1 = df['obstype'].values == 'OBJECT'
             mask2 = df['binning'].values == b
             mask3 = df['filters'].values == _filter
             df.loc[mask1 & mask2 & mask3, 'flat_file'] = master_flat
 
+    manifest.save()
+
     return df
 
  
-def process_object_files(df, red_path):
+def process_night(df, red_path, jobs=1, dtype='float64', manifest=None,
+                  profiler=None, cosmic_ray_threads=1, recipes=None,
+                  writer=None):
+    """
+    Build the master calibration files and reduce all the frames of a night.
+
+    Args:
+        df (pandas.DataFrame) : a data-frame containing the all the data being
+        processed.
+        red_path (str) : the path where the reduced data is stored.
+        jobs (int, optional) : number of frames reduced in parallel.
+        dtype (str, optional) : data type used to reduce the frames.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+        cosmic_ray_threads (int, optional) : number of tiles of each frame
+        cleaned at the same time by LACosmic (default = 1).
+        recipes (dict, optional) : steps run for each frame type, as
+        returned by recipes.load_recipes (default = the default recipes).
+        writer (FrameWriter, optional) : writes the reduced frames in the
+        background (default = each frame is written before the next one).
+
+    Returns:
+        updated_table (pandas.DataFrame) : an updated data-frame where each
+        file now is attached to the corresponding master files.
+    """
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    df = process_zero_files(
+        df, red_path, jobs=jobs, dtype=dtype, manifest=manifest,
+        profiler=profiler, cosmic_ray_threads=cosmic_ray_threads,
+        recipes=recipes, writer=writer)
+
+    df = process_dark_files(
+        df, red_path, jobs=jobs, dtype=dtype, manifest=manifest,
+        profiler=profiler, cosmic_ray_threads=cosmic_ray_threads,
+        recipes=recipes, writer=writer)
+
+    df = process_flat_files(
+        df, red_path, jobs=jobs, dtype=dtype, manifest=manifest,
+        profiler=profiler, recipes=recipes, writer=writer)
+
+    df = process_bad_pixels(
+        df, red_path, manifest=manifest, profiler=profiler)
+
+    df = process_object_files(
+        df, red_path, jobs=jobs, dtype=dtype, manifest=manifest,
+        profiler=profiler, cosmic_ray_threads=cosmic_ray_threads,
+        recipes=recipes, writer=writer)
+
+    return df
+
+
+def process_object_files(df, red_path, jobs=1, dtype='float64',
+                         manifest=None, profiler=None, cosmic_ray_threads=1,
+                         recipes=None, writer=None):
     """
     Args:
 
@@ -389,56 +784,206 @@ def process_object_files(df, red_path):
 
         red_path (str) : the path where the reduced data is stored.
 
+        jobs (int, optional) : number of frames reduced in parallel.
+        dtype (str, optional) : data type used to reduce the frames.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+
+        cosmic_ray_threads (int, optional) : number of tiles cleaned at the
+        same time by LACosmic (default = 1).
+
+        recipes (dict, optional) : steps run for each frame type, as
+        returned by recipes.load_recipes (default = the default recipes).
+
+        writer (FrameWriter, optional) : writes the reduced frames in the
+        background (default = each frame is written before the next one).
+
     Returns:
 
         updated_table (pandas.DataFrame) : an updated data-frame where each
         file now is attached to the corresponding master Zero file.
     """
-    sami_pipeline = reduce.SamiReducer()
-    sami_pipeline.cosmic_rays = True
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    sami_pipeline = reduce.SamiReducer(
+        dtype=dtype, cosmic_ray_threads=cosmic_ray_threads)
+    recipe = get_recipe('SAM', 'OBJECT', recipes)
+    apply_recipe(sami_pipeline, recipe)
 
     log.info('Processing OBJECT files.')
 
     object_df = df.loc[df.obstype.values == 'OBJECT']
 
-    for index, row in object_df.iterrows():
+    object_tasks = []
+    for row in object_df.itertuples():
 
         sami_pipeline.zero_file = row.zero_file
         sami_pipeline.dark_file = row.dark_file
         sami_pipeline.flat_file = row.flat_file
+        sami_pipeline.bad_pixel_file = row.bad_pixel_file
+        sami_pipeline.clean = \
+            recipe['clean'] and row.bad_pixel_file is not None
         obj_file = row.filename
 
         path, fname = os.path.split(obj_file)
         prefix = sami_pipeline.get_prefix()
         output_obj_file = os.path.join(red_path, prefix + fname)
 
-        if os.path.exists(output_obj_file):
-            log.warning(
-                'Skipping existing OBJECT file: {}'.format(output_obj_file))
-            continue
+        object_tasks.append((copy.copy(sami_pipeline), obj_file,
+                             output_obj_file, 'OBJECT'))
 
-        log.info('Processing OBJECT file: {}'.format(obj_file))
+    if recipe['cosmic_rays'] == 'stack':
+        object_tasks = process_object_stacks(
+            object_df, object_tasks, manifest, jobs=jobs, profiler=profiler,
+            writer=writer)
 
-        hdul = pyfits.open(obj_file)
-        data, header, prefix = sami_pipeline.reduce(hdul)
-        pyfits.writeto(output_obj_file, data.value, header=header)
+    object_tasks = manifest.outdated(object_tasks, log=log)
+    parallel.reduce_files(object_tasks, jobs=jobs, log=log,
+                          profiler=profiler, writer=writer)
+    manifest.record_tasks(object_tasks)
+
+    manifest.save()
 
     return df
 
+
+def process_object_stacks(object_df, object_tasks, manifest, jobs=1,
+                          profiler=None, writer=None):
+    """
+    Reduce the OBJECT frames whose cosmic rays are removed by comparing the
+    frames of the same field (see cosmic_rays.reject_in_stack). The frames
+    are grouped by OBJECT, filters and binning and aligned using their WCS.
+    Each reduced frame is recorded in the manifest with the raw files of its
+    whole group, so adding or changing one frame reduces the group again.
+
+    Args:
+
+        object_df (pandas.DataFrame) : the OBJECT rows of the night table.
+
+        object_tasks (list) : (reducer, input_file, output_file, label)
+        tuples, one for each row of object_df.
+
+        manifest (Manifest) : records how the reduced files were created.
+
+        jobs (int, optional) : number of frames reduced in parallel.
+
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+
+        writer (FrameWriter, optional) : writes the reduced frames in the
+        background (default = each frame is written before the next one).
+
+    Returns:
+
+        remaining_tasks (list) : the tasks of the groups with less than
+        cosmic_rays.MIN_STACK frames, changed to clean their cosmic rays
+        with LACosmic.
+    """
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    groups = {}
+    for row, task in zip(object_df.itertuples(), object_tasks):
+        key = (row.object, row.filters, row.binning)
+        groups.setdefault(key, []).append(task)
+
+    remaining_tasks = []
+    outdated_groups = []
+
+    for (obj, filters, binning), tasks in groups.items():
+
+        if len(tasks) < cosmic_rays.MIN_STACK:
+            log.info('Only {:d} frames of {:s} with filters {:s} and binning '
+                     '{:s}. Using LACosmic.'.format(
+                         len(tasks), obj, filters, binning))
+            for reducer, input_file, output_file, label in tasks:
+                reducer = copy.copy(reducer)
+                reducer.cosmic_rays = 'lacosmic'
+                remaining_tasks.append(
+                    (reducer, input_file, output_file, label))
+            continue
+
+        inputs = [input_file for _, input_file, _, _ in tasks]
+
+        if all(manifest.is_current(output_file, inputs, r.get_options(),
+                                   masters=r.get_master_files())
+               for r, _, output_file, _ in tasks):
+            log.debug('Skipping up-to-date OBJECT files of {:s}'.format(obj))
+            continue
+
+        outdated_groups.append((obj, tasks))
+
+    parallel.reduce_files([t for _, tasks in outdated_groups for t in tasks],
+                          jobs=jobs, log=log, profiler=profiler,
+                          writer=writer)
+
+    for obj, tasks in outdated_groups:
+
+        inputs = [input_file for _, input_file, _, _ in tasks]
+        outputs = [output_file for _, _, output_file, _ in tasks]
+
+        try:
+            offsets = cosmic_rays.get_offsets(
+                [pyfits.getheader(f) for f in outputs])
+        except ValueError as error:
+            log.warning('{} Assuming that the frames are aligned.'.format(
+                error))
+            offsets = np.zeros((len(outputs), 2), dtype=int)
+
+        with profiler.stage('stack_cosmic_rays', outputs[0]):
+            n_flagged = cosmic_rays.reject_in_stack(outputs, offsets=offsets)
+
+        log.info('Removed cosmic rays from {:d} frames of {:s}: {:s} '
+                 'pixels.'.format(len(outputs), obj,
+                                  ', '.join(str(n) for n in n_flagged)))
+
+        for reducer, _, output_file, _ in tasks:
+            manifest.record(output_file, inputs, reducer.get_options(),
+                            masters=reducer.get_master_files())
+
+    return remaining_tasks
+
  
-def process_zero_files(df, red_path):
+def process_zero_files(df, red_path, jobs=1, dtype='float64',
+                       manifest=None, profiler=None, cosmic_ray_threads=1,
+                       recipes=None, writer=None):
     """
     Args:
         df (pandas.DataFrame) : a data-frame containing the all the data being
         processed.
         red_path (str) : the path where the reduced data is stored.
+        jobs (int, optional) : number of frames reduced in parallel.
+        dtype (str, optional) : data type used to reduce the frames.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+        cosmic_ray_threads (int, optional) : number of tiles cleaned at the
+        same time by LACosmic (default = 1).
+        recipes (dict, optional) : steps run for each frame type, as
+        returned by recipes.load_recipes (default = the default recipes).
+        writer (FrameWriter, optional) : writes the reduced frames in the
+        background (default = each frame is written before the next one).
 
     Returns:
         updated_table (pandas.DataFrame) : an updated data-frame where each
         file now is attached to the corresponding master Zero file.
     """
-    sami_pipeline = reduce.SamiReducer()
-    sami_pipeline.cosmic_rays = True
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    sami_pipeline = reduce.SamiReducer(
+        dtype=dtype, cosmic_ray_threads=cosmic_ray_threads)
+    apply_recipe(sami_pipeline, get_recipe('SAM', 'ZERO', recipes))
 
     binning = df.binning.unique()
 
@@ -458,7 +1003,8 @@ def process_zero_files(df, red_path):
         zero_table = zero_table.sort_values('filename')
 
         zero_list = []
-        for index, row in zero_table.iterrows():
+        zero_tasks = []
+        for row in zero_table.itertuples():
 
             sami_pipeline.zero_file = None
             sami_pipeline.flat_file = None
@@ -470,16 +1016,13 @@ def process_zero_files(df, red_path):
 
             zero_list.append(prefix + fname)
 
-            if os.path.exists(output_zero_file):
-                log.warning('Skipping existing file: {}'.format(
-                    output_zero_file))
-                continue
-
-            log.info('Processing ZERO file: {}'.format(zero_file))
+            zero_tasks.append((copy.copy(sami_pipeline), zero_file,
+                               output_zero_file, 'ZERO'))
 
-            hdul = pyfits.open(zero_file)
-            data, header, prefix = sami_pipeline.reduce(hdul)
-            pyfits.writeto(output_zero_file, data.value, header=header)
+        zero_tasks = manifest.outdated(zero_tasks, log=log)
+        parallel.reduce_files(zero_tasks, jobs=jobs, log=log,
+                              profiler=profiler, writer=writer)
+        manifest.record_tasks(zero_tasks)
 
         if len(zero_list) == 0:
                 continue
@@ -493,27 +1036,70 @@ def process_zero_files(df, red_path):
         log.info('Combining ZERO files.')
         master_zero = zero_list_name + '.fits'
 
-        if os.path.exists(master_zero):
+        zero_combine_files = [os.path.join(red_path, f) for f in zero_list]
+
+        if manifest.is_current(master_zero, zero_combine_files,
+                               {'combine': 'ZeroCombine'}):
             log.warning(
-                'Skipping existing MASTER ZERO: {:s}'.format(master_zero))
+                'Skipping up-to-date MASTER ZERO: {:s}'.format(master_zero))
 
         else:
 
             log.info("Writing master zero to: {}".format(master_zero))
-            zero_combine_files = [os.path.join(red_path, f) for f in zero_list]
 
             zero_combine = combine.ZeroCombine(input_list=zero_combine_files,
                                                output_file=master_zero)
-            zero_combine.run()
+            with profiler.stage('zero_combine', master_zero):
+                zero_combine.run()
+            manifest.record(master_zero, zero_combine_files,
+                            {'combine': 'ZeroCombine'})
             log.info('Done.')
 
         mask1 = df['obstype'].values != 'ZERO'
         mask2 = df['binning'].values == b
         df.loc[mask1 & mask2, 'zero_file'] = master_zero
 
+    manifest.save()
+
     return df
 
 
+def select_calibrations(df, min_zero=5, min_flat=5):
+    """
+    Remove the ZERO and FLAT files that do not have enough companions to
+    build a master file yet.
+
+    Args:
+        df (pandas.DataFrame) : a data-frame containing the all the data being
+        processed.
+        min_zero (int, optional) : minimum number of ZERO files with the same
+        binning.
+        min_flat (int, optional) : minimum number of FLAT files with the same
+        binning and filters.
+
+    Returns:
+        selected_df (pandas.DataFrame) : the data-frame without the incomplete
+        sets of calibration files.
+    """
+    keep = pd.Series(True, index=df.index)
+
+    zero_df = df[df.obstype == 'ZERO']
+    zero_count = zero_df.groupby('binning').filename.transform('size')
+    keep.loc[zero_count.index] = zero_count.values >= min_zero
+
+    flat_df = df[df.obstype.isin(['SFLAT', 'DFLAT'])]
+    flat_count = flat_df.groupby(
+        ['binning', 'filters']).filename.transform('size')
+    keep.loc[flat_count.index] = flat_count.values >= min_flat
+
+    n_waiting = len(df.index) - keep.sum()
+    if n_waiting > 0:
+        log.info('Calibration files waiting for more frames: {:d}'.format(
+            n_waiting))
+
+    return df[keep]
+
+
 def write_dataframe_to_html(df):
     """
     Writes the dataframe as a HTML file for debugging.
@@ -536,9 +1122,11 @@ def write_dataframe_to_html(df):
                 'filter2',
                 'filters',
                 'obstype',
+                'object',
                 'zero_file',
                 'dark_file',
                 'flat_file',
+                'bad_pixel_file',
             ]
         )
 
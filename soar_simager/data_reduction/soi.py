@@ -2,15 +2,18 @@
 # -*- coding: utf8 -*-
 
 import ccdproc
-import pandas as pd
+import copy
 import glob
-import numpy
 import os
 
-from soar_simager.io import pyfits
 from soar_simager.io.logging import get_logger
 from soar_simager.tools import version
-from soar_simager.data_reduction import reduce, combine
+from soar_simager.data_reduction import bad_pixels, reduce, combine, night, \
+    parallel, profiling
+from soar_simager.data_reduction.header_index import HeaderIndex
+from soar_simager.data_reduction.manifest import Manifest
+from soar_simager.data_reduction.recipes import apply_recipe, get_recipe, \
+    load_recipes
 
 astropy_logger = get_logger('astropy')
 astropy_logger.setLevel('NOTSET')
@@ -25,60 +28,80 @@ __author__ = 'Bruno Quint'
 
 KEYWORDS = ["OBSTYPE", "FILTERS", "CCDSUM"]
 
-
-def build_table(list_of_files):
+# Columns of the night table.
+COLUMNS = [
+    'filename',
+    'instrume',
+    'obstype',
+    'filters',
+    'filter1',
+    'filter2',
+    'binning',
+    'bad_pixel_file',
+    'flat_file',
+    'zero_file',
+]
+
+# Columns of the night table that hold master files.
+MASTER_COLUMNS = ['zero_file', 'flat_file']
+
+
+def build_table(list_of_files, check_data=True, stride=night.DATA_STRIDE,
+                header_index=None, scan_threads=1):
     """
-    Return a pandas.DataFrame used to organize the pipeline.
+    Return a pandas.DataFrame used to organize the pipeline. Only the headers
+    and a strided sample of the first extension of each file are read.
 
     Args:
         list_of_files (list) : list of files to be included in the dataframe.
 
+        check_data (bool, optional) : reject files with empty or saturated
+        data (default = True).
+
+        stride (int, optional) : step used to sample the data when checking
+        it (default = night.DATA_STRIDE).
+
+        header_index (HeaderIndex, optional) : persistent index used to avoid
+        reading the files that did not change since the last run.
+
+        scan_threads (int, optional) : number of files read at the same time.
+        Useful when the raw data is on a network file system (default = 1).
+
     Returns:
         table (pandas.Dataframe) : a dataframe with information needed for the
         pipeline.
     """
     log.info('Reading raw files')
 
-    table = pd.DataFrame(
-        columns=[
-            'filename',
-            'instrume',
-            'obstype',
-            'filters',
-            'filter1',
-            'filter2',
-            'binning',
-            'flat_file',
-            'zero_file',
-        ]
-    )
+    if header_index is None:
+        read_files_info = night.read_files_info
+    else:
+        read_files_info = header_index.read_files_info
 
     list_of_files.sort()
-    for _file in list_of_files:
+    infos = read_files_info(list_of_files, check_data=check_data,
+                            stride=stride, threads=scan_threads)
+
+    records = []
+
+    for _file, info in zip(list_of_files, infos):
 
-        try:
-            hdu = pyfits.open(_file)
-        except OSError:
+        if info is None:
             log.warning("Could not read file: {}".format(_file))
             continue
 
-        if numpy.std(hdu[1].data.ravel()) == 0:
+        if info.pop('bad_data'):
             log.warning("Bad data found on file: {}".format(_file))
             continue
 
-        row = pd.Series(data={
-            'filename': _file,
-            'obstype': hdu[0].header['obstype'],
-            'instrume': hdu[0].header['instrume'].strip().upper(),
-            'filters': hdu[0].header['filters'],
-            'filter1': hdu[0].header['filter1'],
-            'filter2': hdu[0].header['filter2'],
-            'binning': hdu[1].header['ccdsum'].strip(),
+        info.update({
+            'bad_pixel_file': None,
             'flat_file': None,
             'zero_file': None,
         })
+        records.append(info)
 
-        table = table.append(row, ignore_index=True, sort=True)
+    table = night.build_dataframe(records, columns=COLUMNS)
 
     return table
 
@@ -124,20 +147,105 @@ def get_binning_used(table):
     return list_of_binning
 
 
-def process_flat_files(df, red_path):
+def process_bad_pixels(df, red_path, manifest=None, profiler=None):
+    """
+    Find the bad pixels in the master files of each binning and write them
+    to a bad pixel map next to the masters. The OBJECT files are cleaned
+    with it. The map is only derived again when the masters change.
+
+    Args:
+        df (pandas.DataFrame) : a data-frame containing the all the data being
+        processed.
+        red_path (str) : the path where the reduced data is stored.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+
+    Returns:
+        updated_table (pandas.DataFrame) : an updated data-frame where each
+        OBJECT file now is attached to the corresponding bad pixel map.
+    """
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    options = {'derive': 'BadPixelMap', 'sigma': bad_pixels.SIGMA,
+               'min_masters': bad_pixels.MIN_MASTERS,
+               'flat_edge': bad_pixels.FLAT_EDGE}
+
+    for b in df.binning.unique():
+
+        bx, by = b.split(' ')
+
+        binning_df = df.loc[df.binning.values == b]
+        master_files = sorted(
+            {f for column in MASTER_COLUMNS for f in binning_df[column]
+             if isinstance(f, str)})
+
+        if len(master_files) == 0:
+            continue
+
+        log.info('Finding bad pixels with binning: {} x {}'.format(bx, by))
+
+        bad_pixel_file = os.path.join(
+            red_path, "2BadPixels{}x{}.json".format(bx, by))
+
+        if manifest.is_current(bad_pixel_file, master_files, options):
+            log.warning('Skipping up-to-date BAD PIXEL MAP: {:s}'.format(
+                bad_pixel_file))
+        else:
+            log.info('Writing bad pixel map to: {}'.format(bad_pixel_file))
+
+            with profiler.stage('bad_pixels', bad_pixel_file):
+                bad_pixel_map = bad_pixels.derive_bad_pixel_map(
+                    bad_pixel_file, master_files, instrument='SOI',
+                    binning=int(bx))
+            manifest.record(bad_pixel_file, master_files, options)
+
+            log.info('Number of bad pixels: {:d}'.format(
+                bad_pixel_map.n_pixels))
+
+        mask1 = df['obstype'].values == 'OBJECT'
+        mask2 = df['binning'].values == b
+        df.loc[mask1 & mask2, 'bad_pixel_file'] = bad_pixel_file
+
+    manifest.save()
+
+    return df
+
+
+def process_flat_files(df, red_path, jobs=1, dtype='float64',
+                       manifest=None, profiler=None, recipes=None):
     """
     Args:
         df (pandas.DataFrame) : a data-frame containing the all the data being
         processed.
         red_path (str) : the path where the reduced data is stored.
+        jobs (int, optional) : number of frames reduced in parallel.
+        dtype (str, optional) : data type used to reduce the frames.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+        recipes (dict, optional) : steps run for each frame type, as
+        returned by recipes.load_recipes (default = the default recipes).
 
     Returns:
         updated_table (pandas.DataFrame) : an updated data-frame where each
         file now is attached to the corresponding master Zero file.
     """
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
     log.info('Processing FLAT files (SFLAT + DFLAT)')
-    soi_merger = reduce.SoiReducer()
-    soi_merger.clean = True
+    soi_merger = reduce.SoiReducer(dtype=dtype)
+    apply_recipe(soi_merger, get_recipe('SOI', 'FLAT', recipes))
 
     binning = df.binning.unique()
 
@@ -166,7 +274,8 @@ def process_flat_files(df, red_path):
                 'Filter Wheel 2: {}'.format(filter_flat_df.filter2.unique()[0]))
 
             flat_list = []
-            for index, row in filter_flat_df.iterrows():
+            flat_tasks = []
+            for row in filter_flat_df.itertuples():
 
                 soi_merger.zero_file = row.zero_file
                 soi_merger.flat_file = None
@@ -177,18 +286,13 @@ def process_flat_files(df, red_path):
                 output_flat = os.path.join(red_path, prefix + fname)
                 flat_list.append(prefix + fname)
 
-                if os.path.exists(output_flat):
-                    log.warning(
-                        'Skipping existing FLAT file: {}'.format(output_flat))
-                    continue
-
-                log.info('Processing FLAT file: {}'.format(flat_file))
-
-                d = soi_merger.merge(flat_file)
-                h = soi_merger.get_header(flat_file)
+                flat_tasks.append((copy.copy(soi_merger), flat_file,
+                                   output_flat, 'FLAT'))
 
-                d, h, p = soi_merger.__reduce(d, h)
-                pyfits.writeto(output_flat, d, h)
+            flat_tasks = manifest.outdated(flat_tasks, log=log)
+            parallel.reduce_files(flat_tasks, jobs=jobs, log=log,
+                                  profiler=profiler)
+            manifest.record_tasks(flat_tasks)
 
             flat_list_name = os.path.join(
                 red_path, "1FLAT_{}x{}_{}".format(bx, by, _filter))
@@ -199,85 +303,128 @@ def process_flat_files(df, red_path):
 
             master_flat = flat_list_name + '.fits'
 
-            if os.path.exists(master_flat):
-                log.warning(
-                    'Skipping existing MASTER FLAT: {:s}'.format(master_flat))
+            flat_combine_files = [os.path.join(red_path, f) for f in flat_list]
+
+            if manifest.is_current(master_flat, flat_combine_files,
+                                   {'combine': 'FlatCombine'}):
+                log.warning('Skipping up-to-date MASTER FLAT: {:s}'.format(
+                    master_flat))
             else:
                 log.info('Writing master FLAT to file: {}'.format(master_flat))
 
-            flat_combine_files = [os.path.join(red_path, f) for f in flat_list]
-
-            flat_combine = combine.FlatCombine(
-                 input_list=flat_combine_files, output_file=master_flat)
+                flat_combine = combine.FlatCombine(
+                     input_list=flat_combine_files, output_file=master_flat)
 
-            flat_combine.run()
+                with profiler.stage('flat_combine', master_flat):
+                    flat_combine.run()
+                manifest.record(master_flat, flat_combine_files,
+                                {'combine': 'FlatCombine'})
 
             mask1 = df['obstype'].values == 'OBJECT'
             mask2 = df['binning'].values == b
             df.loc[mask1 & mask2, 'flat_file'] = master_flat
 
+    manifest.save()
+
     return df
 
 
-def process_object_files(df, red_path):
+def process_object_files(df, red_path, jobs=1, dtype='float64',
+                         manifest=None, profiler=None, cosmic_ray_threads=1,
+                         recipes=None):
     """
     Args:
         df (pandas.DataFrame) : a data-frame containing the all the data being
         processed.
         red_path (str) : the path where the reduced data is stored.
+        jobs (int, optional) : number of frames reduced in parallel.
+        dtype (str, optional) : data type used to reduce the frames.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+        cosmic_ray_threads (int, optional) : number of tiles cleaned at the
+        same time by LACosmic (default = 1).
+        recipes (dict, optional) : steps run for each frame type, as
+        returned by recipes.load_recipes (default = the default recipes).
 
     Returns:
         updated_table (pandas.DataFrame) : an updated data-frame where each
         file now is attached to the corresponding master Zero file.
     """
-    soi_merger = reduce.SoiReducer()
-    soi_merger.cosmic_rays = True
-    soi_merger.clean = True
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    soi_merger = reduce.SoiReducer(
+        dtype=dtype, cosmic_ray_threads=cosmic_ray_threads)
+    apply_recipe(soi_merger, get_recipe('SOI', 'OBJECT', recipes))
+
+    # The OBJECT frames of SOI are not grouped by field yet.
+    if soi_merger.cosmic_rays == 'stack':
+        log.warning('The stack cosmic ray mode is only available for SAMI. '
+                    'Using LACosmic.')
+        soi_merger.cosmic_rays = 'lacosmic'
 
     log.info('Processing OBJECT files.')
 
     object_df = df.loc[df.obstype.values == 'OBJECT']
 
-    for index, row in object_df.iterrows():
+    object_tasks = []
+    for row in object_df.itertuples():
 
         soi_merger.zero_file = row.zero_file
         soi_merger.flat_file = row.flat_file
+        soi_merger.bad_pixel_file = row.bad_pixel_file
         obj_file = row.filename
 
         path, fname = os.path.split(obj_file)
         prefix = soi_merger.get_prefix()
         output_obj_file = os.path.join(path, 'RED', prefix + fname)
 
-        if os.path.exists(output_obj_file):
-            log.warning(
-                'Skipping existing OBJECT file: {}'.format(output_obj_file))
-            continue
-
-        log.info('Processing OBJECT file: {}'.format(obj_file))
-
-        d = soi_merger.merge(obj_file)
-        h = soi_merger.get_header(obj_file)
-        h = soi_merger.create_wcs(d, h)
+        object_tasks.append((copy.copy(soi_merger), obj_file,
+                             output_obj_file, 'OBJECT'))
 
-        d, h, p = soi_merger.__reduce(d, h)
+    object_tasks = manifest.outdated(object_tasks, log=log)
+    parallel.reduce_files(object_tasks, jobs=jobs, log=log,
+                          profiler=profiler)
+    manifest.record_tasks(object_tasks)
 
-        pyfits.writeto(output_obj_file, d, h)
+    manifest.save()
 
     return df
 
 
-def process_zero_files(df, red_path):
+def process_zero_files(df, red_path, jobs=1, dtype='float64',
+                       manifest=None, profiler=None, recipes=None):
     """
     Args:
         df (pandas.DataFrame) : a data-frame containing the all the data being
         processed.
         red_path (str) : the path where the reduced data is stored.
+        jobs (int, optional) : number of frames reduced in parallel.
+        dtype (str, optional) : data type used to reduce the frames.
+        manifest (Manifest, optional) : records how the reduced files were
+        created (default = the manifest stored in red_path).
+        profiler (Profiler, optional) : records the time, I/O and memory
+        used by each step (default = no profiling).
+        recipes (dict, optional) : steps run for each frame type, as
+        returned by recipes.load_recipes (default = the default recipes).
 
     Returns:
         updated_table (pandas.DataFrame) : an updated data-frame where each
         file now is attached to the corresponding master Zero file.
     """
-    soi_merger = reduce.SoiReducer()
+    if manifest is None:
+        manifest = Manifest(red_path)
+
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    soi_merger = reduce.SoiReducer(dtype=dtype)
+    apply_recipe(soi_merger, get_recipe('SOI', 'ZERO', recipes))
 
     binning = df.binning.unique()
 
@@ -297,11 +444,11 @@ def process_zero_files(df, red_path):
         zero_table = zero_table.sort_values('filename')
 
         zero_list = []
-        for index, row in zero_table.iterrows():
+        zero_tasks = []
+        for row in zero_table.itertuples():
 
             soi_merger.zero_file = None
             soi_merger.flat_file = None
-            soi_merger.clean = True
             zero_file = row.filename
 
             path, fname = os.path.split(zero_file)
@@ -310,20 +457,13 @@ def process_zero_files(df, red_path):
 
             zero_list.append(prefix + fname)
 
-            if os.path.exists(output_zero_file):
-                log.warning('Skipping existing file: {}'.format(
-                    output_zero_file))
-                continue
-
-            log.info('Processing ZERO file: {}'.format(zero_file))
-
-            data = soi_merger.merge(zero_file)
-            header = soi_merger.get_header(zero_file)
-
-            log.debug('Data format: {0[0]:d} x {0[1]:d}'.format(data.shape))
+            zero_tasks.append((copy.copy(soi_merger), zero_file,
+                               output_zero_file, 'ZERO'))
 
-            data, header, prefix = soi_merger.__reduce(data, header)
-            pyfits.writeto(output_zero_file, data, header)
+        zero_tasks = manifest.outdated(zero_tasks, log=log)
+        parallel.reduce_files(zero_tasks, jobs=jobs, log=log,
+                              profiler=profiler)
+        manifest.record_tasks(zero_tasks)
 
         zero_list_name = os.path.join(red_path, "0Zero{}x{}".format(bx, by))
 
@@ -334,28 +474,71 @@ def process_zero_files(df, red_path):
         log.info('Combining ZERO files.')
         master_zero = zero_list_name + '.fits'
 
-        if os.path.exists(master_zero):
+        zero_combine_files = [os.path.join(red_path, f) for f in zero_list]
+
+        if manifest.is_current(master_zero, zero_combine_files,
+                               {'combine': 'ZeroCombine'}):
             log.warning(
-                'Skipping existing MASTER ZERO: {:s}'.format(master_zero))
+                'Skipping up-to-date MASTER ZERO: {:s}'.format(master_zero))
 
         else:
 
             log.info("Writing master zero to: {}".format(master_zero))
-            zero_combine_files = [os.path.join(red_path, f) for f in zero_list]
 
             zero_combine = combine.ZeroCombine(input_list=zero_combine_files,
                                                output_file=master_zero)
-            zero_combine.run()
+            with profiler.stage('zero_combine', master_zero):
+                zero_combine.run()
+            manifest.record(master_zero, zero_combine_files,
+                            {'combine': 'ZeroCombine'})
             log.info('Done.')
 
         mask1 = df['obstype'].values != 'ZERO'
         mask2 = df['binning'].values == b
         df.loc[mask1 & mask2, 'zero_file'] = master_zero
 
+    manifest.save()
+
     return df
 
 
-def reduce(path, debug=False, quiet=False):
+def data_reduction(path, debug=False, quiet=False, jobs=1,
+                   dtype='float64', scan_threads=1, profiler=None,
+                   cosmic_ray_threads=1, recipe_file=None,
+                   cosmic_ray_mode=None):
+    """
+    Main method for SOI data reduction pipeline.
+
+    Args:
+         path (str) : path to the directory which contains the data.
+
+         debug (bool, optional) : enable debug mode (default = False).
+
+         quiet (bool, optional) : disable printing on screen (default = False).
+
+         jobs (int, optional) : number of frames reduced in parallel
+         (default = 1).
+
+         dtype (str, optional) : data type used to reduce the frames,
+         'float32' or 'float64' (default = 'float64').
+
+         scan_threads (int, optional) : number of raw files whose headers are
+         read at the same time (default = 1).
+
+         profiler (Profiler, optional) : records the time, I/O and memory
+         used by each step. A summary is logged at the end
+         (default = no profiling).
+
+         cosmic_ray_threads (int, optional) : number of tiles of each frame
+         cleaned at the same time by LACosmic (default = 1).
+
+         recipe_file (str, optional) : JSON file with the recipes that change
+         the steps run for each frame type (default = data/recipes.json).
+
+         cosmic_ray_mode (str, optional) : 'fast' cleans the cosmic rays with
+         a median filter instead of LACosmic, for quicklook (default = the
+         detector in the recipes).
+    """
 
     if debug:
         log.setLevel('DEBUG')
@@ -367,19 +550,39 @@ def reduce(path, debug=False, quiet=False):
     log.info('SOAR Imager Data-Reduction Pipeline')
     log.info('Version {}'.format(version.__str__))
 
+    if profiler is None:
+        profiler = profiling.NULL_PROFILER
+
+    recipes = load_recipes(recipe_file, cosmic_ray_mode=cosmic_ray_mode)
+
     reduced_path = create_reduced_folder(os.path.join(path, 'RED'))
+    manifest = Manifest(reduced_path)
 
     list_of_files = glob.glob(os.path.join(path, '*.fits'))
 
-    table = build_table(list_of_files)
+    with HeaderIndex(reduced_path) as header_index, profiler.stage('scan'):
+        table = build_table(list_of_files, header_index=header_index,
+                            scan_threads=scan_threads)
 
     table = filter_files(table)
 
-    table = process_zero_files(table, reduced_path)
+    table = process_zero_files(
+        table, reduced_path, jobs=jobs, dtype=dtype, manifest=manifest,
+        profiler=profiler, recipes=recipes)
+
+    table = process_flat_files(
+        table, reduced_path, jobs=jobs, dtype=dtype, manifest=manifest,
+        profiler=profiler, recipes=recipes)
+
+    table = process_bad_pixels(
+        table, reduced_path, manifest=manifest, profiler=profiler)
 
-    table = process_flat_files(table, reduced_path)
+    process_object_files(
+        table, reduced_path, jobs=jobs, dtype=dtype, manifest=manifest,
+        profiler=profiler, cosmic_ray_threads=cosmic_ray_threads,
+        recipes=recipes)
 
-    process_object_files(table, reduced_path)
+    profiler.log_summary(log)
 
 
 def filter_files(df):
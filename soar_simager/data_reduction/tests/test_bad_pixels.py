@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import glob
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from astropy.io import fits as pyfits
+
+from soar_simager.data_reduction import bad_pixels, reduce
+
+__author__ = 'Bruno Quint'
+
+
+class TestBadPixelMap(unittest.TestCase):
+
+    def test_repair_column(self):
+
+        data = np.tile(np.arange(20.), (10, 1))
+        data[2:8, 10] = 1e6
+
+        bad_pixel_map = bad_pixels.BadPixelMap(
+            data.shape, columns=[[10, 2, 8]])
+        bad_pixel_map.repair(data)
+
+        np.testing.assert_equal(data[:, 10], 10.)
+
+    def test_repair_line(self):
+
+        data = np.tile(np.arange(20.), (20, 1)).T
+        data[10, 3:15] = -1e6
+
+        bad_pixel_map = bad_pixels.BadPixelMap(
+            data.shape, lines=[[3, 15, 10]])
+        bad_pixel_map.repair(data)
+
+        np.testing.assert_equal(data[10], 10.)
+
+    def test_bad_neighbours_are_not_used(self):
+
+        data = np.zeros((10, 20))
+        data[:, 9:12] = 1e6
+        data[:, 0] = 1e6
+
+        bad_pixel_map = bad_pixels.BadPixelMap(
+            data.shape, columns=[[0, 0, 10], [9, 0, 10], [10, 0, 10],
+                                 [11, 0, 10]])
+        bad_pixel_map.repair(data)
+
+        np.testing.assert_equal(data, 0.)
+
+    def test_columns_only(self):
+
+        data = np.zeros((10, 10))
+        data[:, 4] = 1.
+        data[6, :] = 1.
+
+        bad_pixel_map = bad_pixels.BadPixelMap(
+            data.shape, columns=[[4, 0, 10]], lines=[[0, 10, 6]])
+        bad_pixel_map.repair(data, lines=False)
+
+        # The crossing pixel has no good neighbours along the line.
+        np.testing.assert_equal(np.delete(data[:, 4], 6), 0.)
+        np.testing.assert_equal(data[6], 1.)
+
+    def test_keeps_dtype(self):
+
+        data = np.ones((10, 10), dtype=np.float32)
+        data[:, 4] = 5.
+
+        bad_pixel_map = bad_pixels.BadPixelMap(
+            data.shape, columns=[[4, 0, 10]])
+
+        self.assertIs(bad_pixel_map.repair(data), data)
+        self.assertEqual(data.dtype, np.float32)
+        np.testing.assert_equal(data, 1.)
+
+    def test_shape_mismatch(self):
+
+        bad_pixel_map = bad_pixels.BadPixelMap((10, 10), columns=[[4, 0, 10]])
+
+        with self.assertRaises(ValueError):
+            bad_pixel_map.repair(np.zeros((10, 12)))
+
+
+class TestBadPixelFiles(unittest.TestCase):
+
+    def test_files(self):
+
+        filenames = glob.glob(os.path.join(
+            os.path.dirname(bad_pixels.get_filename('SAM', 4)), '*.json'))
+
+        self.assertGreater(len(filenames), 0)
+
+        for filename in filenames:
+
+            with open(filename) as f:
+                content = json.load(f)
+
+            self.assertEqual(
+                bad_pixels.get_filename(content['instrument'],
+                                        content['binning']),
+                filename)
+            self.assertLessEqual(content['version'], bad_pixels.MAP_VERSION)
+            self.assertEqual(content['shape'],
+                             [4096 // content['binning']] * 2)
+
+    def test_cached(self):
+
+        self.assertIs(bad_pixels.get_bad_pixel_map('SAM', 4),
+                      bad_pixels.get_bad_pixel_map('SAM', 4))
+        self.assertIsNone(bad_pixels.get_bad_pixel_map('SAM', 3))
+
+    def test_soi_reducer(self):
+
+        header = pyfits.Header()
+        header['CCDSUM'] = '2 2'
+
+        data = np.ones((2048, 2048))
+        data[:2047, 855] = 100.
+
+        reducer = reduce.SoiReducer()
+        data = reducer.clean_columns(data, header)
+        data = reducer.clean_lines(data, header)
+
+        np.testing.assert_equal(data, 1.)
+        self.assertIn('soi_2x2.json', str(header['HISTORY']))
+
+    def test_unknown_shape_is_skipped(self):
+
+        header = pyfits.Header()
+        header['CCDSUM'] = '4 4'
+
+        data = np.ones((100, 100))
+        data[:, 10] = 5.
+
+        reducer = reduce.SamiReducer()
+        data, header, prefix = reducer.clean_hot_columns_and_lines(
+            data, header, 'm_', True)
+
+        self.assertEqual(prefix, 'cm_')
+        self.assertEqual(data[0, 10], 5.)
+
+
+class TestDeriveBadPixelMap(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_master(self, filename, level, seed):
+
+        data = np.random.RandomState(seed).normal(
+            level, 5., size=(256, 256)).astype(np.float32)
+        data[:, 100] += 200.
+        data[:, 150:153] += 200.
+        data[40, 60] -= 500.
+
+        filename = os.path.join(self.path, filename)
+        pyfits.writeto(filename, data)
+
+        return filename
+
+    def test_from_mask(self):
+
+        mask = np.zeros((20, 20), dtype=bool)
+        mask[2:10, 5] = True
+        mask[15, 3:8] = True
+        mask[18, 18] = True
+
+        bad_pixel_map = bad_pixels.BadPixelMap.from_mask(mask)
+
+        self.assertEqual(bad_pixel_map.columns, [[5, 2, 10]])
+        self.assertEqual(bad_pixel_map.lines, [[3, 8, 15], [18, 19, 18]])
+        np.testing.assert_equal(bad_pixel_map.mask, mask)
+
+    def test_to_file(self):
+
+        filename = os.path.join(self.path, 'bad_pixels.json')
+
+        bad_pixel_map = bad_pixels.BadPixelMap(
+            (20, 20), columns=[[5, 2, 10]], lines=[[3, 8, 15]])
+        bad_pixel_map.to_file(filename, instrument='SAM', binning=4,
+                              derived_from=['0Zero4x4.fits'])
+
+        read_map = bad_pixels.read_bad_pixel_map(filename)
+
+        self.assertIs(read_map, bad_pixels.read_bad_pixel_map(filename))
+        self.assertEqual(read_map.name, 'bad_pixels.json')
+        self.assertEqual(read_map.version, bad_pixels.MAP_VERSION)
+        np.testing.assert_equal(read_map.mask, bad_pixel_map.mask)
+
+    def test_find_bad_pixels(self):
+
+        filename = self.make_master('zero.fits', 0., 1)
+        mask = bad_pixels.find_bad_pixels(pyfits.getdata(filename))
+
+        expected = np.zeros_like(mask)
+        expected[:, 100] = True
+        expected[:, 150:153] = True
+        expected[40, 60] = True
+
+        np.testing.assert_equal(mask, expected)
+
+    def test_derive_bad_pixel_map(self):
+
+        master_files = [self.make_master('zero.fits', 0., 1),
+                        self.make_master('flat.fits', 1000., 2)]
+        output_file = os.path.join(self.path, '2BadPixels4x4.json')
+
+        bad_pixel_map = bad_pixels.derive_bad_pixel_map(
+            output_file, master_files)
+
+        with open(output_file) as f:
+            content = json.load(f)
+
+        self.assertEqual(content['derived_from'], ['zero.fits', 'flat.fits'])
+        self.assertEqual(bad_pixel_map.n_pixels, 4 * 256 + 1)
+
+        header = pyfits.Header()
+        header['CCDSUM'] = '4 4'
+
+        data = np.random.RandomState(3).normal(size=(256, 256))
+        data[:, 100] += 200.
+
+        reducer = reduce.SamiReducer(bad_pixel_file=output_file)
+        data = reducer.clean_bad_pixels(data, header)
+
+        self.assertLess(np.abs(data[:, 100]).max(), 5.)
+        self.assertIn(output_file, reducer.get_master_files())
+
+        with self.assertRaises(ValueError):
+            bad_pixels.derive_bad_pixel_map(output_file, [])
+
+    def test_cosmic_rays_are_not_bad_pixels(self):
+
+        master_files = [self.make_master('zero.fits', 0., 1),
+                        self.make_master('flat.fits', 1000., 2)]
+
+        # Isolated hits left in a master DARK.
+        rng = np.random.RandomState(4)
+        data = pyfits.getdata(self.make_master('dark.fits', 10., 3))
+        y, x = rng.randint(0, 256, 50), rng.randint(0, 90, 50)
+        data[y, x] += rng.uniform(500., 5000., 50)
+        master_files.append(os.path.join(self.path, 'dark_hits.fits'))
+        pyfits.writeto(master_files[-1], data)
+
+        self.assertGreaterEqual(
+            bad_pixels.find_bad_pixels(data).sum(), 4 * 256 + 1 + 40)
+
+        bad_pixel_map = bad_pixels.derive_bad_pixel_map(
+            os.path.join(self.path, '2BadPixels4x4.json'), master_files)
+
+        self.assertEqual(bad_pixel_map.n_pixels, 4 * 256 + 1)
+        self.assertFalse(bad_pixel_map.mask[y, x].any())
+
+    def test_columns_need_several_masters(self):
+
+        master_files = [self.make_master('zero.fits', 0., 1)]
+
+        # Two FLATs with vignetted edges, the two central columns moved to
+        # the right edge and a column that is only bad in one of them.
+        x = np.arange(256)
+        for i in range(2):
+            data = pyfits.getdata(self.make_master(
+                'raw_flat{:d}.fits'.format(i), 1000., 2 + i))
+            data *= 1. - 0.1 * ((x - 127.5) / 127.5) ** 2
+            data[:, -2:] = 1000.
+            if i == 0:
+                data[:, 200] += 200.
+
+            header = pyfits.Header()
+            header['OBSTYPE'] = 'SFLAT'
+            master_files.append(
+                os.path.join(self.path, 'flat{:d}.fits'.format(i)))
+            pyfits.writeto(master_files[-1], data, header)
+
+        self.assertTrue(bad_pixels.find_bad_pixels(data)[:, -2:].all())
+
+        bad_pixel_map = bad_pixels.derive_bad_pixel_map(
+            os.path.join(self.path, '2BadPixels4x4.json'), master_files)
+
+        self.assertEqual(bad_pixel_map.n_pixels, 4 * 256 + 1)
+        self.assertFalse(bad_pixel_map.mask[:, 200].any())
+        self.assertFalse(bad_pixel_map.mask[:, -bad_pixels.WIDTH:].any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from soar_simager.data_reduction import parallel, reduce
+from soar_simager.data_reduction.buffers import FramePool, frame_pool
+from soar_simager.tools import synthetic
+
+__author__ = 'Bruno Quint'
+
+
+class TestFramePool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FramePool(maxsize=2)
+
+    def test_reuse_released_buffer(self):
+
+        buffer = self.pool.get((10, 12), dtype=np.float32)
+        self.assertEqual(buffer.shape, (10, 12))
+        self.assertEqual(buffer.dtype, np.float32)
+
+        self.assertTrue(self.pool.release(buffer))
+        self.assertEqual(len(self.pool), 1)
+
+        self.assertIs(self.pool.get((10, 12), dtype=np.float32), buffer)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_keyed_by_shape_and_dtype(self):
+
+        buffer = self.pool.get((10, 12))
+        self.pool.release(buffer)
+
+        self.assertIsNot(self.pool.get((12, 10)), buffer)
+        self.assertIsNot(self.pool.get((10, 12), dtype=np.float32), buffer)
+        self.assertIs(self.pool.get((10, 12)), buffer)
+
+    def test_ignore_other_arrays(self):
+
+        buffer = self.pool.get((10, 12))
+
+        self.assertFalse(self.pool.release(np.empty((10, 12))))
+        self.assertFalse(self.pool.release(buffer[:5]))
+        self.assertFalse(self.pool.release(None))
+
+        self.assertTrue(self.pool.release(buffer))
+        self.assertFalse(self.pool.release(buffer))
+        self.assertEqual(len(self.pool), 1)
+
+    def test_maxsize(self):
+
+        buffers = [self.pool.get((4, 4)) for i in range(3)]
+
+        self.assertEqual([self.pool.release(b) for b in buffers],
+                         [True, True, False])
+        self.assertEqual(len(self.pool), 2)
+
+        self.pool.clear()
+        self.assertEqual(len(self.pool), 0)
+
+    def test_forget_freed_buffers(self):
+
+        self.pool.get((4, 4))
+        gc.collect()
+
+        self.assertEqual(self.pool._lent, {})
+
+
+class TestReduceFileReuse(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        frame_pool.clear()
+
+    def tearDown(self):
+        frame_pool.clear()
+        shutil.rmtree(self.path)
+
+    def reduce(self, i):
+
+        input_file = os.path.join(self.path, 'raw{:d}.fits'.format(i))
+        output_file = os.path.join(self.path, 'm_raw{:d}.fits'.format(i))
+        synthetic.write_frame(input_file, binning=4, seed=i)
+
+        parallel.reduce_file(reduce.SamiReducer(), input_file, output_file)
+
+    def test_reuse_between_frames(self):
+
+        self.reduce(0)
+        self.assertEqual(len(frame_pool), 1)
+
+        buffer = frame_pool.get((1024, 1024))
+        frame_pool.release(buffer)
+
+        self.reduce(1)
+        self.assertEqual(len(frame_pool), 1)
+        self.assertIs(frame_pool.get((1024, 1024)), buffer)
+
+
+if __name__ == '__main__':
+    unittest.main()
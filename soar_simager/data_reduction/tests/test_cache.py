@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from soar_simager.data_reduction.cache import CalibrationCache
+from soar_simager.io import pyfits
+
+__author__ = 'Bruno Quint'
+
+
+class TestCalibrationCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        self.cache = CalibrationCache(maxsize=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write_master(self, name, value, exptime=10.):
+
+        filename = os.path.join(self.path, name)
+        header = pyfits.Header()
+        header['EXPTIME'] = exptime
+        pyfits.writeto(filename, np.full((4, 4), value, dtype=float),
+                       header=header, overwrite=True)
+
+        return filename
+
+    def test_reuse_loaded_master(self):
+
+        filename = self.write_master('zero.fits', 100.)
+
+        zero = self.cache.get_zero(filename)
+
+        self.assertEqual(zero.dtype, np.float32)
+        self.assertFalse(zero.flags.writeable)
+        self.assertIs(zero, self.cache.get_zero(filename))
+
+    def test_dark_is_normalized(self):
+
+        filename = self.write_master('dark.fits', 50., exptime=25.)
+        np.testing.assert_equal(self.cache.get_dark(filename), 2.)
+
+    def test_reload_modified_master(self):
+
+        filename = self.write_master('flat.fits', 1.)
+        self.cache.get_flat(filename)
+
+        filename = self.write_master('flat.fits', 2.)
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        np.testing.assert_equal(self.cache.get_flat(filename), 2.)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_least_recently_used_is_evicted(self):
+
+        files = [self.write_master('zero{:d}.fits'.format(i), i)
+                 for i in range(3)]
+
+        first = self.cache.get_zero(files[0])
+        self.cache.get_zero(files[1])
+        self.cache.get_zero(files[0])
+        self.cache.get_zero(files[2])
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIs(first, self.cache.get_zero(files[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,18 @@
 #!/usr/bin/env python 
 # -*- coding: utf8 -*-
 
+import ccdproc
 import unittest
 import numpy as np
 import os
+import shutil
+import tempfile
 
 from ccdproc import Combiner, CCDData
 
+from soar_simager.data_reduction import combine
+from soar_simager.io import pyfits
+
 __author__ = 'Bruno Quint'
 
 
@@ -40,5 +46,104 @@ class TestZeroCombine(unittest.TestCase):
 
         np.testing.assert_equal(combined_data.data, ccd1.data)
 
+class TestCombineFiles(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        self.input_list = []
+
+        for i in range(5):
+            data = np.random.normal(1000. * (i + 1), 10., size=(40, 30))
+            if i == 0:
+                data[5, 7] = 1e6
+            filename = os.path.join(self.path, 'f{:d}.fits'.format(i))
+            pyfits.writeto(filename, data)
+            self.input_list.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_average_same_as_ccdproc(self):
+
+        expected = ccdproc.combine(
+            self.input_list, method='average', minmax_clip=True, unit='adu')
+
+        # A tiny memory budget forces the engine to use many bands
+        combined = combine.combine_files(
+            self.input_list, method='average', minmax_clip=True,
+            mem_limit=2000)
+
+        np.testing.assert_allclose(combined, expected.data, rtol=1e-12)
+
+    def test_median_same_as_ccdproc(self):
+
+        expected = ccdproc.combine(
+            self.input_list, method='median', sigma_clip=True, unit='adu',
+            scale=combine.scale_flat_sami)
+
+        combined = combine.combine_files(
+            self.input_list, method='median', sigma_clip=True,
+            scale=combine.scale_flat_sami, mem_limit=2000)
+
+        np.testing.assert_allclose(combined, expected.data, rtol=1e-12)
+
+    def test_minmax_thresholds(self):
+
+        combined = combine.combine_files(
+            self.input_list, method='average', minmax_clip=True,
+            minmax_clip_max=1e5)
+
+        self.assertAlmostEqual(combined[5, 7], 3500., delta=50.)
+
+    def test_reject_extrema(self):
+
+        combined = combine.combine_files(
+            self.input_list, method='average', n_low=1, n_high=1,
+            mem_limit=2000)
+
+        self.assertAlmostEqual(combined[5, 7], 4000., delta=50.)
+        self.assertAlmostEqual(np.median(combined), 3000., delta=5.)
+
+    def test_reject_extrema_needs_enough_values(self):
+
+        stack = np.array([[[1., 1.]], [[2., np.nan]], [[7., 5.]]])
+        combine.reject_extrema(stack, 1, 1)
+
+        np.testing.assert_equal(stack[:, 0, 0], [np.nan, 2., np.nan])
+        np.testing.assert_equal(stack[:, 0, 1], [1., 5., np.nan])
+
+
+class TestMasterCombine(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_cosmic_rays_are_rejected(self):
+
+        rng = np.random.RandomState(0)
+        header = pyfits.Header()
+        header['CCDSUM'] = '4 4'
+
+        input_list = []
+        for i in range(5):
+            data = rng.normal(1000., 5., size=(40, 30))
+            if i == 2:
+                data[10:12, 20] += 5000.
+            input_list.append(os.path.join(self.path, '{:d}.fits'.format(i)))
+            pyfits.writeto(input_list[-1], data, header)
+
+        for combiner in [combine.ZeroCombine, combine.DarkCombine]:
+
+            output_file = os.path.join(self.path, 'master.fits')
+            combiner(input_list, output_file=output_file).run()
+
+            master = pyfits.getdata(output_file)
+            self.assertLess(np.abs(master - 1000.).max(), 20.)
+
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
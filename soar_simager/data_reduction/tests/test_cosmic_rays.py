@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from astropy.io import fits as pyfits
+
+from soar_simager.data_reduction import cosmic_rays, reduce
+
+__author__ = 'Bruno Quint'
+
+
+def make_frame(shape=(300, 260), n_hits=100, seed=0):
+
+    rng = np.random.RandomState(seed)
+    data = rng.normal(1000., 20., size=shape)
+
+    y = rng.randint(0, shape[0], n_hits)
+    x = rng.randint(0, shape[1], n_hits)
+    data[y, x] += rng.uniform(2000., 20000., n_hits)
+
+    return data, y, x
+
+
+class TestGetTiles(unittest.TestCase):
+
+    def test_cover_the_frame(self):
+
+        shape = (300, 260)
+        count = np.zeros(shape, dtype=int)
+
+        for outer, inner, center in cosmic_rays.get_tiles(
+                shape, tile_size=100, overlap=16):
+
+            count[inner] += 1
+
+            tile = np.empty(shape)[outer]
+            self.assertEqual(tile[center].shape,
+                             count[inner].shape)
+
+        np.testing.assert_equal(count, 1)
+
+    def test_overlap(self):
+
+        tiles = cosmic_rays.get_tiles((300, 300), tile_size=100, overlap=16)
+
+        self.assertEqual(len(tiles), 9)
+
+        outer, inner, center = tiles[4]
+        self.assertEqual(outer, (slice(84, 216), slice(84, 216)))
+        self.assertEqual(inner, (slice(100, 200), slice(100, 200)))
+        self.assertEqual(center, (slice(16, 116), slice(16, 116)))
+
+
+class TestLACosmic(unittest.TestCase):
+
+    def test_tiled_is_equivalent(self):
+
+        data, y, x = make_frame()
+
+        cleaned, mask = cosmic_rays.lacosmic(data)
+        tiled_cleaned, tiled_mask = cosmic_rays.lacosmic(
+            data, tile_size=100, threads=2)
+
+        self.assertGreater(mask[y, x].mean(), 0.9)
+
+        n_different = np.count_nonzero(
+            (mask != tiled_mask) | ~np.isclose(cleaned, tiled_cleaned))
+
+        self.assertLessEqual(n_different / data.size,
+                             cosmic_rays.TILED_TOLERANCE)
+
+    def test_large_tiles_use_the_full_frame(self):
+
+        data, _, _ = make_frame(shape=(64, 64), n_hits=10)
+
+        cleaned, mask = cosmic_rays.lacosmic(data)
+        tiled_cleaned, tiled_mask = cosmic_rays.lacosmic(
+            data, tile_size=64, threads=2)
+
+        np.testing.assert_equal(tiled_cleaned, cleaned)
+        np.testing.assert_equal(tiled_mask, mask)
+
+
+class TestFast(unittest.TestCase):
+
+    def test_detection(self):
+
+        data, y, x = make_frame()
+
+        cleaned, mask = cosmic_rays.fast(data)
+        _, lacosmic_mask = cosmic_rays.lacosmic(data)
+
+        self.assertGreaterEqual(mask[y, x].mean(),
+                                lacosmic_mask[y, x].mean() - 0.01)
+        self.assertLess(np.abs(cleaned[y, x] - 1000.).max(), 100.)
+        self.assertLess(mask.sum(), 2 * len(y))
+
+    def test_stars_are_kept(self):
+
+        yy, xx = np.mgrid[:64, :64]
+        data = 1000. + 5e4 * np.exp(
+            -((yy - 32.) ** 2 + (xx - 30.) ** 2) / (2 * 1.3 ** 2))
+        data += np.random.RandomState(1).normal(0., 20., data.shape)
+        data[10, 50] += 5000.
+
+        cleaned, mask = cosmic_rays.fast(data)
+
+        self.assertTrue(mask[10, 50])
+        self.assertFalse(mask[28:37, 26:35].any())
+        np.testing.assert_equal(cleaned[~mask], data[~mask])
+
+    def test_keeps_dtype(self):
+
+        data, _, _ = make_frame(shape=(64, 64), n_hits=10)
+        data = data.astype(np.float32)
+
+        cleaned, _ = cosmic_rays.fast(data)
+        self.assertEqual(cleaned.dtype, np.float32)
+
+
+def make_sequence(offsets, shape=(200, 180), n_hits=40, seed=0):
+
+    rng = np.random.RandomState(seed)
+    margin = np.abs(offsets).max()
+    ny, nx = shape[0] + 2 * margin, shape[1] + 2 * margin
+
+    yy, xx = np.mgrid[:ny, :nx]
+    field = np.full((ny, nx), 1000.)
+    for y, x in rng.uniform(margin, [ny - margin, nx - margin], (20, 2)):
+        field += 3e4 * np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 3.4)
+
+    # The pixel (y, x) of the first frame is (y + dy, x + dx) in the others.
+    frames, hits, fields = [], [], []
+    for dy, dx in offsets:
+        fields.append(field[margin - dy:margin - dy + shape[0],
+                            margin - dx:margin - dx + shape[1]])
+        frame = rng.normal(fields[-1], np.sqrt(fields[-1] / 2.6))
+
+        y = rng.randint(0, shape[0], n_hits)
+        x = rng.randint(0, shape[1], n_hits)
+        frame[y, x] += rng.uniform(2000., 20000., n_hits)
+
+        frames.append(frame)
+        hits.append((y, x))
+
+    return frames, hits, fields
+
+
+def covered(offsets, shape, j, y, x):
+    """True on the pixels of frame j seen by all the frames."""
+    inside = np.ones(y.shape, dtype=bool)
+
+    for dy, dx in offsets - offsets[j]:
+        inside &= (y + dy >= 0) & (y + dy < shape[0]) & \
+            (x + dx >= 0) & (x + dx < shape[1])
+
+    return inside
+
+
+class TestStack(unittest.TestCase):
+
+    def check(self, offsets):
+
+        offsets = np.array(offsets)
+        frames, hits, fields = make_sequence(offsets)
+        original = [f.copy() for f in frames]
+
+        n_flagged = cosmic_rays.stack(frames, offsets=offsets, rows=64)
+
+        for j, (frame, before, (y, x), field, n) in enumerate(
+                zip(frames, original, hits, fields, n_flagged)):
+
+            changed = frame != before
+
+            inside = covered(offsets, frame.shape, j, y, x)
+            y, x = y[inside], x[inside]
+
+            self.assertEqual(changed.sum(), n)
+            self.assertGreater(changed[y, x].mean(), 0.9)
+            self.assertLess(n, 2 * len(y))
+            self.assertLess(np.abs(frame - field)[changed].max(), 500.)
+
+    def test_aligned(self):
+        self.check([(0, 0)] * 4)
+
+    def test_dithered(self):
+        self.check([(0, 0), (5, -7), (-9, 3)])
+
+    def test_stars_are_kept(self):
+
+        offsets = np.array([(0, 0), (5, -7), (-9, 3)])
+        frames, _, _ = make_sequence(offsets, n_hits=0)
+        original = [f.copy() for f in frames]
+
+        self.assertEqual(cosmic_rays.stack(frames, offsets=offsets),
+                         [0, 0, 0])
+        np.testing.assert_equal(frames, original)
+
+    def test_too_few_frames(self):
+
+        frames, _, _ = make_sequence([(0, 0)] * 2)
+
+        with self.assertRaises(ValueError):
+            cosmic_rays.stack(frames)
+
+
+class TestRejectInStack(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_files(self):
+
+        offsets = [(0, 0), (4, 6), (-6, 2)]
+        frames, hits, fields = make_sequence(offsets)
+        filenames = []
+
+        for i, ((dy, dx), frame) in enumerate(zip(offsets, frames)):
+
+            header = pyfits.Header()
+            header['OBSTYPE'] = 'OBJECT'
+            header['CCDSUM'] = '4 4'
+            header['PIXSCAL1'] = header['PIXSCAL2'] = 0.0455
+            header['DECPANGL'] = 0.
+            header['RA'] = '10:00:00'
+            header['DEC'] = '00:00:00'
+
+            _, header = reduce.Reducer.create_wcs(frame, header)
+
+            # The same sky is seen by pixels moved by (dy, dx).
+            header['CRPIX1'] += dx
+            header['CRPIX2'] += dy
+
+            filenames.append(os.path.join(self.path, '{:d}.fits'.format(i)))
+            pyfits.writeto(filenames[-1], frame, header)
+
+        np.testing.assert_equal(
+            cosmic_rays.get_offsets([pyfits.getheader(f) for f in filenames]),
+            offsets)
+
+        n_flagged = cosmic_rays.reject_in_stack(filenames)
+
+        for j, (filename, (y, x), field, n) in enumerate(
+                zip(filenames, hits, fields, n_flagged)):
+
+            data, header = pyfits.getdata(filename, header=True)
+
+            inside = covered(np.array(offsets), data.shape, j, y, x)
+            y, x = y[inside], x[inside]
+
+            changed = data != frames[j]
+
+            self.assertEqual(changed.sum(), n)
+            self.assertGreater(changed[y, x].mean(), 0.9)
+            self.assertLess(np.abs(data - field)[changed].max(), 500.)
+            self.assertIn('aligned frames', str(header['HISTORY']))
+
+    def test_no_wcs(self):
+
+        with self.assertRaises(ValueError):
+            cosmic_rays.get_offsets([pyfits.Header()] * 3)
+
+
+class TestReducerTiles(unittest.TestCase):
+
+    def test_tile_size(self):
+
+        self.assertIsNone(reduce.Reducer().get_cosmic_ray_tile_size())
+        self.assertEqual(
+            reduce.Reducer(cosmic_ray_threads=4).get_cosmic_ray_tile_size(),
+            cosmic_rays.TILE_SIZE)
+        reducer = reduce.Reducer(cosmic_ray_tile_size=512)
+        self.assertEqual(reducer.get_cosmic_ray_tile_size(), 512)
+
+    def test_options(self):
+
+        reducer = reduce.Reducer(cosmic_rays=True)
+        self.assertNotIn('cosmic_ray_tile_size', reducer.get_options())
+
+        reducer = reduce.Reducer(cosmic_rays=True, cosmic_ray_threads=2)
+        self.assertEqual(reducer.get_options()['cosmic_ray_tile_size'],
+                         cosmic_rays.TILE_SIZE)
+
+        reducer = reduce.Reducer(cosmic_ray_threads=2)
+        self.assertNotIn('cosmic_ray_tile_size', reducer.get_options())
+
+        reducer = reduce.Reducer(cosmic_rays='fast', cosmic_ray_threads=2)
+        self.assertEqual(reducer.get_options()['cosmic_rays'], 'fast')
+        self.assertNotIn('cosmic_ray_tile_size', reducer.get_options())
+
+        reducer = reduce.Reducer(cosmic_rays='stack')
+        self.assertEqual(reducer.get_options()['cosmic_rays'], 'stack')
+
+    def test_fast_mode(self):
+
+        data, y, x = make_frame(shape=(64, 64), n_hits=10)
+        header = pyfits.Header()
+
+        cleaned, header, _ = reduce.Reducer.remove_cosmic_rays(
+            data, header, 'm_', 'fast')
+
+        self.assertLess(np.abs(cleaned[y, x] - 1000.).max(), 100.)
+        self.assertIn('median filter', str(header['HISTORY']))
+
+        with self.assertRaises(ValueError):
+            reduce.Reducer.remove_cosmic_rays(data, header, 'm_', 'slow')
+
+    def test_stack_mode(self):
+
+        data, _, _ = make_frame(shape=(64, 64), n_hits=10)
+
+        cleaned, _, _ = reduce.Reducer.remove_cosmic_rays(
+            data.copy(), pyfits.Header(), 'm_', 'stack')
+
+        np.testing.assert_equal(cleaned, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
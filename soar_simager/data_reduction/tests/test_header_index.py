@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+from soar_simager.data_reduction import night
+from soar_simager.data_reduction.header_index import HeaderIndex
+from soar_simager.data_reduction.tests.test_night import write_raw_file
+
+__author__ = 'Bruno Quint'
+
+
+class TestHeaderIndex(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'raw.fits')
+
+        data = np.random.randint(0, 2 ** 16, size=(64, 64)).astype(np.uint16)
+        write_raw_file(self.filename, data)
+
+        self.index = HeaderIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.path)
+
+    def test_store_and_reuse(self):
+
+        self.assertIsNone(self.index.get(self.filename))
+
+        info = self.index.read_file_info(self.filename)
+        self.assertEqual(info, night.read_file_info(self.filename))
+        self.assertEqual(len(self.index), 1)
+
+        self.assertEqual(self.index.get(self.filename), info)
+
+    def test_persistent(self):
+
+        info = self.index.read_file_info(self.filename)
+        self.index.close()
+
+        self.index = HeaderIndex(self.path)
+        self.assertEqual(self.index.get(self.filename), info)
+
+    def test_modified_file(self):
+
+        self.index.read_file_info(self.filename)
+
+        os.remove(self.filename)
+        write_raw_file(self.filename, np.zeros((64, 64), dtype=np.uint16))
+        stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+        self.assertIsNone(self.index.get(self.filename))
+        self.assertTrue(self.index.read_file_info(self.filename)['bad_data'])
+
+    def test_unchecked_entry(self):
+
+        self.index.read_file_info(self.filename, check_data=False)
+
+        self.assertIsNotNone(self.index.get(self.filename, check_data=False))
+        self.assertIsNone(self.index.get(self.filename, check_data=True))
+
+    def test_read_many_files(self):
+
+        other = os.path.join(self.path, 'other.fits')
+        write_raw_file(other, np.zeros((64, 64), dtype=np.uint16))
+        missing = os.path.join(self.path, 'missing.fits')
+
+        self.index.read_file_info(self.filename)
+
+        infos = self.index.read_files_info(
+            [other, missing, self.filename], threads=2)
+
+        self.assertTrue(infos[0]['bad_data'])
+        self.assertIsNone(infos[1])
+        self.assertEqual(infos[2]['filename'], self.filename)
+        self.assertEqual(len(self.index), 2)
+
+    def test_committed(self):
+
+        self.index.read_files_info([self.filename])
+
+        # Seen by another connection while the index is still open.
+        connection = sqlite3.connect(os.path.join(self.path, 'headers.sqlite'))
+        count, = connection.execute('SELECT COUNT(*) FROM files').fetchone()
+        connection.close()
+
+        self.assertEqual(count, 1)
+
+    def test_old_index(self):
+
+        self.index.close()
+        os.remove(os.path.join(self.path, 'headers.sqlite'))
+
+        connection = sqlite3.connect(os.path.join(self.path, 'headers.sqlite'))
+        connection.execute('CREATE TABLE files (filename TEXT PRIMARY KEY, '
+                           'size INTEGER, mtime INTEGER, checked INTEGER, '
+                           'bad_data INTEGER, obstype TEXT)')
+        connection.commit()
+        connection.close()
+
+        self.index = HeaderIndex(self.path)
+
+        info = self.index.read_file_info(self.filename)
+        self.assertEqual(info['object'], 'NGC 2070')
+        self.assertEqual(self.index.get(self.filename), info)
+
+    def test_query(self):
+
+        self.index.read_file_info(self.filename)
+        filename = os.path.abspath(self.filename)
+
+        self.assertEqual(self.index.query(obstype='OBJECT'), [filename])
+        self.assertEqual(self.index.query(binning='4 4', filters='c0002'),
+                         [filename])
+        self.assertEqual(self.index.query(obstype='ZERO'), [])
+        self.assertEqual(self.index.query(object='NGC 2070'), [filename])
+
+        with self.assertRaises(KeyError):
+            self.index.query(exptime=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
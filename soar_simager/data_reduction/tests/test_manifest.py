@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from soar_simager.data_reduction.manifest import Manifest
+from soar_simager.data_reduction.reduce import Reducer
+
+__author__ = 'Bruno Quint'
+
+
+def write_file(filename, content):
+
+    with open(filename, 'wb') as f:
+        f.write(content)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+
+        self.raw = os.path.join(self.path, 'raw.fits')
+        self.master = os.path.join(self.path, 'master.fits')
+        self.output = os.path.join(self.path, 'm_raw.fits')
+
+        write_file(self.raw, b'raw data')
+        write_file(self.master, b'master data')
+        write_file(self.output, b'reduced data')
+
+        self.options = {'clean': False}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def record(self, manifest):
+        manifest.record(self.output, [self.raw], self.options,
+                        masters=[self.master])
+
+    def is_current(self, manifest, options=None):
+        return manifest.is_current(
+            self.output, [self.raw], options or self.options,
+            masters=[self.master])
+
+    def test_missing_entry(self):
+
+        manifest = Manifest(self.path)
+        self.assertFalse(self.is_current(manifest))
+
+        self.record(manifest)
+        self.assertTrue(self.is_current(manifest))
+
+    def test_save_and_load(self):
+
+        manifest = Manifest(self.path)
+        self.record(manifest)
+        manifest.save()
+
+        self.assertTrue(self.is_current(Manifest(self.path)))
+
+    def test_changed_options(self):
+
+        manifest = Manifest(self.path)
+        self.record(manifest)
+
+        self.assertFalse(self.is_current(manifest, options={'clean': True}))
+
+    def test_changed_input(self):
+
+        manifest = Manifest(self.path)
+        self.record(manifest)
+
+        write_file(self.raw, b'new raw data')
+        self.assertFalse(self.is_current(manifest))
+
+    def test_missing_output(self):
+
+        manifest = Manifest(self.path)
+        self.record(manifest)
+
+        os.remove(self.output)
+        self.assertFalse(self.is_current(manifest))
+
+    def test_rewritten_master(self):
+
+        manifest = Manifest(self.path)
+        self.record(manifest)
+
+        stat = os.stat(self.master)
+
+        write_file(self.master, b'master data')
+        mtime = stat.st_mtime_ns + 10 ** 9
+        os.utime(self.master, ns=(stat.st_atime_ns, mtime))
+        self.assertTrue(self.is_current(manifest))
+
+        write_file(self.master, b'master DATA')
+        os.utime(self.master, ns=(stat.st_atime_ns, mtime + 10 ** 9))
+        self.assertFalse(self.is_current(manifest))
+
+    def test_outdated_tasks(self):
+
+        manifest = Manifest(self.path)
+
+        reducer = Reducer(zero_file=self.master)
+        tasks = [(reducer, self.raw, self.output, 'OBJECT')]
+
+        self.assertEqual(manifest.outdated(tasks), tasks)
+
+        manifest.record_tasks(tasks)
+        self.assertEqual(manifest.outdated(tasks), [])
+
+        reducer = Reducer(zero_file=self.master, time=True)
+        tasks = [(reducer, self.raw, self.output, 'OBJECT')]
+        self.assertEqual(manifest.outdated(tasks), tasks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from unittest import mock
+
+import numpy as np
+
+from soar_simager.data_reduction import night
+from soar_simager.io import cards, pyfits
+
+__author__ = 'Bruno Quint'
+
+
+def write_raw_file(filename, data):
+
+    hdul = pyfits.HDUList()
+    hdul.append(pyfits.PrimaryHDU())
+
+    hdul[0].header['OBSTYPE'] = 'OBJECT'
+    hdul[0].header['INSTRUME'] = ' sam '
+    hdul[0].header['OBJECT'] = 'NGC 2070'
+    hdul[0].header['FILTERS'] = 'c0002'
+    hdul[0].header['FILTER1'] = 'gunn_r'
+    hdul[0].header['FILTER2'] = 'EMPTY'
+
+    hdu = pyfits.ImageHDU(data=data)
+    hdu.header['CCDSUM'] = '4 4 '
+    hdul.append(hdu)
+
+    hdul.writeto(filename)
+
+
+class TestReadFileInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_read_keywords(self):
+
+        filename = os.path.join(self.path, 'good.fits')
+        data = np.random.randint(0, 2 ** 16, size=(64, 64)).astype(np.uint16)
+        write_raw_file(filename, data)
+
+        info = night.read_file_info(filename)
+
+        self.assertEqual(info['filename'], filename)
+        self.assertEqual(info['obstype'], 'OBJECT')
+        self.assertEqual(info['instrume'], 'SAM')
+        self.assertEqual(info['filters'], 'c0002')
+        self.assertEqual(info['binning'], '4 4')
+        self.assertFalse(info['bad_data'])
+
+    def test_flag_bad_data(self):
+
+        filename = os.path.join(self.path, 'bad.fits')
+        write_raw_file(filename, np.zeros((64, 64), dtype=np.uint16))
+
+        info = night.read_file_info(filename)
+        self.assertTrue(info['bad_data'])
+
+        info = night.read_file_info(filename, check_data=False)
+        self.assertFalse(info['bad_data'])
+
+    def test_astropy_fallback(self):
+
+        filename = os.path.join(self.path, 'good.fits')
+        data = np.random.randint(0, 2 ** 16, size=(64, 64)).astype(np.uint16)
+        write_raw_file(filename, data)
+
+        def read_headers(*args):
+            raise cards.CardParseError('Unsupported card.')
+
+        with mock.patch.object(cards, 'read_headers', read_headers):
+            info = night.read_file_info(filename)
+
+        self.assertEqual(info, night.read_file_info(filename))
+
+    def test_strided_sample(self):
+
+        data = np.zeros((64, 64))
+        data[1::2, 1::2] = 1.
+
+        self.assertFalse(night.has_valid_data(data, stride=2))
+        self.assertTrue(night.has_valid_data(data, stride=1))
+
+
+class TestReadFilesInfo(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        self.list_of_files = []
+
+        for i in range(8):
+            filename = os.path.join(self.path, 'raw{:d}.fits'.format(i))
+            data = np.random.randint(0, 2 ** 16, size=(64, 64))
+            write_raw_file(filename, data.astype(np.uint16))
+            self.list_of_files.append(filename)
+
+        self.list_of_files.append(os.path.join(self.path, 'missing.fits'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_serial(self):
+
+        infos = night.read_files_info(self.list_of_files)
+
+        self.assertIsNone(infos[-1])
+        self.assertEqual([i['filename'] for i in infos[:-1]],
+                         self.list_of_files[:-1])
+
+    def test_threads_with_latency(self):
+
+        read_file_info = night.read_file_info
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def slow_read_file_info(filename, **kwargs):
+
+            with lock:
+                running.append(filename)
+                max_running.append(len(running))
+
+            time.sleep(0.05)
+
+            with lock:
+                running.remove(filename)
+
+            return read_file_info(filename, **kwargs)
+
+        with mock.patch.object(night, 'read_file_info', slow_read_file_info):
+            infos = night.read_files_info(self.list_of_files, threads=4)
+
+        self.assertGreater(max(max_running), 1)
+        self.assertIsNone(infos[-1])
+        self.assertEqual(infos[:-1],
+                         night.read_files_info(self.list_of_files[:-1]))
+
+
+class TestBuildDataframe(unittest.TestCase):
+
+    columns = ['filename', 'obstype', 'binning', 'zero_file']
+
+    def test_schema(self):
+
+        records = [
+            {'filename': 'a.fits', 'obstype': 'ZERO', 'binning': '4 4',
+             'zero_file': None},
+            {'filename': 'b.fits', 'obstype': 'OBJECT', 'binning': '4 4',
+             'zero_file': None},
+        ]
+
+        table = night.build_dataframe(records, columns=self.columns)
+
+        self.assertEqual(list(table.columns), self.columns)
+        self.assertEqual(table.obstype.dtype, 'category')
+        self.assertEqual(table.binning.dtype, 'category')
+        self.assertEqual(table.zero_file.dtype, object)
+        self.assertIsNone(next(table.itertuples()).zero_file)
+
+    def test_empty(self):
+
+        table = night.build_dataframe([], columns=self.columns)
+
+        self.assertEqual(len(table.index), 0)
+        self.assertEqual(list(table.columns), self.columns)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from soar_simager.data_reduction import parallel
+from soar_simager.io import pyfits
+
+__author__ = 'Bruno Quint'
+
+
+class DummyReducer:
+    """Picklable reducer that only scales the primary data."""
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def reduce(self, filename, prefix=""):
+        data, header = pyfits.getdata(filename, header=True)
+        return data * self.factor, header, 'm_'
+
+
+class TestReduceFiles(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        self.tasks = []
+
+        for i in range(4):
+            input_file = os.path.join(self.path, 'raw{:d}.fits'.format(i))
+            output_file = os.path.join(self.path, 'm_raw{:d}.fits'.format(i))
+            pyfits.writeto(input_file, np.full((8, 8), i, dtype=float))
+            self.tasks.append(
+                (DummyReducer(i + 1), input_file, output_file, 'OBJECT'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def check_outputs(self, output_files):
+
+        self.assertEqual(output_files, [t[2] for t in self.tasks])
+
+        for i, output_file in enumerate(output_files):
+            np.testing.assert_equal(
+                pyfits.getdata(output_file), np.full((8, 8), i * (i + 1)))
+
+    def test_serial(self):
+        self.check_outputs(parallel.reduce_files(self.tasks, jobs=1))
+
+    def test_process_pool(self):
+        self.check_outputs(parallel.reduce_files(self.tasks, jobs=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
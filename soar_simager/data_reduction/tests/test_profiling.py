@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from soar_simager.data_reduction import parallel, profiling, reduce
+from soar_simager.tools import synthetic
+
+__author__ = 'Bruno Quint'
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_stage(self):
+
+        records = []
+        profiler = profiling.Profiler(hooks=[records.append])
+
+        with profiler.stage('merge', 'raw.fits'):
+            time.sleep(0.01)
+            profiling.add_bytes_read(100)
+            profiling.add_bytes_written(10)
+
+        self.assertEqual(records, profiler.records)
+
+        record = records[0]
+        self.assertEqual(record.stage, 'merge')
+        self.assertEqual(record.filename, 'raw.fits')
+        self.assertGreaterEqual(record.wall_time, 0.01)
+        self.assertEqual(record.bytes_read, 100)
+        self.assertEqual(record.bytes_written, 10)
+        self.assertIsNone(record.peak_memory)
+
+    def test_bytes_outside_stages(self):
+
+        profiler = profiling.Profiler()
+
+        profiling.add_bytes_read(100)
+
+        with profiler.stage('zero'):
+            pass
+
+        self.assertEqual(profiler.records[0].bytes_read, 0)
+
+    def test_trace_memory(self):
+
+        profiler = profiling.Profiler(trace_memory=True)
+
+        with profiler.stage('zero'):
+            data = np.ones(10 ** 6)
+
+        profiler.stop()
+
+        self.assertGreaterEqual(profiler.records[0].peak_memory, data.nbytes)
+
+    def test_other_threads(self):
+
+        profiler = profiling.Profiler(trace_memory=True)
+        done = threading.Event()
+
+        def _work():
+            with profiler.stage('write'):
+                while not done.is_set():
+                    sum(range(1000))
+
+        thread = threading.Thread(target=_work)
+        thread.start()
+
+        with profiler.stage('zero'):
+            time.sleep(0.2)
+
+        done.set()
+        thread.join()
+        profiler.stop()
+
+        records = {r.stage: r for r in profiler.records}
+
+        # The CPU used by the other thread is not part of the stage, and
+        # the peak memory is only followed in the main thread.
+        self.assertLess(records['zero'].cpu_time, 0.1)
+        self.assertGreater(records['write'].cpu_time, 0.1)
+        self.assertIsNotNone(records['zero'].peak_memory)
+        self.assertIsNone(records['write'].peak_memory)
+
+    def test_share_stages(self):
+
+        profiler = profiling.Profiler()
+
+        def _work(i):
+            cpu_start = time.thread_time()
+            while time.thread_time() - cpu_start < 0.05:
+                sum(range(1000))
+            profiling.add_bytes_read(10)
+            return i
+
+        self.assertIs(profiling.share_stages(_work), _work)
+
+        with profiler.stage('cosmic_rays'):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                results = list(executor.map(
+                    profiling.share_stages(_work), range(4)))
+
+        record = profiler.records[0]
+
+        self.assertEqual(results, list(range(4)))
+        self.assertGreaterEqual(record.cpu_time, 0.2)
+        self.assertEqual(record.bytes_read, 40)
+
+    def test_summary(self):
+
+        profiler = profiling.Profiler()
+
+        for i in range(3):
+            with profiler.stage('zero'):
+                profiling.add_bytes_read(10)
+
+        with profiler.stage('cosmic_rays'):
+            time.sleep(0.01)
+
+        summary = profiler.summary()
+
+        self.assertEqual([s['stage'] for s in summary],
+                         ['cosmic_rays', 'zero'])
+        self.assertEqual(summary[1]['calls'], 3)
+        self.assertEqual(summary[1]['bytes_read'], 30)
+        self.assertEqual(len(profiler.format_summary()), 3)
+
+    def test_null_profiler(self):
+
+        with profiling.NULL_PROFILER.stage('zero'):
+            profiling.add_bytes_read(10)
+
+        profiling.NULL_PROFILER.log_summary(logging.getLogger(__name__))
+
+
+class TestReduceFilesProfile(unittest.TestCase):
+
+    stages = ['merge', 'central_columns', 'calibrate', 'cosmic_rays',
+              'glow', 'clean', 'wcs', 'write']
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        self.tasks = []
+
+        for i in range(2):
+
+            input_file = os.path.join(self.path, 'raw{:d}.fits'.format(i))
+            output_file = os.path.join(self.path, 'm_raw{:d}.fits'.format(i))
+            synthetic.write_frame(input_file, binning=4, seed=i)
+
+            self.tasks.append(
+                (reduce.SamiReducer(), input_file, output_file, 'OBJECT'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def check_records(self, profiler):
+
+        stages = [r.stage for r in profiler.records
+                  if r.filename == self.tasks[0][1]]
+        self.assertEqual(stages, self.stages)
+
+        summary = {s['stage']: s for s in profiler.summary()}
+        self.assertEqual(summary['merge']['calls'], 2)
+        self.assertGreater(summary['merge']['bytes_read'], 0)
+        self.assertGreater(summary['write']['bytes_written'], 0)
+
+    def test_serial(self):
+
+        profiler = profiling.Profiler()
+        parallel.reduce_files(self.tasks, jobs=1, profiler=profiler)
+
+        self.check_records(profiler)
+
+    def test_process_pool(self):
+
+        records = []
+        profiler = profiling.Profiler(hooks=[records.append])
+        parallel.reduce_files(self.tasks, jobs=2, profiler=profiler)
+
+        self.check_records(profiler)
+        self.assertEqual(len(records), 2 * len(self.stages))
+
+
+if __name__ == '__main__':
+    unittest.main()
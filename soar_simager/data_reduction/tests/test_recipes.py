@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from soar_simager.data_reduction import recipes, reduce
+
+__author__ = 'Bruno Quint'
+
+
+class TestRecipes(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, content):
+
+        filename = os.path.join(self.path, 'recipes.json')
+
+        with open(filename, 'w') as f:
+            json.dump(content, f)
+
+        return filename
+
+    def test_defaults(self):
+
+        for instrument in ['SAM', 'SOI', 'SIFS']:
+
+            zero = recipes.get_recipe(instrument, 'ZERO')
+            obj = recipes.get_recipe(instrument, 'OBJECT')
+
+            flat = recipes.get_recipe(instrument, 'FLAT')
+
+            self.assertFalse(zero['cosmic_rays'])
+            self.assertFalse(flat['cosmic_rays'])
+            self.assertTrue(obj['cosmic_rays'])
+
+        self.assertFalse(recipes.get_recipe('SAM', 'DARK')['cosmic_rays'])
+        self.assertTrue(recipes.get_recipe('SAM', 'DARK')['time'])
+        self.assertEqual(recipes.get_recipe('SOI', 'DFLAT'),
+                         recipes.get_recipe('SOI', 'FLAT'))
+
+    def test_unknown_recipe(self):
+
+        with self.assertRaises(ValueError):
+            recipes.get_recipe('SOI', 'DARK')
+
+    def test_user_file(self):
+
+        filename = self.write({
+            'version': 1,
+            'SAM': {'ZERO': {'cosmic_rays': True}},
+            'SOI': {'DARK': {'time': True}},
+        })
+
+        loaded = recipes.load_recipes(filename)
+
+        zero = recipes.get_recipe('SAM', 'ZERO', loaded)
+        self.assertTrue(zero['cosmic_rays'])
+        self.assertFalse(zero['time'])
+
+        self.assertTrue(recipes.get_recipe('SOI', 'DARK', loaded)['time'])
+
+        # The defaults are not changed.
+        self.assertFalse(recipes.get_recipe('SAM', 'ZERO')['cosmic_rays'])
+
+    def test_cosmic_ray_mode(self):
+
+        loaded = recipes.load_recipes(cosmic_ray_mode='fast')
+
+        self.assertEqual(
+            recipes.get_recipe('SAM', 'OBJECT', loaded)['cosmic_rays'],
+            'fast')
+        self.assertFalse(
+            recipes.get_recipe('SAM', 'ZERO', loaded)['cosmic_rays'])
+
+        # Only the OBJECT frames can be compared with each other.
+        filename = self.write({'SAM': {'DARK': {'cosmic_rays': True}}})
+        loaded = recipes.load_recipes(filename, cosmic_ray_mode='stack')
+        self.assertEqual(
+            recipes.get_recipe('SAM', 'OBJECT', loaded)['cosmic_rays'],
+            'stack')
+        self.assertIs(
+            recipes.get_recipe('SAM', 'DARK', loaded)['cosmic_rays'], True)
+
+        filename = self.write({'SOI': {'OBJECT': {'cosmic_rays': 'fast'}}})
+        self.assertEqual(recipes.get_recipe(
+            'SOI', 'OBJECT', recipes.load_recipes(filename))['cosmic_rays'],
+            'fast')
+
+        with self.assertRaises(ValueError):
+            recipes.load_recipes(cosmic_ray_mode='slow')
+
+    def test_invalid_file(self):
+
+        with self.assertRaises(ValueError):
+            recipes.load_recipes(
+                self.write({'SAM': {'ZERO': {'overscan': True}}}))
+
+        with self.assertRaises(ValueError):
+            recipes.load_recipes(
+                self.write({'SAM': {'ZERO': {'cosmic_rays': 'yes'}}}))
+
+        with self.assertRaises(ValueError):
+            recipes.load_recipes(self.write({'version': 2}))
+
+    def test_apply_recipe(self):
+
+        reducer = reduce.SamiReducer(cosmic_rays=True)
+        recipes.apply_recipe(reducer, recipes.get_recipe('SAM', 'FLAT'))
+
+        self.assertFalse(reducer.cosmic_rays)
+        self.assertFalse(reducer.time)
+        self.assertFalse(reducer.get_options()['cosmic_rays'])
+
+
+if __name__ == '__main__':
+    unittest.main()
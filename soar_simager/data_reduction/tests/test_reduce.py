@@ -1,6 +1,9 @@
 #!/usr/bin/env python 
 # -*- coding: utf8 -*-
 
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as _np
 
@@ -33,7 +36,8 @@ class TestReducer(unittest.TestCase):
 
         _np.testing.assert_equal(data, _np.zeros_like(data))
 
-    def test_merge(self):
+    @staticmethod
+    def make_hdul(data=None):
 
         hdul = pyfits.HDUList()
         hdul.append(pyfits.PrimaryHDU())
@@ -41,7 +45,7 @@ class TestReducer(unittest.TestCase):
         for i in range(1, 5):
 
             ihdu = pyfits.ImageHDU()
-            ihdu.data = _np.ones((15, 15))
+            ihdu.data = _np.ones((15, 15)) if data is None else data.copy()
             ihdu.data[:, :5]
 
             ihdu.header['DETSIZE'] = "[1:30,1:30]"
@@ -59,11 +63,175 @@ class TestReducer(unittest.TestCase):
 
             hdul.append(ihdu)
 
+        return hdul
+
+    def test_merge(self):
+
+        hdul = self.make_hdul()
         data, header, prefix = self.reducer.merge(hdul)
 
         self.assertEqual(prefix, 'm_')
         self.assertIsInstance(data, _np.ndarray)
         self.assertIsInstance(header, pyfits.Header)
+        _np.testing.assert_allclose(data, 0., atol=1e-10)
+
+    def test_merge_from_file(self):
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        raw = _np.arange(225, dtype=_np.uint16).reshape((15, 15)) + 40000
+        filename = os.path.join(path, 'raw.fits')
+        self.make_hdul(raw).writeto(filename)
+
+        with pyfits.open(filename) as hdul:
+            expected, _, _ = self.reducer.merge(hdul)
+            expected = _np.array(expected)
+
+        data, header, prefix = self.reducer.merge(filename)
+
+        _np.testing.assert_allclose(data, expected)
+        self.assertGreater(_np.abs(data).max(), 1.)
+
+
+class TestPrecision(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+
+        raw = _np.random.normal(3000., 50., size=(15, 15)).astype(_np.uint16)
+        hdul = TestReducer.make_hdul(raw)
+        hdul[0].header['OBSTYPE'] = 'DFLAT'
+        hdul[0].header['EXPTIME'] = 10.
+        hdul[0].header['PIXSCAL1'] = 0.045
+        hdul[0].header['PIXSCAL2'] = 0.045
+
+        self.raw_file = os.path.join(self.path, 'raw.fits')
+        hdul.writeto(self.raw_file)
+
+        self.zero_file = os.path.join(self.path, 'zero.fits')
+        pyfits.writeto(self.zero_file, _np.random.normal(5., 1., (30, 30)))
+
+        self.flat_file = os.path.join(self.path, 'flat.fits')
+        pyfits.writeto(self.flat_file, _np.random.normal(1., .05, (30, 30)))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_float32_same_as_float64(self):
+
+        results = {}
+        for dtype in ['float32', 'float64']:
+
+            reducer = reduce.Reducer(
+                dtype=dtype, zero_file=self.zero_file,
+                flat_file=self.flat_file, time=True)
+
+            data, header, prefix = reducer.reduce(self.raw_file)
+            results[dtype] = data
+
+        self.assertEqual(results['float32'].dtype, _np.float32)
+        self.assertEqual(results['float64'].dtype, _np.float64)
+
+        _np.testing.assert_allclose(
+            results['float32'], results['float64'], rtol=1e-5, atol=1e-4)
+
+
+class TestCalibrate(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        self.files = {}
+
+        for kind, level in [('zero', 5.), ('dark', 1.), ('flat', 1.)]:
+            header = pyfits.Header()
+            header['EXPTIME'] = 100.
+            self.files[kind] = os.path.join(self.path, kind + '.fits')
+            pyfits.writeto(self.files[kind], _np.random.normal(
+                level, level / 20., (37, 30)), header)
+
+        self.data = _np.random.normal(3000., 50., size=(37, 30))
+        self.header = pyfits.Header()
+        self.header['EXPTIME'] = 10.
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_same_as_separate_steps(self):
+
+        for dtype in [_np.float32, _np.float64]:
+
+            data = self.data.astype(dtype)
+            header = self.header.copy()
+
+            expected = reduce.Reducer.correct_zero(
+                data.copy(), header, 'm_', self.files['zero'])
+            expected = reduce.Reducer.correct_dark(
+                *expected, dark_file=self.files['dark'])
+            expected = reduce.Reducer.correct_flat(
+                *expected, flat_file=self.files['flat'])
+            expected = reduce.Reducer.divide_by_exposuretime(
+                *expected, time=True)
+
+            result = reduce.Reducer.calibrate(
+                data, self.header.copy(), 'm_',
+                zero_file=self.files['zero'], dark_file=self.files['dark'],
+                flat_file=self.files['flat'], time=True, rows=8)
+
+            _np.testing.assert_array_equal(result[0], expected[0])
+            self.assertEqual(result[0].dtype, dtype)
+            self.assertEqual(list(result[1].items()),
+                             list(expected[1].items()))
+            self.assertEqual(result[2], 'tfdzm_')
+
+            # The frame is corrected in place.
+            self.assertIs(result[0], data)
+
+    def test_nothing_to_do(self):
+
+        data, header, prefix = reduce.Reducer.calibrate(
+            self.data.copy(), self.header, 'm_')
+
+        _np.testing.assert_array_equal(data, self.data)
+        self.assertEqual(prefix, 'm_')
+
+    def test_fused(self):
+
+        self.assertTrue(reduce.Reducer().get_calibration_fused())
+        self.assertTrue(
+            reduce.Reducer(cosmic_rays='stack').get_calibration_fused())
+        self.assertFalse(
+            reduce.Reducer(cosmic_rays=True).get_calibration_fused())
+        self.assertFalse(
+            reduce.Reducer(glow_file='glow.fits').get_calibration_fused())
+
+
+class TestFitOverscan(unittest.TestCase):
+
+    def test_same_as_polyfit(self):
+
+        x = _np.arange(200) + 1
+        biases = [
+            1000. + 0.1 * i * x - 1e-4 * x ** 2 +
+            _np.random.normal(size=x.size)
+            for i in range(4)
+        ]
+
+        bias_fits = reduce.fit_overscan(biases, 2)
+
+        for bias, bias_fit in zip(biases, bias_fits):
+            expected = _np.polyval(_np.polyfit(x, bias, 2), x)
+            _np.testing.assert_allclose(bias_fit, expected, rtol=1e-10)
+
+    def test_different_sizes(self):
+
+        biases = [_np.ones(10), 2 * _np.ones(12)]
+        bias_fits = reduce.fit_overscan(biases, 2)
+
+        _np.testing.assert_allclose(bias_fits[0], _np.ones(10))
+        _np.testing.assert_allclose(bias_fits[1], 2 * _np.ones(12))
 
 
 class TestWCS(unittest.TestCase):
@@ -1,6 +1,8 @@
 
 import os
 
+import pandas as pd
+
 from unittest import TestCase, main
 from soar_simager.data_reduction import sami
 
@@ -34,5 +36,28 @@ class TestCreateRedFolder(TestCase):
         os.rmdir(red_path)
 
 
+class TestSelectCalibrations(TestCase):
+
+    def test_wait_for_enough_files(self):
+
+        rows = \
+            [('ZERO', '4 4', 'c0001')] * 3 + \
+            [('ZERO', '2 2', 'c0001')] * 5 + \
+            [('SFLAT', '4 4', 'c0002')] * 5 + \
+            [('DFLAT', '4 4', 'c0003')] * 2 + \
+            [('OBJECT', '4 4', 'c0003')] * 2
+
+        df = pd.DataFrame(rows, columns=['obstype', 'binning', 'filters'])
+        df['filename'] = ['file{:02d}.fits'.format(i) for i in df.index]
+
+        selected = sami.select_calibrations(df, min_zero=5, min_flat=5)
+        zero = selected[selected.obstype == 'ZERO']
+
+        self.assertEqual(len(selected.index), 12)
+        self.assertTrue((zero.binning == '2 2').all())
+        self.assertFalse((selected.obstype == 'DFLAT').any())
+        self.assertEqual((selected.obstype == 'OBJECT').sum(), 2)
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
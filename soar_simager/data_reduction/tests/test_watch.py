@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from soar_simager.data_reduction.watch import FileWatcher
+
+__author__ = 'Bruno Quint'
+
+
+class TestFileWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.watcher = FileWatcher(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, content):
+
+        filename = os.path.join(self.path, name)
+
+        with open(filename, 'ab') as f:
+            f.write(content)
+
+        return filename
+
+    def test_report_after_size_settles(self):
+
+        filename = self.write('a.fits', b'0' * 2880)
+        self.write('a.txt', b'0' * 2880)
+
+        self.assertEqual(self.watcher.poll(), [])
+        self.assertEqual(self.watcher.poll(), [filename])
+        self.assertEqual(self.watcher.poll(), [])
+
+    def test_wait_while_growing(self):
+
+        filename = self.write('b.fits', b'0' * 2880)
+        self.assertEqual(self.watcher.poll(), [])
+
+        self.write('b.fits', b'0' * 2880)
+        self.assertEqual(self.watcher.poll(), [])
+
+        self.assertEqual(self.watcher.poll(), [filename])
+
+    def test_ignore_empty_files(self):
+
+        self.write('c.fits', b'')
+
+        self.assertEqual(self.watcher.poll(), [])
+        self.assertEqual(self.watcher.poll(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+import numpy as np
+
+from astropy.io import fits as pyfits
+
+from soar_simager.data_reduction import parallel, profiling, reduce, writer
+from soar_simager.data_reduction.buffers import frame_pool
+from soar_simager.tools import synthetic
+
+__author__ = 'Bruno Quint'
+
+
+class SlowWriter(writer.FrameWriter):
+    """Writer whose threads wait for an event before each frame."""
+
+    def __init__(self, *args, **kwargs):
+        self.go = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def _write(self, *args):
+        self.go.wait()
+        super()._write(*args)
+
+
+class TestFrameWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def frame(self, i):
+
+        filename = os.path.join(self.path, '{:d}.fits'.format(i))
+        header = pyfits.Header()
+        header['FRAME'] = i
+
+        return filename, np.full((8, 6), float(i)), header
+
+    def check(self, filename, i):
+
+        data, header = pyfits.getdata(filename, header=True)
+
+        np.testing.assert_equal(data, i)
+        self.assertEqual(header['FRAME'], i)
+
+    def test_write(self):
+
+        for threads in [0, 1, 3]:
+
+            profiler = profiling.Profiler()
+            released = []
+
+            with writer.FrameWriter(threads=threads) as w:
+                for i in range(5):
+                    filename, data, header = self.frame(i)
+                    w.submit(filename, data, header, profiler=profiler,
+                             callback=lambda i=i: released.append(i))
+
+            for i in range(5):
+                self.check(self.frame(i)[0], i)
+
+            self.assertEqual(sorted(released), list(range(5)))
+            self.assertEqual(len(profiler.records), 5)
+            for record in profiler.records:
+                self.assertEqual(record.stage, 'write')
+                self.assertGreater(record.bytes_written, 0)
+
+    def test_back_pressure(self):
+
+        w = SlowWriter(threads=1, queue_size=1)
+
+        # One frame is being written and one is waiting in the queue.
+        w.submit(*self.frame(0))
+        w.submit(*self.frame(1))
+
+        blocked = threading.Thread(target=w.submit, args=self.frame(2))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+
+        w.go.set()
+        blocked.join()
+        w.close()
+
+        for i in range(3):
+            self.check(self.frame(i)[0], i)
+
+    def test_trace_memory(self):
+
+        profiler = profiling.Profiler(trace_memory=True)
+        w = writer.FrameWriter(threads=1)
+        w.submit(*self.frame(0), profiler=profiler)
+
+        # Written in this thread, so the memory was traced.
+        self.check(self.frame(0)[0], 0)
+        self.assertIsNotNone(profiler.records[0].peak_memory)
+
+        w.close()
+        profiler.stop()
+
+    def test_sync(self):
+
+        w = writer.FrameWriter(threads=2)
+        for i in range(3):
+            w.submit(*self.frame(i))
+
+        with mock.patch.object(writer.os, 'fsync') as fsync:
+            w.close()
+
+        # The three files and their directory.
+        self.assertEqual(fsync.call_count, 4)
+
+        with self.assertRaises(RuntimeError):
+            w.submit(*self.frame(3))
+
+    def test_errors(self):
+
+        w = writer.FrameWriter(threads=1)
+        _, data, header = self.frame(0)
+        missing = os.path.join(self.path, 'missing', '0.fits')
+
+        w.submit(missing, data, header)
+        with self.assertRaises(OSError):
+            w.flush()
+
+        # The writer can still be used.
+        w.submit(*self.frame(1))
+        w.close()
+        self.check(self.frame(1)[0], 1)
+
+
+class TestReduceFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        frame_pool.clear()
+
+    def tearDown(self):
+        frame_pool.clear()
+        shutil.rmtree(self.path)
+
+    def test_same_files(self):
+
+        tasks = []
+        for i in range(3):
+            input_file = os.path.join(self.path, 'raw{:d}.fits'.format(i))
+            synthetic.write_frame(input_file, binning=4, seed=i)
+            tasks.append((reduce.SamiReducer(), input_file,
+                          os.path.join(self.path, 'm_raw{:d}.fits'.format(i)),
+                          'OBJECT'))
+
+        expected = []
+        for reducer, input_file, _, _ in tasks:
+            data, _, _ = reducer.reduce(input_file)
+            expected.append(np.array(data))
+
+        with writer.FrameWriter(threads=1) as w:
+            output_files = parallel.reduce_files(tasks, writer=w)
+
+            # The files are complete before the writer is closed.
+            for output_file, data in zip(output_files, expected):
+                np.testing.assert_equal(pyfits.getdata(output_file), data)
+
+        # The buffers are given back once written. Two frames may be in
+        # memory at the same time: one being written and one being reduced.
+        self.assertIn(len(frame_pool), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
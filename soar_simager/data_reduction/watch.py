@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Folder Watcher
+
+    During the night, the raw files are written to the data folder while the
+    pipeline is running. The watcher polls the folder and reports each new
+    file only once its size stopped changing between two polls, so frames
+    that are still being written by the acquisition system are not read.
+"""
+
+import fnmatch
+import os
+
+__author__ = 'Bruno Quint'
+
+
+class FileWatcher:
+    """
+    Polls a folder looking for new files.
+
+    Parameters
+    ----------
+        path : str
+            Folder that receives the raw files.
+
+        pattern : str
+            Shell-style pattern that the file names must match.
+    """
+
+    def __init__(self, path, pattern='*.fits'):
+
+        self.path = path
+        self.pattern = pattern
+
+        # Files already reported and files waiting for their size to settle.
+        self._known = set()
+        self._pending = {}
+
+    def poll(self):
+        """
+        Scan the folder once.
+
+        Returns:
+
+            new_files (list) : sorted list with the files that were completely
+            written since the last call.
+        """
+        new_files = []
+        pending = {}
+
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+
+                if entry.path in self._known:
+                    continue
+
+                if not fnmatch.fnmatch(entry.name, self.pattern):
+                    continue
+
+                if not entry.is_file():
+                    continue
+
+                size = entry.stat().st_size
+
+                if size > 0 and self._pending.get(entry.path) == size:
+                    self._known.add(entry.path)
+                    new_files.append(entry.path)
+                else:
+                    pending[entry.path] = size
+
+        self._pending = pending
+
+        return sorted(new_files)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Background Writer
+
+    Writing a reduced frame takes a good part of the time spent on it, and
+    the CPU is idle while the data goes to disk. The FrameWriter passes the
+    frames to one or more threads that write them while the next frame is
+    being reduced. The queue of frames waiting to be written is bounded, so
+    a slow disk makes the reduction wait instead of keeping the whole night
+    in memory.
+
+    The files are complete once flush returns, and safely on disk once sync
+    or close return, since they call fsync on every file written. Errors
+    raised while writing are raised again by the next call to submit, flush
+    or close. Frames submitted with a profiler that traces the memory are
+    written in the calling thread, since tracemalloc cannot tell the
+    threads apart.
+"""
+
+import os
+import queue
+import threading
+
+import numpy as _np
+
+from soar_simager.data_reduction import profiling
+from soar_simager.io import pyfits as _pyfits
+
+__author__ = 'Bruno Quint'
+
+__all__ = ['FrameWriter', 'QUEUE_SIZE']
+
+# Frames waiting to be written. Each one holds a full frame in memory.
+QUEUE_SIZE = 2
+
+
+class FrameWriter:
+    """
+    Writes the reduced frames in background threads.
+
+    Parameters
+    ----------
+        threads : int
+            Number of threads writing the frames. With 0, the frames are
+            written by submit itself, in the calling thread.
+
+        queue_size : int
+            Maximum number of frames waiting to be written. submit blocks
+            while the queue is full.
+    """
+
+    def __init__(self, threads=1, queue_size=QUEUE_SIZE):
+
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._lock = threading.Lock()
+        self._errors = []
+        self._written = []
+        self._closed = False
+
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True,
+                             name='FrameWriter-{:d}'.format(i))
+            for i in range(threads)
+        ]
+
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, filename, data, header, source=None, profiler=None,
+               callback=None):
+        """
+        Queue one frame to be written. Blocks while the queue is full.
+
+        Args:
+
+            filename (str) : file to be written. It is overwritten if it
+            exists.
+
+            data (numpy.ndarray) : the frame. It must not be changed until
+            it is written.
+
+            header (astropy.io.fits.Header) : the header of the frame.
+
+            source (str, optional) : file recorded by the profiler
+            (default = filename).
+
+            profiler (Profiler, optional) : records the writing of the
+            frame in the stage 'write'. If it traces the memory, the frame
+            is written before submit returns.
+
+            callback (callable, optional) : called without arguments once
+            the frame is written, or failed to be, e.g. to give its buffer
+            back to the frame pool.
+        """
+        if self._closed:
+            raise RuntimeError('The writer is closed.')
+
+        self._raise_errors()
+
+        item = (filename, data, header, source, profiler, callback)
+
+        if self._threads and not getattr(profiler, 'trace_memory', False):
+            self._queue.put(item)
+        else:
+            self._write(*item)
+
+    def flush(self):
+        """Wait until all the frames submitted are written."""
+        self._queue.join()
+        self._raise_errors()
+
+    def sync(self):
+        """
+        Write all the frames submitted and make sure that they are on disk.
+        """
+        self.flush()
+
+        with self._lock:
+            written, self._written = self._written, []
+
+        for filename in written:
+            _fsync(filename)
+
+        # The new files are only found after a crash if their directory
+        # entries are on disk too.
+        for path in set(os.path.dirname(os.path.abspath(f)) for f in written):
+            _fsync(path, directory=True)
+
+    def close(self):
+        """Write and sync all the frames submitted and stop the threads."""
+        if self._closed:
+            return
+
+        try:
+            self.sync()
+        finally:
+
+            self._closed = True
+
+            for _ in self._threads:
+                self._queue.put(None)
+
+            for thread in self._threads:
+                thread.join()
+
+    def _raise_errors(self):
+        """Raise the first error found while writing."""
+        with self._lock:
+            errors, self._errors = self._errors, []
+
+        if errors:
+            raise errors[0]
+
+    def _run(self):
+        """Write the frames of the queue until None is found."""
+        while True:
+
+            item = self._queue.get()
+
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as error:
+                with self._lock:
+                    self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, filename, data, header, source, profiler, callback):
+        """Write one frame and record it to be synced."""
+        if profiler is None:
+            profiler = profiling.NULL_PROFILER
+
+        try:
+            with profiler.stage('write', source or filename):
+                _pyfits.writeto(filename, _np.asarray(data), header=header,
+                                overwrite=True)
+                profiling.add_bytes_written(os.path.getsize(filename))
+        finally:
+            if callback is not None:
+                callback()
+
+        with self._lock:
+            self._written.append(filename)
+
+
+def _fsync(path, directory=False):
+    """
+    Flush a file, or the entries of a directory, to disk. Files removed in
+    the meantime are ignored, as well as systems that cannot sync
+    directories.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    except OSError:
+        if directory:
+            return
+        raise
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        if not directory:
+            raise
+    finally:
+        os.close(fd)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    FITS Cards
+
+    A minimal reader for the header units of FITS files. To build the night
+    table, only a handful of keywords from the first two header units are
+    needed. Instead of building full HDULists, this reader scans the
+    2880-byte header blocks and parses only the requested cards. It only
+    understands the simple cases used by the raw files. Anything unusual
+    raises CardParseError, so the caller can fall back to astropy.io.fits.
+"""
+
+import numpy as _np
+
+__author__ = 'Bruno Quint'
+
+__all__ = ['BLOCK_SIZE', 'CARD_SIZE', 'CardParseError', 'map_data',
+           'read_headers']
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Cards always parsed, since they are needed to find the next header unit.
+STRUCTURE_KEYWORDS = {'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT'}
+
+DTYPES = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+
+class CardParseError(ValueError):
+    """Raised when a header cannot be read by this minimal reader."""
+    pass
+
+
+def _parse_value(card):
+    """Return the value of a card with a value indicator."""
+    value = card[10:].lstrip()
+
+    if value.startswith("'"):
+
+        chars = []
+        i = 1
+
+        while i < len(value):
+            if value[i] == "'":
+                if value[i + 1:i + 2] == "'":
+                    chars.append("'")
+                    i += 2
+                    continue
+                return ''.join(chars).rstrip()
+            chars.append(value[i])
+            i += 1
+
+        raise CardParseError('Unterminated string: {:s}'.format(card))
+
+    value = value.split('/')[0].strip()
+
+    if value == 'T':
+        return True
+
+    if value == 'F':
+        return False
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    try:
+        return float(value.replace('D', 'E'))
+    except ValueError:
+        raise CardParseError('Unsupported value: {:s}'.format(card))
+
+
+def _read_header(f, keywords, first_keyword):
+    """
+    Read one header unit from the current position of a file.
+
+    Returns:
+
+        cards (dict) : the requested and the structural keywords.
+
+        header_size (int) : size of the header in bytes.
+    """
+    cards = {}
+    wanted = set(keywords) | STRUCTURE_KEYWORDS
+    n_blocks = 0
+
+    while True:
+
+        block = f.read(BLOCK_SIZE)
+        n_blocks += 1
+
+        if len(block) < BLOCK_SIZE:
+            raise CardParseError('Header ended before the END card.')
+
+        try:
+            block = block.decode('ascii')
+        except UnicodeDecodeError:
+            raise CardParseError('Header contains non-ASCII characters.')
+
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+
+            card = block[i:i + CARD_SIZE]
+            keyword = card[:8].rstrip().upper()
+
+            if n_blocks == 1 and i == 0 and keyword != first_keyword:
+                raise CardParseError(
+                    'Header starts with {:s}.'.format(keyword))
+
+            if keyword == 'END':
+                return cards, n_blocks * BLOCK_SIZE
+
+            if keyword == 'HIERARCH' or keyword == 'CONTINUE':
+                raise CardParseError('Unsupported card: {:s}'.format(card))
+
+            naxis_n = keyword.startswith('NAXIS') and keyword[5:].isdigit()
+
+            if keyword in cards or not (keyword in wanted or naxis_n):
+                continue
+
+            if card[8:10] != '= ':
+                raise CardParseError('Missing value indicator: {:s}'.format(
+                    card))
+
+            cards[keyword] = _parse_value(card)
+
+
+def _data_size(cards):
+    """Return the size of the data unit in bytes, including the padding."""
+    naxis = cards.get('NAXIS', 0)
+
+    if naxis == 0:
+        return 0
+
+    try:
+        n_pixels = 1
+        for i in range(1, naxis + 1):
+            n_pixels *= cards['NAXIS{:d}'.format(i)]
+        size = abs(cards['BITPIX']) // 8 * cards.get('GCOUNT', 1) * \
+            (cards.get('PCOUNT', 0) + n_pixels)
+    except KeyError:
+        raise CardParseError('Missing NAXISn or BITPIX.')
+
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def read_headers(filename, keywords):
+    """
+    Read some keywords from the first header units of a FITS file.
+
+    Args:
+
+        filename (str) : the FITS file name.
+
+        keywords (list) : one list of keywords for each header unit to be
+        read, starting with the primary header.
+
+    Returns:
+
+        headers (list) : one (cards, data_offset) tuple for each header unit.
+        cards is a dictionary with the requested keywords plus BITPIX and
+        NAXISn. data_offset is the position of the data unit in bytes.
+
+    Raises:
+
+        CardParseError : if the header contains anything this reader does
+        not understand or if a requested keyword is missing.
+
+        OSError : if the file cannot be opened.
+    """
+    headers = []
+
+    with open(filename, 'rb') as f:
+
+        offset = 0
+
+        for i, hdu_keywords in enumerate(keywords):
+
+            hdu_keywords = [k.upper() for k in hdu_keywords]
+            first_keyword = 'SIMPLE' if i == 0 else 'XTENSION'
+
+            f.seek(offset)
+            cards, header_size = _read_header(f, hdu_keywords, first_keyword)
+
+            for keyword in hdu_keywords:
+                if keyword not in cards:
+                    raise CardParseError(
+                        'Keyword not found: {:s}'.format(keyword))
+
+            data_offset = offset + header_size
+            headers.append((cards, data_offset))
+
+            offset = data_offset + _data_size(cards)
+
+    return headers
+
+
+def map_data(filename, cards, data_offset):
+    """
+    Memory-map the raw (unscaled) data of an image header unit.
+
+    Args:
+
+        filename (str) : the FITS file name.
+
+        cards (dict) : cards returned by read_headers.
+
+        data_offset (int) : position of the data unit returned by
+        read_headers.
+
+    Returns:
+
+        data (numpy.memmap) : read-only array with the raw data, or None if
+        the header unit has no data.
+
+    Raises:
+
+        CardParseError : if the data is not a 2D image with a known BITPIX.
+    """
+    naxis = cards.get('NAXIS', 0)
+
+    if naxis == 0:
+        return None
+
+    if naxis != 2 or cards.get('BITPIX') not in DTYPES:
+        raise CardParseError('Unsupported data unit.')
+
+    shape = (cards['NAXIS2'], cards['NAXIS1'])
+
+    try:
+        data = _np.memmap(filename, dtype=DTYPES[cards['BITPIX']], mode='r',
+                          offset=data_offset, shape=shape)
+    except ValueError:
+        raise CardParseError('Data unit is truncated.')
+
+    return data
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from soar_simager.io import cards, pyfits
+
+__author__ = 'Bruno Quint'
+
+
+class TestReadHeaders(unittest.TestCase):
+
+    def setUp(self):
+
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'raw.fits')
+
+        hdul = pyfits.HDUList()
+        hdul.append(pyfits.PrimaryHDU(data=np.zeros((3, 5), dtype=np.int32)))
+
+        h0 = hdul[0].header
+        h0['OBSTYPE'] = 'OBJECT'
+        h0['INSTRUME'] = ' sam '
+        h0['OBJECT'] = "O'Neil"
+        h0['EXPTIME'] = 1.5
+        h0['NCOMBINE'] = 3
+        h0['SATURATE'] = False
+
+        for i in range(40):
+            h0['KEY{:d}'.format(i)] = i
+
+        hdu = pyfits.ImageHDU(
+            data=np.arange(12, dtype=np.uint16).reshape((3, 4)))
+        hdu.header['CCDSUM'] = '4 4 '
+        hdul.append(hdu)
+
+        hdul.writeto(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_same_values_as_astropy(self):
+
+        keywords = ['OBSTYPE', 'INSTRUME', 'OBJECT', 'EXPTIME', 'NCOMBINE',
+                    'SATURATE', 'KEY39']
+
+        (h0, _), (h1, _) = cards.read_headers(
+            self.filename, [keywords, ['CCDSUM']])
+
+        with pyfits.open(self.filename) as hdul:
+            for key in keywords:
+                self.assertEqual(h0[key], hdul[0].header[key])
+            self.assertEqual(h1['CCDSUM'], hdul[1].header['CCDSUM'])
+
+    def test_map_data(self):
+
+        (h0, offset0), (h1, offset1) = cards.read_headers(
+            self.filename, [[], []])
+
+        np.testing.assert_equal(cards.map_data(self.filename, h0, offset0),
+                                np.zeros((3, 5)))
+
+        with pyfits.open(self.filename, do_not_scale_image_data=True) as hdul:
+            np.testing.assert_equal(
+                cards.map_data(self.filename, h1, offset1), hdul[1].data)
+
+    def test_missing_keyword(self):
+
+        with self.assertRaises(cards.CardParseError):
+            cards.read_headers(self.filename, [['FILTERS']])
+
+    def test_not_fits(self):
+
+        filename = os.path.join(self.path, 'text.fits')
+
+        with open(filename, 'w') as f:
+            f.write('This is not a FITS file.\n' * 200)
+
+        with self.assertRaises(cards.CardParseError):
+            cards.read_headers(filename, [['OBSTYPE']])
+
+
+if __name__ == '__main__':
+    unittest.main()
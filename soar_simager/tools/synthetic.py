@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+    Synthetic Nights
+
+    Writes raw SAMI and SOI frames that look like the real ones to the data
+    reduction: multi-extension files with one ImageHDU per amplifier, the
+    DETSIZE, DETSEC, TRIMSEC, DATASEC, BIASSEC and CCDSUM keywords, an
+    overscan whose level changes along the rows, the bad columns and lines
+    of the bad pixel maps, cosmic rays, stars, and a flat field response.
+    They are used to benchmark and to load test the pipeline without real
+    data. A given seed always gives the same night. All the OBJECT frames
+    show the same star field, moved by the dither pattern of the night
+    together with their RA and DEC.
+"""
+
+import json
+import os
+
+import numpy as _np
+
+from astropy import units as u
+from astropy.coordinates import Angle
+
+from soar_simager.data_reduction import bad_pixels
+from soar_simager.io import pyfits as _pyfits
+
+__author__ = 'Bruno Quint'
+
+__all__ = ['FILTERS', 'INSTRUMENTS', 'get_filters', 'make_frame',
+           'make_night', 'night_plan', 'write_frame']
+
+# Geometry and detector properties of each instrument, in unbinned pixels.
+# `amplifiers` is the number of amplifiers along x and y and `amp_size` is
+# the width and height of each one, without the overscan.
+INSTRUMENTS = {
+    'SAM': {
+        'prefix': 'sami',
+        'amplifiers': (2, 2),
+        'amp_size': (2048, 2048),
+        'overscan': 32,
+        'pixel_scale': 0.0455,
+        'obstypes': ['ZERO', 'DARK', 'SFLAT', 'OBJECT'],
+    },
+    'SOI': {
+        'prefix': 'soi',
+        'amplifiers': (4, 1),
+        'amp_size': (1024, 4096),
+        'overscan': 32,
+        'pixel_scale': 0.0767,
+        'obstypes': ['ZERO', 'SFLAT', 'OBJECT'],
+    },
+}
+
+# Signal levels in ADU.
+BIAS_LEVEL = 1000.
+BAD_PIXEL_LEVEL = 800.
+DARK_CURRENT = 0.01
+FLAT_LEVEL = 20000.
+SKY_LEVEL = 5.
+READ_NOISE = 4.
+
+# Default exposure time of each type of frame, in seconds.
+EXPTIMES = {'ZERO': 0., 'DARK': 300., 'SFLAT': 5., 'DFLAT': 5.,
+            'OBJECT': 60.}
+
+# Cosmic ray hits per unbinned pixel per second of exposure.
+COSMIC_RAY_RATE = 2e-7
+
+# Fraction of the frames of a night used by each calibration.
+PLAN_FRACTIONS = {'ZERO': 0.2, 'DARK': 0.1, 'SFLAT': 0.2}
+
+# Filters used by the flats and the objects by default (gunn r and i).
+FILTERS = ['c0002', 'c0003']
+
+# Pointing of the OBJECT frames, in degrees, and seed of their star field.
+RA, DEC = 150., -30.
+FIELD_SEED = 2018
+
+# Offsets of the telescope between consecutive OBJECT frames, in unbinned
+# pixels along x and y. They are whole pixels at all the binnings.
+DITHERS = [(0, 0), (40, 24), (-32, 48), (24, -40), (-48, -16)]
+
+
+def get_filters():
+    """
+    Read the filters available for SAMI.
+
+    Returns:
+
+        filters (list) : (code, name) tuples sorted by code, where code goes
+        into the FILTERS keyword and name into FILTER1.
+    """
+    filename = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                            'data', 'filters.json')
+
+    with open(filename) as f:
+        filters = json.load(f)['sami_filters'][0]
+
+    return sorted((code, names[1]) for code, names in filters.items())
+
+
+def _bad_pixel_mask(instrument, shape, binning):
+    """
+    Return the known bad pixels of a merged raw frame. The bad pixel maps
+    refer to the frames already cleaned by SamiReducer, which moves the two
+    central columns of SAMI to the right edge, so the right half of the SAMI
+    map is shifted back by two columns.
+    """
+    bad_pixel_map = bad_pixels.get_bad_pixel_map(instrument, binning)
+
+    if bad_pixel_map is None or bad_pixel_map.shape != shape:
+        return _np.zeros(shape, dtype=bool)
+
+    mask = bad_pixel_map.mask
+
+    if instrument == 'SAM':
+        center = shape[1] // 2
+        mask = mask.copy()
+        mask[:, center + 1:] = bad_pixel_map.mask[:, center - 1:-2]
+        mask[:, center - 1:center + 1] = False
+
+    return mask
+
+
+def _add_stars(image, rng, n_stars=50, fwhm=3., offset=(0., 0.)):
+    """Add gaussian stars to an image, moved by offset (x, y) pixels."""
+    ny, nx = image.shape
+    sigma = fwhm / 2.355
+    half = int(4 * sigma) + 1
+
+    y, x = _np.mgrid[-half:half + 1, -half:half + 1]
+
+    for i in range(n_stars):
+
+        xc = rng.uniform(half, nx - half - 1)
+        yc = rng.uniform(half, ny - half - 1)
+        flux = 10 ** rng.uniform(3, 5.5)
+
+        xc, yc = xc + offset[0], yc + offset[1]
+        if not (half <= xc < nx - half - 1 and half <= yc < ny - half - 1):
+            continue
+
+        x0, y0 = int(xc), int(yc)
+        dx, dy = xc - x0, yc - y0
+
+        stamp = _np.exp(-((x - dx) ** 2 + (y - dy) ** 2) / (2 * sigma ** 2))
+        stamp *= flux / stamp.sum()
+
+        image[y0 - half:y0 + half + 1, x0 - half:x0 + half + 1] += stamp
+
+
+def _add_cosmic_rays(image, rng, n_hits):
+    """Add short cosmic ray tracks to an image."""
+    ny, nx = image.shape
+
+    for i in range(n_hits):
+
+        x, y = rng.integers(1, nx - 1), rng.integers(1, ny - 1)
+        dx, dy = rng.integers(-1, 2, size=2)
+        length = rng.integers(1, 4)
+        energy = rng.uniform(2000., 20000.)
+
+        for j in range(length):
+            xi = min(max(x + j * dx, 0), nx - 1)
+            yi = min(max(y + j * dy, 0), ny - 1)
+            image[yi, xi] += energy / (j + 1)
+
+
+def _signal(instrument, obstype, binning, exptime, rng, dither=(0, 0)):
+    """Return the signal of the merged frame, without the bias level."""
+    geometry = INSTRUMENTS[instrument]
+
+    nx = geometry['amplifiers'][0] * geometry['amp_size'][0] // binning
+    ny = geometry['amplifiers'][1] * geometry['amp_size'][1] // binning
+
+    image = _np.zeros((ny, nx), dtype=_np.float32)
+    pixels = binning ** 2
+
+    if obstype == 'DARK':
+        image += DARK_CURRENT * pixels * exptime
+
+    elif obstype in ('SFLAT', 'DFLAT', 'OBJECT'):
+
+        # Vignetting and pixel to pixel response.
+        y, x = _np.ogrid[-1:1:ny * 1j, -1:1:nx * 1j]
+        response = 1. - 0.1 * (x ** 2 + y ** 2)
+        response = response * rng.normal(1., 0.01, size=(ny, nx))
+
+        if obstype == 'OBJECT':
+            image += SKY_LEVEL * pixels * exptime
+            _add_stars(image, _np.random.default_rng(FIELD_SEED),
+                       offset=(-dither[0] / binning, -dither[1] / binning))
+        else:
+            image += FLAT_LEVEL
+
+        image *= response.astype(_np.float32)
+
+    # Photon noise.
+    if image.any():
+        image += _np.sqrt(_np.maximum(image, 0)) * rng.standard_normal(
+            image.shape, dtype=_np.float32)
+
+    n_hits = rng.poisson(
+        COSMIC_RAY_RATE * exptime * image.size * pixels)
+    _add_cosmic_rays(image, rng, n_hits)
+
+    image[_bad_pixel_mask(instrument, image.shape, binning)] += \
+        BAD_PIXEL_LEVEL
+
+    return image
+
+
+def make_frame(instrument='SAM', obstype='OBJECT', binning=4,
+               filters='c0002', exptime=None, seed=0, dither=(0, 0)):
+    """
+    Create a synthetic raw frame.
+
+    Args:
+
+        instrument (str, optional) : 'SAM' or 'SOI' (default = 'SAM').
+
+        obstype (str, optional) : ZERO, DARK, SFLAT, DFLAT or OBJECT
+        (default = 'OBJECT').
+
+        binning (int, optional) : 1, 2 or 4 (default = 4).
+
+        filters (str, optional) : filter code from data/filters.json
+        (default = 'c0002').
+
+        exptime (float, optional) : exposure time in seconds. The default
+        depends on the obstype.
+
+        seed (int, optional) : seed of the random number generator.
+
+        dither (tuple, optional) : offset of the telescope along x and y, in
+        unbinned pixels. The stars move the other way and RA and DEC change
+        accordingly (default = (0, 0)).
+
+    Returns:
+
+        hdul (astropy.io.fits.HDUList) : a PrimaryHDU with the observation
+        keywords followed by one ImageHDU with unsigned 16-bit data for each
+        amplifier.
+    """
+    instrument = instrument.upper()
+    geometry = INSTRUMENTS[instrument]
+    rng = _np.random.default_rng(seed)
+
+    if exptime is None:
+        exptime = EXPTIMES[obstype]
+
+    filter_names = dict(get_filters())
+
+    hdul = _pyfits.HDUList()
+    hdul.append(_pyfits.PrimaryHDU())
+
+    h0 = hdul[0].header
+    h0['OBSTYPE'] = obstype
+    h0['INSTRUME'] = instrument
+    h0['OBJECT'] = 'Synthetic' if obstype == 'OBJECT' else obstype
+    h0['FILTERS'] = filters
+    h0['FILTER1'] = filter_names.get(filters, filters)
+    h0['FILTER2'] = 'EMPTY'
+    h0['EXPTIME'] = exptime
+    h0['DATE-OBS'] = '2018-01-01T00:00:00'
+    scale = geometry['pixel_scale'] / 3600.
+    dec = DEC + dither[1] * scale
+    ra = RA + dither[0] * scale / _np.cos(_np.deg2rad(dec))
+    h0['RA'] = Angle(ra, u.deg).to_string(unit=u.hour, sep=':', precision=4)
+    h0['DEC'] = Angle(dec, u.deg).to_string(sep=':', precision=3)
+    h0['DECPANGL'] = 0.
+    h0['PIXSCAL1'] = geometry['pixel_scale']
+    h0['PIXSCAL2'] = geometry['pixel_scale']
+
+    image = _signal(instrument, obstype, binning, exptime, rng,
+                    dither=dither)
+
+    n_amp_x, n_amp_y = geometry['amplifiers']
+    amp_w, amp_h = geometry['amp_size']
+    width, height = amp_w // binning, amp_h // binning
+    overscan = geometry['overscan'] // binning
+
+    rows = _np.linspace(0, 1, height, dtype=_np.float32)[:, _np.newaxis]
+
+    for j in range(n_amp_y):
+        for i in range(n_amp_x):
+
+            # The overscan of each amplifier is on the outer edge.
+            if i < n_amp_x / 2:
+                bias_x, trim_x = (0, overscan), (overscan, overscan + width)
+            else:
+                bias_x, trim_x = (width, width + overscan), (0, width)
+
+            # Bias level drifting along the rows, different in each
+            # amplifier.
+            level = BIAS_LEVEL + 50. * (i + n_amp_x * j)
+            bias = level + 20. * rows - 10. * rows ** 2
+
+            data = bias + rng.normal(0., READ_NOISE,
+                                     size=(height, width + overscan))
+            data[:, trim_x[0]:trim_x[1]] += image[
+                j * height:(j + 1) * height, i * width:(i + 1) * width]
+
+            hdu = _pyfits.ImageHDU(
+                data=_np.clip(data, 0, 2 ** 16 - 1).astype(_np.uint16))
+
+            h = hdu.header
+            h['CCDSUM'] = '{0:d} {0:d}'.format(binning)
+            h['DETSIZE'] = '[1:{:d},1:{:d}]'.format(
+                n_amp_x * amp_w, n_amp_y * amp_h)
+            h['DETSEC'] = '[{:d}:{:d},{:d}:{:d}]'.format(
+                i * amp_w + 1, (i + 1) * amp_w, j * amp_h + 1,
+                (j + 1) * amp_h)
+            h['TRIMSEC'] = '[{:d}:{:d},1:{:d}]'.format(
+                trim_x[0] + 1, trim_x[1], height)
+            h['DATASEC'] = h['TRIMSEC']
+            h['BIASSEC'] = '[{:d}:{:d},1:{:d}]'.format(
+                bias_x[0] + 1, bias_x[1], height)
+
+            hdul.append(hdu)
+
+    return hdul
+
+
+def write_frame(filename, **kwargs):
+    """Write a synthetic raw frame. See make_frame for the arguments."""
+    make_frame(**kwargs).writeto(filename, overwrite=True)
+
+
+def night_plan(instrument='SAM', n_frames=20, filters=None):
+    """
+    Distribute the frames of a night between calibrations and objects.
+
+    Args:
+
+        instrument (str, optional) : 'SAM' or 'SOI' (default = 'SAM').
+
+        n_frames (int, optional) : total number of frames (default = 20).
+
+        filters (list, optional) : codes of the filters used by the flats
+        and the objects (default = FILTERS).
+
+    Returns:
+
+        plan (list) : (obstype, filters) tuples, one for each frame, in the
+        order they are observed.
+
+    Raises:
+
+        ValueError : if a filter is not in data/filters.json.
+    """
+    instrument = instrument.upper()
+    obstypes = INSTRUMENTS[instrument]['obstypes']
+
+    if filters is None:
+        filters = FILTERS
+
+    known_filters = dict(get_filters())
+
+    for code in filters:
+        if code not in known_filters:
+            raise ValueError('Unknown filter: {}'.format(code))
+
+    plan = []
+
+    for obstype in obstypes[:-1]:
+
+        n = max(1, int(round(PLAN_FRACTIONS[obstype] * n_frames)))
+
+        for k in range(n):
+            if obstype in ('ZERO', 'DARK'):
+                plan.append((obstype, filters[0]))
+            else:
+                plan.append((obstype, filters[k * len(filters) // n]))
+
+    n = max(0, n_frames - len(plan))
+
+    for k in range(n):
+        plan.append((obstypes[-1], filters[k * len(filters) // n]))
+
+    return plan[:n_frames]
+
+
+def make_night(path, instrument='SAM', n_frames=20, binning=4, filters=None,
+               seed=0):
+    """
+    Write a synthetic night.
+
+    Args:
+
+        path (str) : folder where the files are written. It is created if
+        needed.
+
+        instrument (str, optional) : 'SAM' or 'SOI' (default = 'SAM').
+
+        n_frames (int, optional) : total number of frames (default = 20).
+
+        binning (int, optional) : 1, 2 or 4 (default = 4).
+
+        filters (list, optional) : codes of the filters used by the flats
+        and the objects (default = FILTERS).
+
+        seed (int, optional) : seed used for the first frame. Each frame
+        uses the next one. The OBJECT frames follow the DITHERS pattern.
+
+    Returns:
+
+        list_of_files (list) : names of the files written.
+    """
+    instrument = instrument.upper()
+    prefix = INSTRUMENTS[instrument]['prefix']
+
+    plan = night_plan(instrument, n_frames=n_frames, filters=filters)
+
+    os.makedirs(path, exist_ok=True)
+    list_of_files = []
+    n_objects = 0
+
+    for i, (obstype, filters) in enumerate(plan):
+
+        filename = os.path.join(path, '{:s}_{:04d}.fits'.format(prefix, i))
+
+        dither = (0, 0)
+        if obstype == 'OBJECT':
+            dither = DITHERS[n_objects % len(DITHERS)]
+            n_objects += 1
+
+        write_frame(filename, instrument=instrument, obstype=obstype,
+                    binning=binning, filters=filters, seed=seed + i,
+                    dither=dither)
+
+        list_of_files.append(filename)
+
+    return list_of_files
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from scipy import ndimage
+
+from soar_simager.data_reduction import night, reduce
+from soar_simager.tools import synthetic
+
+__author__ = 'Bruno Quint'
+
+
+class TestMakeFrame(unittest.TestCase):
+
+    def test_sami_geometry(self):
+
+        hdul = synthetic.make_frame('SAM', 'OBJECT', binning=4)
+
+        self.assertEqual(len(hdul), 5)
+        self.assertEqual(hdul[0].header['INSTRUME'], 'SAM')
+        self.assertEqual(hdul[0].header['FILTER1'], 'gunn_r')
+
+        for hdu in hdul[1:]:
+            self.assertEqual(hdu.data.shape, (512, 520))
+            self.assertEqual(hdu.header['CCDSUM'], '4 4')
+
+        data, header, prefix = reduce.Reducer().merge(hdul)
+        self.assertEqual(data.shape, (1024, 1024))
+
+    def test_overscan_removed(self):
+
+        hdul = synthetic.make_frame('SAM', 'ZERO', binning=4)
+        data, header, prefix = reduce.Reducer().merge(hdul)
+
+        # The bias level is different in each amplifier.
+        for y, x in [(0, 0), (0, 512), (512, 0), (512, 512)]:
+            self.assertLess(
+                abs(np.median(data[y:y + 512, x:x + 512])), 1.)
+
+    def test_bad_columns(self):
+
+        hdul = synthetic.make_frame('SAM', 'SFLAT', binning=4)
+        data, header, prefix = reduce.Reducer().merge(hdul)
+
+        self.assertGreater(np.median(data[10:500, 167]),
+                           np.median(data[10:500, 160]) + 500.)
+
+    def test_soi_geometry(self):
+
+        hdul = synthetic.make_frame('SOI', 'OBJECT', binning=4)
+
+        self.assertEqual(len(hdul), 5)
+        self.assertEqual(hdul[1].data.shape, (1024, 264))
+
+        data, header, prefix = reduce.Reducer().merge(hdul)
+        self.assertEqual(data.shape, (1024, 1024))
+
+    def test_reproducible(self):
+
+        a = synthetic.make_frame('SAM', 'OBJECT', binning=4, seed=3)
+        b = synthetic.make_frame('SAM', 'OBJECT', binning=4, seed=3)
+
+        for hdu_a, hdu_b in zip(a[1:], b[1:]):
+            np.testing.assert_array_equal(hdu_a.data, hdu_b.data)
+
+    def test_dither(self):
+
+        a = synthetic.make_frame('SAM', 'OBJECT', binning=4, seed=1)
+        b = synthetic.make_frame('SAM', 'OBJECT', binning=4, seed=2,
+                                 dither=(40, -24))
+
+        peaks = []
+        for hdul in (a, b):
+            data = ndimage.median_filter(reduce.Reducer().merge(hdul)[0], 3)
+            peaks.append(np.unravel_index(np.argmax(data), data.shape))
+
+        # The stars move the other way, by the dither in binned pixels.
+        self.assertEqual(peaks[1], (peaks[0][0] + 6, peaks[0][1] - 10))
+
+        self.assertEqual(a[0].header['DEC'], '-30:00:00.000')
+        self.assertEqual(b[0].header['DEC'], '-30:00:01.092')
+
+
+class TestMakeNight(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_night_plan(self):
+
+        plan = synthetic.night_plan('SAM', n_frames=20,
+                                    filters=['c0002', 'c0003'])
+        obstypes = [obstype for obstype, filters in plan]
+
+        self.assertEqual(len(plan), 20)
+        self.assertEqual(obstypes.count('ZERO'), 4)
+        self.assertEqual(obstypes.count('DARK'), 2)
+        self.assertEqual(obstypes.count('SFLAT'), 4)
+        self.assertEqual({f for o, f in plan if o == 'OBJECT'},
+                         {'c0002', 'c0003'})
+
+        plan = synthetic.night_plan('SOI', n_frames=10)
+        self.assertNotIn('DARK', [obstype for obstype, filters in plan])
+
+        with self.assertRaises(ValueError):
+            synthetic.night_plan('SAM', filters=['x9999'])
+
+    def test_make_night(self):
+
+        list_of_files = synthetic.make_night(
+            self.path, 'SAM', n_frames=6, binning=4)
+
+        self.assertEqual(len(list_of_files), 6)
+        self.assertEqual(os.path.basename(list_of_files[0]),
+                         'sami_0000.fits')
+
+        for filename in list_of_files:
+            info = night.read_file_info(filename)
+            self.assertFalse(info['bad_data'])
+            self.assertEqual(info['binning'], '4 4')
+
+
+if __name__ == '__main__':
+    unittest.main()